@@ -0,0 +1,85 @@
+"""
+Benchmark of request throughput of data_fetching.utils against a local stub of the ZTM API.
+
+Compares sequential requests without session reuse with fetch_concurrently
+on a pooled ApiClient, for several in-flight limits.
+
+Run from the repository root:
+    python3 benchmarks/bench_fetch.py
+"""
+
+import os
+import sys
+import json
+import threading
+from time import sleep, perf_counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), ".."),
+                os.path.join(os.path.dirname(__file__), "..", "data_fetching")]
+
+# pylint: disable=wrong-import-position
+from data_fetching.utils import send_request, fetch_concurrently, ApiClient
+
+LATENCY = 0.02
+REQUESTS = 200
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every POST after LATENCY seconds, like a slow timetable endpoint.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Handles POST request.
+        """
+        sleep(LATENCY)
+        body = json.dumps({"result": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/api/action/dbtimetable_get"
+
+    start = perf_counter()
+    for _ in range(REQUESTS):
+        send_request(url)
+    print(f"sequential, no session: {REQUESTS / (perf_counter() - start):.1f} req/s")
+
+    for max_workers in (1, 4, 16):
+        client = ApiClient(max_workers)
+        start = perf_counter()
+        for _ in fetch_concurrently(lambda _: send_request(url, client), range(REQUESTS),
+                                    max_workers):
+            pass
+        print(f"pooled, {max_workers} in flight: "
+              f"{REQUESTS / (perf_counter() - start):.1f} req/s")
+
+    client = ApiClient(16, max_rate=50)
+    start = perf_counter()
+    for _ in fetch_concurrently(lambda _: send_request(url, client), range(REQUESTS), 16):
+        pass
+    print(f"pooled, 16 in flight, capped at 50 req/s: "
+          f"{REQUESTS / (perf_counter() - start):.1f} req/s")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
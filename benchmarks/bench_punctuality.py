@@ -0,0 +1,120 @@
+"""
+Benchmark of bus stop arrival matching in punctuality.find_delays.
+
+Compares the indexed matcher with the original linear scan over live bus data
+on synthetic data and checks that both return identical delays.
+
+Run from the repository root:
+    python3 benchmarks/bench_punctuality.py
+"""
+
+import os
+import sys
+import random
+from math import cos, sin
+from time import perf_counter
+from datetime import datetime, timedelta
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "..", "data_analysis"),
+                os.path.join(os.path.dirname(__file__), "..")]
+
+# pylint: disable=wrong-import-position
+from punctuality import find_delays
+from utils import is_at_stop, validate_time_format, BUS_DATA_MEASUREMENT_TIME
+
+
+def linear_scan_delays(schedules_data, bus_stops_to_locations, bus_locations, download_time):
+    """
+    Original matcher: for every scheduled time scans all live data of the bus line.
+    """
+    delayed_buses = []
+    for sid in schedules_data:
+        bus_stop_id, bus_stop_nr, bus_line = sid.split(',')
+
+        times = [datetime.strptime(time, '%H:%M:%S').time()
+                 for time in schedules_data[sid] if validate_time_format(time)]
+        times = [download_time.replace(
+            hour=t.hour, minute=t.minute, second=t.second) for t in times]
+        times = [time for time in times if download_time <=
+                 time <= download_time + BUS_DATA_MEASUREMENT_TIME]
+
+        bus_stop_loc = bus_stops_to_locations[(bus_stop_id, bus_stop_nr)]
+
+        if bus_line not in bus_locations:
+            continue
+        locations = bus_locations[bus_line]
+
+        for time in times:
+            arrival = next(((t, bus_loc) for (t, bus_loc) in locations if t >= time -
+                            timedelta(minutes=2) and is_at_stop(bus_loc, bus_stop_loc)), None)
+            if arrival is None:
+                continue
+
+            delay = arrival[0] - time
+            if delay >= timedelta(minutes=2):
+                delayed_buses.append((bus_line, bus_stop_id, time, delay))
+
+    return delayed_buses
+
+
+def generate_data(n_lines, n_stops_per_line, seed=0):
+    """
+    Generates bus stops, schedules and live data of buses driving along straight routes.
+    """
+    rng = random.Random(seed)
+    download_time = datetime(2024, 2, 19, 9, 0, 0)
+
+    bus_stops_to_locations = {}
+    schedules_data = {}
+    bus_locations = {}
+
+    for line in range(n_lines):
+        bus_line = str(100 + line)
+        lat0, lon0 = 52.15 + rng.random() * 0.15, 20.90 + rng.random() * 0.25
+        heading = rng.random() * 6.28
+
+        route = []
+        for stop in range(n_stops_per_line):
+            key = (f"{line:04d}", f"{stop:02d}")
+            loc = (str(lat0 + 0.004 * stop * cos(heading)),
+                   str(lon0 + 0.006 * stop * sin(heading)))
+            bus_stops_to_locations[key] = loc
+            route.append(loc)
+
+        locations = []
+        for bus in range(12):
+            start = download_time + timedelta(minutes=5 * bus - 10)
+            for stop, loc in enumerate(route):
+                scheduled = start + timedelta(minutes=2 * stop)
+                key = f"{line:04d},{stop:02d},{bus_line}"
+                schedules_data.setdefault(key, []).append(scheduled.strftime('%H:%M:%S'))
+                seen = scheduled + timedelta(seconds=rng.randint(-60, 400))
+                locations.append((seen, (float(loc[0]) + rng.gauss(0, 0.001),
+                                         float(loc[1]) + rng.gauss(0, 0.001))))
+        bus_locations[bus_line] = sorted(locations, key=lambda x: x[0])
+
+    return schedules_data, bus_stops_to_locations, bus_locations, download_time
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    for n_lines in (20, 80):
+        data = generate_data(n_lines, 25)
+
+        start = perf_counter()
+        expected = linear_scan_delays(*data)
+        linear_time = perf_counter() - start
+
+        start = perf_counter()
+        result = find_delays(*data)
+        indexed_time = perf_counter() - start
+
+        assert result == expected, "indexed matcher differs from linear scan"
+        print(f"{n_lines} lines: linear scan {linear_time:.3f}s, "
+              f"indexed {indexed_time:.3f}s, {len(result)} delays, identical results")
+
+
+if __name__ == "__main__":
+    main()
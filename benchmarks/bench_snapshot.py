@@ -0,0 +1,103 @@
+"""
+Benchmark of loading captures and schedules from JSON and from memory-mapped snapshots.
+
+Every load runs in a fresh process so peak RSS (VmHWM, Linux only) can be measured.
+Loaded captures are scanned once (sum of latitudes) so memory-mapped pages are actually read.
+
+Run from the repository root:
+    python3 benchmarks/bench_snapshot.py
+"""
+
+import os
+import sys
+import json
+import random
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+DATA_ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_analysis")
+sys.path[:0] = [DATA_ANALYSIS_DIR, os.path.dirname(DATA_ANALYSIS_DIR)]
+
+# pylint: disable=wrong-import-position
+from snapshot import convert
+
+FIXES = 500_000
+SCHEDULES = 30_000
+
+LOAD_SCRIPT = """
+import sys, json
+from time import perf_counter
+sys.path[:0] = [{data_analysis_dir!r}, {data_analysis_dir!r} + "/.."]
+from bus_fixes import load_bus_fixes
+from snapshot import ScheduleTable
+
+start = perf_counter()
+{statement}
+elapsed = perf_counter() - start
+with open("/proc/self/status", encoding="utf-8") as status:
+    rss = next(int(line.split()[1]) for line in status if line.startswith("VmHWM")) / 1024
+print(f"{{elapsed:.3f}} {{rss:.0f}}")
+"""
+
+
+def generate(data_dir):
+    """
+    Writes a synthetic capture and schedules in the JSON format of data_fetching.
+    """
+    rng = random.Random(0)
+    start = datetime(2024, 2, 19, 9, 0, 0)
+    fixes = [{"Lines": str(100 + i % 300), "Lon": 21.0 + rng.random() * 0.3,
+              "VehicleNumber": str(1000 + i % 2000),
+              "Time": (start + timedelta(seconds=i // 2000 * 10)).strftime('%Y-%m-%d %H:%M:%S'),
+              "Lat": 52.1 + rng.random() * 0.2, "Brigade": str(i % 20)}
+             for i in range(FIXES)]
+    with open(os.path.join(data_dir, "bus-locations.json"), "w", encoding="utf-8") as json_file:
+        json.dump(fixes, json_file, indent=2)
+
+    schedules = {f"{i // 10:04d},{i % 10:02d},{100 + i % 300}":
+                 [f"{h:02d}:{m:02d}:00" for h in range(5, 24) for m in (0, 20, 40)]
+                 for i in range(SCHEDULES)}
+    with open(os.path.join(data_dir, "bus-schedules.json"), "w", encoding="utf-8") as json_file:
+        json.dump(schedules, json_file, indent=2)
+
+
+def measure(statement):
+    """
+    Runs statement in a fresh process and returns its duration and peak RSS in MiB.
+    """
+    output = subprocess.run([sys.executable, "-c", LOAD_SCRIPT.format(
+        data_analysis_dir=DATA_ANALYSIS_DIR, statement=statement)],
+                            capture_output=True, text=True, check=True).stdout
+    elapsed, rss = output.split()[-2:]
+    return float(elapsed), float(rss)
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate(data_dir)
+        capture = os.path.join(data_dir, "bus-locations.json")
+        schedules = os.path.join(data_dir, "bus-schedules")
+        convert(data_dir, [capture])
+
+        baseline = measure("pass")
+        print(f"interpreter baseline: {baseline[1]:.0f} MiB")
+        for name, statement in (
+                ("capture from JSON",
+                 f"fixes = load_bus_fixes({capture!r}); fixes.lats.sum()"),
+                ("capture from snapshot",
+                 f"fixes = load_bus_fixes({capture.replace('.json', '.snapshot')!r}); "
+                 "fixes.lats.sum()"),
+                ("schedules from JSON",
+                 f"schedules = json.load(open({schedules + '.json'!r}, encoding='utf-8'))"),
+                ("schedules from snapshot",
+                 f"schedules = ScheduleTable.load({schedules + '.snapshot'!r})")):
+            elapsed, rss = measure(statement)
+            print(f"{name}: {elapsed:.3f}s, peak RSS {rss:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Microbenchmark of timestamp parsing used by the analysis loaders.
+
+Compares the previous path (validate_*_format with strptime followed by a second strptime)
+with the vectorized parse_datetimes and parse_times, and checks they agree.
+
+Run from the repository root:
+    python3 benchmarks/bench_timestamps.py
+"""
+
+import os
+import sys
+import random
+from time import perf_counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "data_analysis"))
+
+# pylint: disable=wrong-import-position
+from utils import parse_datetimes, parse_times, to_seconds
+
+N = 200_000
+
+
+def strptime_datetimes(datetime_strs):
+    """
+    Previous loader path: validation with strptime, then parsing with strptime again.
+    """
+    seconds = []
+    for datetime_str in datetime_strs:
+        try:
+            datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+        seconds.append(to_seconds(datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')))
+    return seconds
+
+
+def strptime_times(time_strs):
+    """
+    Previous schedule path: validation with strptime, then parsing with strptime again.
+    """
+    seconds = []
+    for time_str in time_strs:
+        try:
+            datetime.strptime(time_str, '%H:%M:%S')
+        except ValueError:
+            continue
+        time = datetime.strptime(time_str, '%H:%M:%S').time()
+        seconds.append(time.hour * 3600 + time.minute * 60 + time.second)
+    return seconds
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    rng = random.Random(0)
+    start = datetime(2024, 2, 18)
+    datetime_strs = [(start + timedelta(seconds=rng.randrange(86400))).strftime(
+        '%Y-%m-%d %H:%M:%S') for _ in range(N)]
+    datetime_strs[::1000] = ["2024-02-18T12:00:00"] * len(datetime_strs[::1000])
+    time_strs = [f"{rng.randrange(26):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}"
+                 for _ in range(N)]
+
+    for name, reference, parse, strings in (
+            ("datetimes", strptime_datetimes, parse_datetimes, datetime_strs),
+            ("times", strptime_times, parse_times, time_strs)):
+        begin = perf_counter()
+        expected = reference(strings)
+        reference_time = perf_counter() - begin
+
+        begin = perf_counter()
+        seconds, valid = parse(strings)
+        parse_time = perf_counter() - begin
+
+        assert seconds[valid].tolist() == expected, f"{name} differ"
+        print(f"{N} {name}: strptime {reference_time:.3f}s, vectorized {parse_time:.3f}s "
+              f"({reference_time / parse_time:.0f}x), identical results")
+
+
+if __name__ == "__main__":
+    main()
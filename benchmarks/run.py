@@ -0,0 +1,151 @@
+"""
+Benchmark suite of the analysis hot paths on synthetic city-scale data.
+
+Every benchmark is run repeats times after a warm-up call and its best time is compared
+with the baseline stored in benchmarks/baselines.json for the same scale. The run fails
+(exit code 1) if any benchmark is slower than its baseline by more than the tolerance
+and by more than MIN_REGRESSION seconds.
+
+Run from the repository root:
+    python3 benchmarks/run.py [--scale small|city] [--repeats 5] [--tolerance 0.5] [--update]
+
+--update stores the measured times as new baselines. Baselines depend on the machine,
+so update them on the machine that runs the comparison.
+"""
+
+import gc
+import io
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from time import perf_counter
+from contextlib import redirect_stdout, redirect_stderr
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCHMARKS_DIR, "..", "data_analysis"),
+                os.path.join(BENCHMARKS_DIR, "..")]
+
+# pylint: disable=wrong-import-position
+from synthetic import generate_city
+from utils import iter_bus_records
+from bus_fixes import load_bus_fixes
+from bus_speeding import parse_data, get_speeding_buses
+from punctuality import get_bus_locations, calculate_delays
+from bus_stop_criticality import calculate_bus_stop_criticality
+
+BASELINES_PATH = os.path.join(BENCHMARKS_DIR, "baselines.json")
+
+# Slowdowns smaller than this many seconds are treated as timer noise
+MIN_REGRESSION = 0.005
+
+SCALES = {
+    "small": {"vehicles": 200, "hours": 0.5, "poll_interval": 60},
+    "city": {"vehicles": 1600, "hours": 1.0, "poll_interval": 30},
+}
+
+
+def get_benchmarks(data_dir, city):
+    """
+    Returns benchmarks as tuples of name, setup called before every run and the measured
+    function taking the result of setup.
+    """
+    capture, download_time = city["capture"], city["download_time"]
+    records = list(iter_bus_records(capture))
+    with redirect_stdout(io.StringIO()):
+        bus_to_data = parse_data(capture)
+        fixes = load_bus_fixes(capture)
+
+    def no_setup():
+        return None
+
+    def remove_criticality_cache():
+        shutil.rmtree(os.path.join(data_dir, "bus-stop-criticality.snapshot"), ignore_errors=True)
+
+    return [
+        ("parse_data", no_setup, lambda _: parse_data(capture)),
+        ("get_speeding_buses[dict]", no_setup, lambda _: get_speeding_buses(bus_to_data)),
+        ("get_speeding_buses[BusFixes]", no_setup, lambda _: get_speeding_buses(fixes)),
+        ("get_bus_locations[records]", no_setup,
+         lambda _: get_bus_locations(records, download_time)),
+        ("get_bus_locations[BusFixes]", no_setup,
+         lambda _: get_bus_locations(fixes, download_time)),
+        ("calculate_delays", no_setup,
+         lambda _: calculate_delays(data_dir, capture, download_time)),
+        ("calculate_bus_stop_criticality[cold]", remove_criticality_cache,
+         lambda _: calculate_bus_stop_criticality(data_dir)),
+        ("calculate_bus_stop_criticality[cached]", no_setup,
+         lambda _: calculate_bus_stop_criticality(data_dir)),
+    ]
+
+
+def measure(setup, function, repeats):
+    """
+    Returns the best time of repeats calls of function after a warm-up call, which is
+    less sensitive to noise of other processes than the mean.
+    Output of the measured code is discarded.
+    """
+    times = []
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        for run in range(repeats + 1):
+            argument = setup()
+            gc.collect()
+            start = perf_counter()
+            function(argument)
+            if run > 0:
+                times.append(perf_counter() - start)
+    return min(times)
+
+
+def main():
+    """
+    Runs the benchmark suite.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed slowdown relative to the baseline, 0.5 means 50%%")
+    parser.add_argument("--update", action="store_true", help="store results as baselines")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.isfile(BASELINES_PATH):
+        with open(BASELINES_PATH, "r", encoding="utf-8") as json_file:
+            baselines = json.load(json_file)
+    scale_baselines = baselines.setdefault(args.scale, {})
+
+    regressions = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        city = generate_city(data_dir, **SCALES[args.scale])
+        print(f"scale {args.scale}: {SCALES[args.scale]}")
+
+        for name, setup, function in get_benchmarks(data_dir, city):
+            best = measure(setup, function, args.repeats)
+            baseline = scale_baselines.get(name)
+            if baseline is None:
+                status = "no baseline"
+            else:
+                ratio = best / baseline
+                status = f"{ratio:.2f}x baseline"
+                if ratio > 1.0 + args.tolerance and best - baseline > MIN_REGRESSION:
+                    status += " REGRESSION"
+                    regressions.append(name)
+            print(f"{name:40s} {best * 1000:10.1f} ms  {status}")
+            if args.update:
+                scale_baselines[name] = round(best, 6)
+
+    if args.update:
+        with open(BASELINES_PATH, "w", encoding="utf-8") as json_file:
+            json.dump(baselines, json_file, indent=2, sort_keys=True)
+            json_file.write("\n")
+        print(f"baselines saved to {BASELINES_PATH}")
+    elif regressions:
+        print(f"regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
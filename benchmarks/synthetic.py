@@ -0,0 +1,137 @@
+"""
+Deterministic generator of synthetic city-scale bus data for benchmarks.
+
+Bus lines run around circular routes placed within Warsaw. Vehicles of every line are spaced
+evenly along the route and each keeps its own constant delay, so schedules, live positions
+and expected delays are consistent. Files are written in the formats saved by data_fetching:
+bus-stops.json, bus-stops-to-bus-lines.json, bus-schedules.json and a capture of polls
+in bus-locations.json (with fixes repeated by consecutive polls, as the ZTM API does).
+
+Run from the repository root to write data for manual experiments:
+    python3 benchmarks/synthetic.py <data_dir> [vehicles] [hours] [poll_interval]
+"""
+
+import os
+import sys
+import json
+import random
+from math import cos, sin, radians, pi
+from datetime import datetime, timedelta
+
+# Distance between consecutive bus stops in meters and driving time between them in seconds
+STOP_SPACING = 400.0
+STOP_TRAVEL_TIME = 80
+
+METERS_PER_DEGREE = 6371000.0 * pi / 180.0
+
+START = datetime(2024, 2, 19, 8, 0, 0)
+
+
+def _stop_value(bus_stop_id, bus_stop_nr, lat, lon):
+    values = [("zespol", bus_stop_id), ("slupek", bus_stop_nr), ("nazwa_zespolu", "Synthetic"),
+              ("id_ulicy", "0000"), ("szer_geo", f"{lat:.6f}"), ("dlug_geo", f"{lon:.6f}"),
+              ("kierunek", "Centrum"), ("obowiazuje_od", "2024-01-01 00:00:00.0")]
+    return {"values": [{"key": key, "value": value} for key, value in values]}
+
+
+def generate_city(data_dir, vehicles=400, hours=1.0, poll_interval=60, vehicles_per_line=8,
+                  stops_per_line=30, start=START, seed=0):
+    """
+    Writes synthetic bus stops, lines, schedules and a capture of live positions to data_dir.
+
+    Parameters:
+    - data_dir (str): Output directory, created if needed.
+    - vehicles (int): Number of vehicles in the capture.
+    - hours (float): Length of the capture.
+    - poll_interval (int): Seconds between polls of live positions.
+    - vehicles_per_line (int): Vehicles serving every bus line.
+    - stops_per_line (int): Bus stops on the route of every line (at most 99).
+    - start (datetime): Time of the first poll.
+    - seed (int): Seed of the random generator; equal arguments give identical files.
+
+    Returns:
+    - dict: Paths of the written files ("bus_stops", "bus_stops_to_lines", "schedules",
+      "capture") and the "download_time" of the capture.
+    """
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+
+    n_lines = max(1, vehicles // vehicles_per_line)
+    radius = stops_per_line * STOP_SPACING / (2 * pi)
+    cycle = stops_per_line * STOP_TRAVEL_TIME
+    headway = cycle / vehicles_per_line
+    day_start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    bus_stops = []
+    stops_to_lines = {}
+    schedules = {}
+    routes = []
+    for line in range(n_lines):
+        bus_line = str(100 + line)
+        center_lat = 52.15 + rng.random() * 0.16
+        center_lon = 20.90 + rng.random() * 0.26
+        scale_lon = METERS_PER_DEGREE * cos(radians(center_lat))
+        routes.append((bus_line, center_lat, center_lon, scale_lon))
+
+        for stop in range(stops_per_line):
+            angle = 2 * pi * stop / stops_per_line
+            bus_stop_id, bus_stop_nr = f"{1000 + line}", f"{stop + 1:02d}"
+            bus_stops.append(_stop_value(bus_stop_id, bus_stop_nr,
+                                         center_lat + radius * sin(angle) / METERS_PER_DEGREE,
+                                         center_lon + radius * cos(angle) / scale_lon))
+            stops_to_lines[f"{bus_stop_id},{bus_stop_nr}"] = [bus_line]
+
+            # Departures every headway from 05:00 until 00:30 of the next day
+            first = 5 * 3600 + stop * STOP_TRAVEL_TIME
+            schedules[f"{bus_stop_id},{bus_stop_nr},{bus_line}"] = [
+                f"{int(t) // 3600:02d}:{int(t) // 60 % 60:02d}:{int(t) % 60:02d}"
+                for t in (first + k * headway for k in range(int((19.5 * 3600) // headway)))]
+
+    fleet = []
+    for vehicle in range(vehicles):
+        line = vehicle % n_lines
+        # A few vehicles drive three times faster than scheduled, over the speed limit
+        fleet.append((str(1000 + vehicle), line, vehicle // n_lines % vehicles_per_line,
+                      rng.randint(0, 420), rng.randint(1, 20),
+                      3.0 if rng.random() < 0.03 else 1.0))
+
+    records = []
+    last_times = {}
+    for poll in range(int(hours * 3600 // poll_interval)):
+        poll_time = start + timedelta(seconds=poll * poll_interval)
+        for vehicle_number, line, slot, delay, brigade, pace in fleet:
+            bus_line, center_lat, center_lon, scale_lon = routes[line]
+            # Some vehicles do not send a new fix before the next poll
+            if vehicle_number in last_times and rng.random() < 0.3:
+                records.append(last_times[vehicle_number])
+                continue
+            fix_time = poll_time - timedelta(seconds=rng.randint(0, min(poll_interval, 30)))
+            elapsed = ((fix_time - day_start).total_seconds() - 5 * 3600 - slot * headway
+                       - delay) * pace
+            angle = 2 * pi * (elapsed % cycle) / cycle
+            lat = center_lat + radius * sin(angle) / METERS_PER_DEGREE + rng.gauss(0, 1e-4)
+            lon = center_lon + radius * cos(angle) / scale_lon + rng.gauss(0, 1.5e-4)
+            if rng.random() < 0.001:
+                lat += 0.05  # GPS spike
+            record = {"Lines": bus_line, "Lon": round(lon, 7), "VehicleNumber": vehicle_number,
+                      "Time": fix_time.strftime('%Y-%m-%d %H:%M:%S'), "Lat": round(lat, 7),
+                      "Brigade": str(brigade)}
+            last_times[vehicle_number] = record
+            records.append(record)
+
+    paths = {"bus_stops": os.path.join(data_dir, "bus-stops.json"),
+             "bus_stops_to_lines": os.path.join(data_dir, "bus-stops-to-bus-lines.json"),
+             "schedules": os.path.join(data_dir, "bus-schedules.json"),
+             "capture": os.path.join(data_dir, "bus-locations.json")}
+    for name, data in (("bus_stops", {"result": bus_stops}),
+                       ("bus_stops_to_lines", stops_to_lines),
+                       ("schedules", schedules), ("capture", records)):
+        with open(paths[name], "w", encoding="utf-8") as json_file:
+            json.dump(data, json_file, indent=2, ensure_ascii=False)
+
+    return {**paths, "download_time": start}
+
+
+if __name__ == "__main__":
+    generate_city(sys.argv[1], *(int(arg) for arg in sys.argv[2:3]),
+                  *(float(arg) for arg in sys.argv[3:4]), *(int(arg) for arg in sys.argv[4:5]))
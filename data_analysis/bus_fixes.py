@@ -0,0 +1,243 @@
+"""
+This module provides a columnar in-memory store for bus location fixes.
+"""
+
+import os
+from array import array
+
+import numpy as np
+
+from utils import parse_datetimes, from_seconds, to_seconds, iter_bus_records, save_arrays,\
+                  load_arrays, find_outliers
+from instrumentation import stage
+
+
+PARSE_CHUNK_SIZE = 65536
+
+COLUMNS = ("lats", "lons", "times", "vehicles", "vehicle_codes", "lines", "line_codes",
+           "brigades", "brigade_codes", "offsets")
+
+
+def _categorize(values):
+    """
+    Encodes values as codes into a sorted array of unique categories.
+    """
+    categories, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return categories, codes.astype(np.int32)
+
+
+class BusFixes:
+    """
+    Bus location fixes stored as typed arrays, sorted by vehicle and time.
+
+    Vehicle numbers, lines and brigades are stored as int32 codes into arrays of categories.
+    Vehicle codes follow the order of the categories, so fixes of the i-th vehicle are
+    the slice offsets[i]:offsets[i + 1] of every column.
+    """
+
+    def __init__(self, lats, lons, times, vehicles, vehicle_codes, lines, line_codes,
+                 brigades, brigade_codes):
+        """
+        Parameters:
+        - lats, lons (numpy.ndarray): Coordinates of the fixes.
+        - times (numpy.ndarray): Times of the fixes in seconds since 1970-01-01.
+        - vehicles, lines, brigades (numpy.ndarray): Categories of the codes.
+        - vehicle_codes, line_codes, brigade_codes (numpy.ndarray): Codes of the fixes.
+        """
+        order = np.lexsort((times, vehicle_codes))
+
+        self.lats = np.asarray(lats, dtype=np.float64)[order]
+        self.lons = np.asarray(lons, dtype=np.float64)[order]
+        self.times = np.asarray(times, dtype=np.int64)[order]
+        self.vehicles = vehicles
+        self.vehicle_codes = np.asarray(vehicle_codes, dtype=np.int32)[order]
+        self.lines = lines
+        self.line_codes = np.asarray(line_codes, dtype=np.int32)[order]
+        self.brigades = brigades
+        self.brigade_codes = np.asarray(brigade_codes, dtype=np.int32)[order]
+
+        counts = np.bincount(self.vehicle_codes, minlength=len(vehicles))
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Builds the store from an iterable of bus data dictionaries as returned by the ZTM API,
+        consuming it once. Entries that are not dictionaries or have invalid time or location
+        are skipped, as are fixes repeating the previous time of the same vehicle.
+        """
+        lats, lons, times, valid = array('d'), array('d'), array('q'), array('b')
+        codes = {'VehicleNumber': array('i'), 'Lines': array('i'), 'Brigade': array('i')}
+        categories = {name: {} for name in codes}
+
+        # Time strings are parsed in chunks; zero-padded fixed format makes equal times
+        # equal strings, so duplicates are detected before parsing
+        time_strs = []
+
+        def parse_chunk():
+            chunk_times, chunk_valid = parse_datetimes(time_strs)
+            times.extend(chunk_times.tolist())
+            valid.extend(chunk_valid.tolist())
+            time_strs.clear()
+
+        last_times = {}
+        total = duplicates = 0
+        for bus_data in records:
+            total += 1
+            if not isinstance(bus_data, dict):
+                continue
+            vehicle_number = str(bus_data.get('VehicleNumber', ''))
+            if last_times.get(vehicle_number) == bus_data.get('Time'):
+                duplicates += 1
+                continue
+            last_times[vehicle_number] = bus_data.get('Time')
+
+            time_strs.append(bus_data.get('Time'))
+            try:
+                lat, lon = float(bus_data['Lat']), float(bus_data['Lon'])
+            except (KeyError, TypeError, ValueError):
+                # Skipped below like entries with invalid time
+                lat = lon = float('nan')
+            lats.append(lat)
+            lons.append(lon)
+            for name, name_codes in codes.items():
+                values = categories[name]
+                name_codes.append(values.setdefault(str(bus_data.get(name, '')), len(values)))
+
+            if len(time_strs) == PARSE_CHUNK_SIZE:
+                parse_chunk()
+        parse_chunk()
+
+        valid = np.frombuffer(valid, dtype=np.int8).astype(bool)
+        valid &= ~(np.isnan(np.frombuffer(lats, dtype=np.float64)) |
+                   np.isnan(np.frombuffer(lons, dtype=np.float64)))
+        print(f"skipped {total - duplicates - np.count_nonzero(valid)} elements out of {total}")
+        print(f"dropped {duplicates} duplicate elements ({duplicates / max(total, 1):.1%})")
+
+        columns = []
+        for name, name_codes in codes.items():
+            # Remap codes from order of first appearance to order of sorted categories
+            values, remap = _categorize(list(categories[name]))
+            columns.extend((values, remap[np.frombuffer(name_codes, dtype=np.int32)[valid]]))
+
+        return cls(np.frombuffer(lats, dtype=np.float64)[valid],
+                   np.frombuffer(lons, dtype=np.float64)[valid],
+                   np.frombuffer(times, dtype=np.int64)[valid], *columns)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Builds the store from a dictionary of columns already sorted by vehicle and time,
+        e.g. memory-mapped from a snapshot, without copying them.
+        """
+        fixes = cls.__new__(cls)
+        for name in COLUMNS:
+            setattr(fixes, name, arrays[name])
+        return fixes
+
+    def save(self, dirpath):
+        """
+        Saves the store as a snapshot directory of .npy files.
+        """
+        save_arrays(dirpath, {name: getattr(self, name) for name in COLUMNS},
+                    {"format": "bus-fixes"})
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def vehicle_count(self):
+        """
+        Number of vehicles with at least one fix in the store.
+        """
+        return int(np.count_nonzero(np.diff(self.offsets)))
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes used by the arrays of the store.
+        """
+        return sum(array.nbytes for array in vars(self).values()
+                   if isinstance(array, np.ndarray))
+
+    def vehicle_slice(self, vehicle_code):
+        """
+        Returns the slice of columns with fixes of the given vehicle.
+        """
+        return slice(self.offsets[vehicle_code], self.offsets[vehicle_code + 1])
+
+    def filter(self, mask):
+        """
+        Returns a new store with the fixes selected by a boolean mask.
+        """
+        return BusFixes(self.lats[mask], self.lons[mask], self.times[mask],
+                        self.vehicles, self.vehicle_codes[mask], self.lines, self.line_codes[mask],
+                        self.brigades, self.brigade_codes[mask])
+
+    def datetimes(self, indices):
+        """
+        Returns times of the fixes at given indices as datetime objects.
+        """
+        return [from_seconds(time) for time in self.times[indices].tolist()]
+
+    def records(self, indices):
+        """
+        Returns fixes at given indices as bus data dictionaries with parsed time.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return [{"Lines": line, "Lon": lon, "VehicleNumber": vehicle, "Time": time,
+                 "Lat": lat, "Brigade": brigade}
+                for line, lon, vehicle, time, lat, brigade in zip(
+                    self.lines[self.line_codes[indices]].tolist(),
+                    self.lons[indices].tolist(),
+                    self.vehicles[self.vehicle_codes[indices]].tolist(),
+                    self.datetimes(indices),
+                    self.lats[indices].tolist(),
+                    self.brigades[self.brigade_codes[indices]].tolist())]
+
+
+def clean_fixes(fixes, time_window=None, **kwargs):
+    """
+    Drops GPS outliers from a BusFixes store: fixes outside the service area, fixes more
+    than a tolerance outside time_window (start and end in seconds) and GPS jumps.
+    Other keyword arguments are passed to utils.find_outliers.
+
+    Returns:
+    - tuple: The cleaned store and a dictionary of numbers of fixes dropped by each rule.
+    """
+    with stage("validate") as current:
+        # Trajectories are split between vehicles and between lines served by the same vehicle
+        starts = np.flatnonzero(np.concatenate(([True], (np.diff(fixes.vehicle_codes) != 0) |
+                                                (np.diff(fixes.line_codes) != 0))))
+        outliers = find_outliers(fixes.lats, fixes.lons, fixes.times,
+                                 starts[starts < len(fixes)], time_window=time_window, **kwargs)
+
+        dropped = np.zeros(len(fixes), dtype=bool)
+        for mask in outliers.values():
+            dropped |= mask
+        counts = {rule: int(np.count_nonzero(mask)) for rule, mask in outliers.items()}
+        current.add(items=len(fixes), **counts)
+    print("dropped outliers: " + ", ".join(f"{rule} {count}" for rule, count in counts.items()))
+
+    return fixes.filter(~dropped), counts
+
+
+def load_bus_fixes(filepath, time_window=None):
+    """
+    Reads bus data from a JSON or NDJSON file (or a list of such files) into a BusFixes store.
+    A snapshot directory saved by BusFixes.save is memory-mapped instead.
+    With time_window (start and end datetimes, None for an open end) only fixes
+    within the window are kept; files are filtered while they are read.
+    """
+    with stage("load", filepath=filepath) as current:
+        if isinstance(filepath, str) and os.path.isdir(filepath):
+            arrays, _ = load_arrays(filepath)
+            fixes = BusFixes.from_arrays(arrays)
+        else:
+            fixes = BusFixes.from_records(iter_bus_records(filepath, time_window))
+        if time_window is not None:
+            start, end = (to_seconds(time) if time is not None else bound
+                          for time, bound in zip(time_window, (-np.inf, np.inf)))
+            fixes = fixes.filter((fixes.times >= start) & (fixes.times <= end))
+        current.add(items=len(fixes), bytes=fixes.nbytes)
+    return fixes
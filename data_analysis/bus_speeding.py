@@ -3,96 +3,336 @@ This script processes JSON data related to buses,
 calculates speeds, and generates a map highlighting speeding buses.
 """
 
-import json
-from datetime import datetime
+from math import radians, cos
 
+import numpy as np
 import folium
-from folium.plugins import HeatMap
+from folium.plugins import HeatMap, HeatMapWithTime
 
-from utils import calculate_speed, validate_datetime_format
+from utils import calculate_speeds, to_seconds, parse_datetimes, from_seconds, iter_bus_records,\
+                  save_arrays, load_arrays, find_outliers, METERS_PER_DEGREE, MAX_SPEED,\
+                  BUS_DATA_MEASUREMENT_TIME
+from bus_fixes import BusFixes, clean_fixes
+from instrumentation import stage, instrumented
 
 
 SPEED_LIMIT = 50.0
 
+# Side of speeding grid cells in meters
+CELL_SIZE = 100.0
 
-def parse_data(filepath):
+# Latitude at which grid cells are square, fixed so grids of different data can be merged
+GRID_LATITUDE = 52.23
+
+
+def parse_data(filepath, time_window=None):
     """
     Parse JSON data from a file, filter out invalid entries, and organize it by vehicle number.
+    Fixes repeating the previous time of the same vehicle (returned again by the API
+    on consecutive polls) are dropped.
 
     Parameters:
     - filepath (str): The path to the JSON file containing bus data.
+    - time_window (tuple[datetime, datetime]): If given, only fixes within the window
+      (None for an open end) are read.
 
     Returns:
     - dict: A dictionary mapping vehicle numbers to sorted lists of corresponding bus data.
     """
-    with open(filepath, "r", encoding="utf-8") as json_file:
-        data = json.load(json_file)
+    with stage("load", filepath=filepath) as current:
+        data = list(iter_bus_records(filepath, time_window))
+        current.add(items=len(data))
 
-    buses_list = [bus_data for bus_data in data
-                  if isinstance(bus_data, dict) and validate_datetime_format(bus_data['Time'])]
+    with stage("validate") as current:
+        buses_list = [bus_data for bus_data in data if isinstance(bus_data, dict)]
+        times, valid = parse_datetimes([bus_data.get('Time') for bus_data in buses_list])
+        buses_list = [bus_data for bus_data, is_valid in zip(buses_list, valid.tolist())
+                      if is_valid]
+        times = times[valid].tolist()
+        current.add(items=len(data), skipped=len(data) - len(buses_list))
 
     print(f"skipped {len(data) - len(buses_list)} elements out of {len(data)}")
 
-    bus_to_data = {}
-    for bus_data in buses_list:
-        vehicle_number = bus_data.get('VehicleNumber')
-        bus_data['Time'] = datetime.strptime(bus_data['Time'], '%Y-%m-%d %H:%M:%S')
-        if vehicle_number in bus_to_data:
-            bus_to_data[vehicle_number].append(bus_data)
-        else:
-            bus_to_data[vehicle_number] = [bus_data]
+    with stage("group") as current:
+        bus_to_data = {}
+        duplicates = 0
+        for bus_data, time in zip(buses_list, times):
+            vehicle_number = bus_data.get('VehicleNumber')
+            bus_data['Time'] = from_seconds(time)
+            if vehicle_number in bus_to_data:
+                if bus_to_data[vehicle_number][-1]['Time'] == bus_data['Time']:
+                    duplicates += 1
+                    continue
+                bus_to_data[vehicle_number].append(bus_data)
+            else:
+                bus_to_data[vehicle_number] = [bus_data]
+        current.add(items=len(buses_list), duplicates=duplicates, vehicles=len(bus_to_data))
 
-    for bus in bus_to_data:
-        bus_to_data[bus] = sorted(bus_to_data[bus], key=lambda x: x['Time'])
+    print(f"dropped {duplicates} duplicate elements "
+          f"({duplicates / max(len(buses_list), 1):.1%})")
+
+    with stage("sort") as current:
+        for bus in bus_to_data:
+            bus_to_data[bus] = sorted(bus_to_data[bus], key=lambda x: x['Time'])
+        current.add(items=len(buses_list) - duplicates)
 
     return bus_to_data
 
 
-def get_speeding_buses(bus_to_data):
+def _segment_speeds(lats, lons, times, starts):
+    """
+    Computes speeds between consecutive points of flattened vehicle trajectories.
+    Pair i connects points i and i + 1, so pairs ending at a vehicle start are set to NaN.
+    Pairs faster than MAX_SPEED are GPS jumps after which the vehicle stays at the new
+    location (find_outliers drops only spikes) and are set to NaN too.
+    """
+    speeds = calculate_speeds(lats, lons, times)
+    speeds[starts[starts > 0] - 1] = np.nan
+    with np.errstate(invalid="ignore"):
+        speeds[speeds > MAX_SPEED] = np.nan
+    return speeds
+
+
+def _get_speeding_fixes(fixes):
+    """
+    Identify speeding in a BusFixes store.
+    Returns the indices of speeding fixes, their speeds and vehicle codes of the speeding buses.
+    """
+    starts = fixes.offsets[:-1][np.diff(fixes.offsets) > 0]
+    speeds = _segment_speeds(fixes.lats, fixes.lons, fixes.times, starts)
+
+    with np.errstate(invalid="ignore"):
+        speeding = np.flatnonzero(speeds > SPEED_LIMIT)
+
+    return speeding, speeds[speeding], np.unique(fixes.vehicle_codes[speeding])
+
+
+@instrumented("speeds")
+def get_speeding_buses(bus_to_data, time_window=None):
     """
     Identify buses that have exceeded the defined speed limit.
 
+    GPS outliers (fixes outside the service area, stale fixes and jumps) are dropped first,
+    see utils.find_outliers. Speeds of all consecutive pairs of points are then computed
+    at once over the flattened data of all vehicles; pairs spanning two vehicles
+    and pairs faster than utils.MAX_SPEED are discarded.
+
     Parameters:
-    - bus_to_data (dict): A dictionary mapping vehicle numbers to lists of corresponding bus data.
+    - bus_to_data (dict or BusFixes): A dictionary mapping vehicle numbers to lists
+    of corresponding bus data, or a BusFixes store.
+    - time_window (tuple[datetime, datetime]): Time span of the capture used to drop
+    stale fixes, or None to keep them.
 
     Returns:
     - list: A list of bus data points representing instances where the speed limit was exceeded.
     """
-    count_buses_speeding = 0
-    buses_speeding = []
-
-    for bus in bus_to_data:
-        bus_data = bus_to_data[bus]
-
-        bus_data[0]['Speed'] = 0.0
-        speed_limit_exceeded = False
-        for i, (pt1, pt2) in enumerate(zip(bus_data[:-1], bus_data[1:])):
-            speed = calculate_speed(pt1, pt2)
-            bus_data[i + 1]['Speed'] = speed
-            if speed is not None and speed > SPEED_LIMIT:
-                speed_limit_exceeded = True
-                buses_speeding.append(pt1)
-        if speed_limit_exceeded:
-            count_buses_speeding += 1
+    if time_window is not None:
+        time_window = tuple(None if time is None else to_seconds(time) for time in time_window)
+
+    if isinstance(bus_to_data, BusFixes):
+        fixes, _ = clean_fixes(bus_to_data, time_window)
+        speeding, speeds, speeding_vehicles = _get_speeding_fixes(fixes)
+        print(f"found {len(speeding_vehicles)} buses that exceeded \
+          speed limit out of {fixes.vehicle_count} buses")
+        points = fixes.records(speeding)
+        for point, speed in zip(points, speeds.tolist()):
+            point['Speed'] = speed
+        return points
+
+    points = [bus_data for bus in bus_to_data for bus_data in bus_to_data[bus]]
+    sizes = np.fromiter((len(bus_to_data[bus]) for bus in bus_to_data), dtype=np.int64,
+                        count=len(bus_to_data))
+    starts = (np.cumsum(sizes) - sizes)[sizes > 0]
+
+    lats = np.fromiter((float(bus_data['Lat']) for bus_data in points), dtype=np.float64,
+                       count=len(points))
+    lons = np.fromiter((float(bus_data['Lon']) for bus_data in points), dtype=np.float64,
+                       count=len(points))
+    times = np.fromiter((to_seconds(bus_data['Time']) for bus_data in points), dtype=np.float64,
+                        count=len(points))
+
+    outliers = find_outliers(lats, lons, times, starts, time_window=time_window)
+    keep = ~(outliers["bounds"] | outliers["stale"] | outliers["jump"])
+    print("dropped outliers: " + ", ".join(f"{rule} {np.count_nonzero(mask)}"
+                                           for rule, mask in outliers.items()))
+    vehicles = np.repeat(np.arange(len(sizes)), sizes)[keep]
+    points = [bus_data for bus_data, kept in zip(points, keep.tolist()) if kept]
+    lats, lons, times = lats[keep], lons[keep], times[keep]
+    sizes = np.bincount(vehicles, minlength=len(sizes))
+    starts = (np.cumsum(sizes) - sizes)[sizes > 0]
+
+    speeds = _segment_speeds(lats, lons, times, starts)
+
+    point_speeds = np.concatenate(([0.0], speeds)) if len(points) else speeds
+    point_speeds[starts] = 0.0
+    for bus_data, speed in zip(points, point_speeds.tolist()):
+        bus_data['Speed'] = None if np.isnan(speed) else speed
+
+    with np.errstate(invalid="ignore"):
+        speeding = np.flatnonzero(speeds > SPEED_LIMIT)
+    buses_speeding = [points[i] for i in speeding.tolist()]
+    # A speeding point starts the segment over the limit, as in the BusFixes path
+    for bus_data, speed in zip(buses_speeding, speeds[speeding].tolist()):
+        bus_data['Speed'] = speed
+
+    count_buses_speeding = len(np.unique(vehicles[speeding]))
     print(f"found {count_buses_speeding} buses that exceeded \
           speed limit out of {len(bus_to_data)} buses")
 
     return buses_speeding
 
 
-def generate_map(points):
+def calculate_speeding(filepath, download_time):
+    """
+    Identify buses that have exceeded the speed limit in a capture of bus locations
+    started at download_time, dropping fixes stale for the capture window
+    of BUS_DATA_MEASUREMENT_TIME, see get_speeding_buses.
+
+    Parameters:
+    - filepath (str): The path to the JSON or NDJSON file containing bus data.
+    - download_time (datetime): Start of the capture.
+
+    Returns:
+    - list: A list of bus data points representing instances where the speed limit was exceeded.
+    """
+    time_window = (download_time, download_time + BUS_DATA_MEASUREMENT_TIME)
+    return get_speeding_buses(parse_data(filepath), time_window)
+
+
+class SpeedingGrid:
+    """
+    Speeding events binned into a regular grid of square cells, optionally per time slice.
+
+    The i-th occupied bin is the cell (rows[i], cols[i]) of the slice starting at
+    slices[i] seconds since 1970-01-01 (0 without time slicing), with counts[i] events
+    and severities[i], the sum of their speeds over SPEED_LIMIT in km/h.
+    Its size is bounded by the area and duration covered, not by the number of events.
+    """
+
+    def __init__(self, slices, rows, cols, counts, severities, cell_size=CELL_SIZE,
+                 time_slice=0):
+        self.slices = slices
+        self.rows = rows
+        self.cols = cols
+        self.counts = counts
+        self.severities = severities
+        self.cell_size = cell_size
+        self.time_slice = time_slice
+        self.cell_lat = cell_size / METERS_PER_DEGREE
+        self.cell_lon = self.cell_lat / cos(radians(GRID_LATITUDE))
+
+    @classmethod
+    def from_points(cls, points, cell_size=CELL_SIZE, time_slice=None):
+        """
+        Bins speeding points returned by get_speeding_buses.
+
+        Parameters:
+        - points (list): Bus data points with 'Lat', 'Lon', 'Time' and optionally 'Speed'.
+        - cell_size (float): Side of grid cells in meters.
+        - time_slice (timedelta): Length of time slices, or None to bin all points together.
+
+        Returns:
+        - SpeedingGrid: The binned events.
+        """
+        slice_seconds = int(time_slice.total_seconds()) if time_slice else 0
+        lats = np.array([float(point['Lat']) for point in points], dtype=np.float64)
+        lons = np.array([float(point['Lon']) for point in points], dtype=np.float64)
+        speeds = np.array([point.get('Speed') or SPEED_LIMIT for point in points],
+                          dtype=np.float64)
+        times = np.array([to_seconds(point['Time']) for point in points], dtype=np.int64)
+
+        grid = cls(None, None, None, None, None, cell_size, slice_seconds)
+        bins = np.stack((times // slice_seconds * slice_seconds if slice_seconds
+                         else np.zeros(len(points), dtype=np.int64),
+                         np.floor(lats / grid.cell_lat).astype(np.int64),
+                         np.floor(lons / grid.cell_lon).astype(np.int64)))
+
+        keys, inverse = np.unique(bins, axis=1, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        grid.slices, grid.rows, grid.cols = keys
+        grid.counts = np.bincount(inverse, minlength=keys.shape[1]).astype(np.int64)
+        grid.severities = np.bincount(inverse, weights=np.maximum(speeds - SPEED_LIMIT, 0.0),
+                                      minlength=keys.shape[1])
+        return grid
+
+    def __len__(self):
+        return len(self.counts)
+
+    def centers(self):
+        """
+        Returns latitudes and longitudes of centers of the occupied cells.
+        """
+        return (self.rows + 0.5) * self.cell_lat, (self.cols + 0.5) * self.cell_lon
+
+    def weights(self, weight="count"):
+        """
+        Returns weights of the bins, either "count" of events or their "severity".
+        """
+        if weight == "count":
+            return self.counts.astype(np.float64)
+        if weight == "severity":
+            return np.asarray(self.severities, dtype=np.float64)
+        raise ValueError(f"unknown weight: {weight}")
+
+    def save(self, dirpath):
+        """
+        Saves the grid as a snapshot directory for reuse.
+        """
+        save_arrays(dirpath, {"slices": self.slices, "rows": self.rows, "cols": self.cols,
+                              "counts": self.counts, "severities": self.severities},
+                    {"format": "speeding-grid", "cell_size": self.cell_size,
+                     "time_slice": self.time_slice, "grid_latitude": GRID_LATITUDE})
+
+    @classmethod
+    def load(cls, dirpath):
+        """
+        Loads a grid saved by save.
+        """
+        arrays, meta = load_arrays(dirpath, mmap_mode=None)
+        return cls(arrays["slices"], arrays["rows"], arrays["cols"], arrays["counts"],
+                   arrays["severities"], meta["cell_size"], meta["time_slice"])
+
+
+def generate_map(points, weight="count"):
     """
     Generate a Folium map with a heatmap overlay based on provided latitude and longitude points.
 
+    Points are binned into a SpeedingGrid first, so the map holds one entry per occupied
+    grid cell. A grid with several time slices is rendered as a heatmap with a time slider.
+
     Parameters:
-    - points (list): A list of dictionaries representing latitude and longitude points.
+    - points (list or SpeedingGrid): A list of dictionaries representing latitude and longitude
+    points, or already binned speeding events.
+    - weight (str): Weight of grid cells, "count" of events or their "severity".
 
     Returns:
     - folium.Map: A Folium map object.
     """
+    with stage("group") as current:
+        grid = points if isinstance(points, SpeedingGrid) else SpeedingGrid.from_points(points)
+        current.add(items=len(points), bins=len(grid))
+
+    with stage("render", bins=len(grid)):
+        return _render_heatmap(grid, weight)
+
+
+def _render_heatmap(grid, weight):
+    """
+    Builds the heatmap layer of a SpeedingGrid.
+    """
     warsaw_map = folium.Map(location=[52.2298, 21.0118], zoom_start=12)
 
-    heat_data = [[point["Lat"], point["Lon"]] for point in points]
-    HeatMap(heat_data).add_to(warsaw_map)
+    lats, lons = grid.centers()
+    weights = grid.weights(weight)
+    weights = weights / max(weights.max(initial=0.0), 1e-9)
+
+    slices = np.unique(grid.slices)
+    if len(slices) > 1:
+        heat_data = [np.column_stack((lats, lons, weights))[grid.slices == start].tolist()
+                     for start in slices.tolist()]
+        HeatMapWithTime(heat_data, index=[str(from_seconds(start)) for start in slices.tolist()]
+                        ).add_to(warsaw_map)
+    else:
+        HeatMap(np.column_stack((lats, lons, weights)).tolist()).add_to(warsaw_map)
 
     return warsaw_map
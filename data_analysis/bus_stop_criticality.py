@@ -5,55 +5,131 @@ This module provides scripts for analysis of bus stop criticality.
 import os
 import json
 
+import numpy as np
 import folium
 
+from snapshot import ScheduleTable, has_snapshot, snapshot_path, source_signature
+from utils import save_arrays, load_arrays
+from instrumentation import instrumented
 
-def calculate_bus_stop_criticality(data_dir):
+CRITICALITY_VERSION = 1
+
+
+def aggregate_scheduled_stops(schedules):
     """
-    Calculates bus stops criticallity 
-    and returns dictionary with the results.
+    Counts scheduled stops of all bus lines at each bus stop.
+
+    Parameters:
+    - schedules (ScheduleTable): Bus schedules.
+
+    Returns:
+    - tuple: Bus stops as an array of "busstopId,busstopNr" strings, total counts per bus stop
+      and counts per bus stop and hour of the day (0-23, times past midnight are folded).
+      Unparseable times are only included in total counts.
     """
-    filepath = os.path.join(data_dir, "bus-schedules.json")
+    if len(schedules) == 0:
+        return np.array([], dtype=str), np.zeros(0, dtype=np.int64), \
+            np.zeros((0, 24), dtype=np.int64)
 
-    with open(filepath, "r", encoding="utf-8") as json_file:
-        bus_schedules = json.load(json_file)
+    counts = np.diff(schedules.offsets)
+    stops, key_stops = np.unique(np.char.rpartition(schedules.keys_array, ",")[:, 0],
+                                 return_inverse=True)
+    totals = np.bincount(key_stops, weights=counts, minlength=len(stops)).astype(np.int64)
+
+    times = np.asarray(schedules.times)
+    entry_stops = np.repeat(key_stops, counts)
+    valid = times >= 0
+    hourly = np.bincount(entry_stops[valid] * 24 + times[valid] // 3600 % 24,
+                         minlength=len(stops) * 24).reshape(len(stops), 24)
 
-    count_scheduled_stops = {}
+    return stops, totals, hourly
 
-    for sid in bus_schedules:
-        bus_stop_id, bus_stop_nr, _ = sid.split(',')
-        stops = bus_schedules[sid]
-        if (bus_stop_id, bus_stop_nr) not in count_scheduled_stops:
-            count_scheduled_stops[(bus_stop_id, bus_stop_nr)] = 0
-        count_scheduled_stops[(bus_stop_id, bus_stop_nr)] += len(stops)
 
-    return count_scheduled_stops
+def _load_schedules(filepath):
+    if has_snapshot(filepath):
+        return ScheduleTable.load(snapshot_path(filepath))
 
+    with open(filepath, "r", encoding="utf-8") as json_file:
+        return ScheduleTable.from_schedules(json.load(json_file))
+
+
+@instrumented("aggregate")
+def calculate_bus_stop_criticality(data_dir, by_hour=False):
+    """
+    Calculates bus stops criticallity
+    and returns dictionary with the results.
 
+    Results are cached in data_dir/bus-stop-criticality.snapshot and recalculated
+    when bus-schedules.json or its snapshot changes.
+    With by_hour the dictionary maps bus stops to lists of counts per hour of the day.
+    """
+    filepath = os.path.join(data_dir, "bus-schedules.json")
+    cache_dir = os.path.join(data_dir, "bus-stop-criticality.snapshot")
+    source = [source_signature(filepath),
+              source_signature(os.path.join(snapshot_path(filepath), "meta.json"))]
+
+    try:
+        arrays, meta = load_arrays(cache_dir, mmap_mode=None)
+        if meta.get("version") != CRITICALITY_VERSION or meta.get("source") != source:
+            raise ValueError("outdated bus stop criticality")
+        stops, totals, hourly = arrays["stops"], arrays["totals"], arrays["hourly"]
+    except (OSError, ValueError, KeyError):
+        stops, totals, hourly = aggregate_scheduled_stops(_load_schedules(filepath))
+        try:
+            save_arrays(cache_dir, {"stops": stops, "totals": totals, "hourly": hourly},
+                        {"format": "bus-stop-criticality", "version": CRITICALITY_VERSION,
+                         "source": source})
+        except OSError as err:
+            print(f"could not cache bus stop criticality: {err}")
+
+    bus_stops = [tuple(stop.split(",")) for stop in stops.tolist()]
+    values = hourly.tolist() if by_hour else totals.tolist()
+
+    return dict(zip(bus_stops, values))
+
+
+@instrumented("render")
 def generate_criticality_map(data_frame):
     """
     Generate a Folium map with latitude and longitude points, where the color temperature
-    is proportional to .
+    is proportional to the number of scheduled stops.
+
+    All bus stops are drawn as a single GeoJSON layer of circle markers,
+    which keeps the page small and responsive for the whole city.
 
     Parameters:
     - df (pandas.DataFrame): DataFrame with Latitude and Longitude points of bus stops
-    with values proportional to criticality of the bus stop. 
+    with values proportional to criticality of the bus stop.
 
     Returns:
     - folium.Map: A Folium map object.
     """
     warsaw_map = folium.Map(location=[52.2298, 21.0118], zoom_start=12)
+    if data_frame.empty:
+        return warsaw_map
 
+    counts = data_frame["Number of scheduled stops"]
     colormap = folium.LinearColormap(colors=["blue", "green", "yellow", "red"],
-                                     vmin=data_frame["Number of scheduled stops"].min(),
-                                     vmax=data_frame["Number of scheduled stops"].max())
-
-    for _, row in data_frame.iterrows():
-        folium.Marker(
-            location=[row['Latitude'], row["Longitude"]],
-            popup=f"Number of scheduled stops: {row['Number of scheduled stops']}",
-            icon=folium.Icon(color=colormap(row["Number of scheduled stops"]), icon='info-sign')
-        ).add_to(warsaw_map)
-
+                                     vmin=counts.min(), vmax=counts.max())
+
+    names = data_frame["Bus stop"].tolist() if "Bus stop" in data_frame else \
+        [""] * len(data_frame)
+    features = [{
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+        "properties": {"stop": ",".join(name) if isinstance(name, tuple) else str(name),
+                       "count": int(count), "color": colormap(count)},
+    } for name, count, lat, lon in zip(names, counts.tolist(), data_frame["Latitude"].tolist(),
+                                       data_frame["Longitude"].tolist())]
+
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        marker=folium.CircleMarker(radius=6, fill=True, fill_opacity=0.8, weight=1),
+        style_function=lambda feature: {"color": feature["properties"]["color"],
+                                        "fillColor": feature["properties"]["color"]},
+        tooltip=folium.GeoJsonTooltip(fields=["stop", "count"],
+                                      aliases=["Bus stop", "Number of scheduled stops"]),
+    ).add_to(warsaw_map)
+    colormap.add_to(warsaw_map)
 
     return warsaw_map
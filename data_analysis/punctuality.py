@@ -4,39 +4,63 @@ This module provides scripts for analysis of punctuality.
 
 import os
 import json
-from datetime import datetime, timedelta
+import zlib
+import tempfile
+import multiprocessing
+from bisect import bisect_left
+from datetime import timedelta
+from itertools import compress
+import numpy as np
 from tqdm import tqdm
 
-from utils import get_time, get_coords, validate_datetime_format,\
-                  validate_time_format, is_at_stop, BUS_DATA_MEASUREMENT_TIME
+from bus_fixes import BusFixes, load_bus_fixes, clean_fixes
+from snapshot import ScheduleTable, has_snapshot, snapshot_path, load_bus_stops_locations
+from timetable import CompiledTimetable, load_timetable
+from instrumentation import instrumented
+from utils import get_time, get_coords, iter_bus_records, parse_datetimes,\
+                  to_seconds, from_seconds, find_passages, find_outliers, StopGrid, DelayStats,\
+                  BUS_DATA_MEASUREMENT_TIME, MAX_FIX_GAP
 
 
-def get_buses_data(filepath):
+def get_buses_data(filepath, download_time=None):
     """
-    Reads buses data from filepath.
+    Reads buses data from filepath (JSON or NDJSON).
+    A snapshot directory is memory-mapped into BusFixes instead.
+    With download_time, fixes older than it are skipped while reading.
     """
-    with open(filepath, "r", encoding="utf-8") as json_file:
-        buses_data = json.load(json_file)
+    time_window = None if download_time is None else (download_time, None)
+    if os.path.isdir(filepath):
+        return load_bus_fixes(filepath, time_window)
 
-    return buses_data
+    return list(iter_bus_records(filepath, time_window))
 
+@instrumented("load")
 def get_schedules(data_dir):
     """
-    Reads schedules data from data_dir/bus_schedules.json.
+    Reads schedules data from data_dir/bus_schedules.json,
+    or memory-maps its snapshot if it is up to date.
     """
     filepath_schedules = os.path.join(data_dir, "bus-schedules.json")
 
+    if has_snapshot(filepath_schedules):
+        return ScheduleTable.load(snapshot_path(filepath_schedules))
+
     with open(filepath_schedules, "r", encoding="utf-8") as json_file:
         schedules_data = json.load(json_file)
 
     return schedules_data
 
+@instrumented("load")
 def get_bus_stops_locations(data_dir):
     """
-    Reads bus stops locations from data_dir/bus-stops.json.    
+    Reads bus stops locations from data_dir/bus-stops.json,
+    or from its snapshot if it is up to date.
     """
     filepath_bus_stops = os.path.join(data_dir, "bus-stops.json")
 
+    if has_snapshot(filepath_bus_stops):
+        return load_bus_stops_locations(snapshot_path(filepath_bus_stops))
+
     with open(filepath_bus_stops, "r", encoding="utf-8") as json_file:
         bus_stops_data = json.load(json_file)
 
@@ -46,10 +70,43 @@ def get_bus_stops_locations(data_dir):
 
     return bus_stops_to_locations
 
-def get_bus_locations(buses_data, download_time):
+def get_fixes_locations(fixes, download_time):
+    """
+    Gets bus lines locations based on live bus data stored in BusFixes.
+    """
+    fixes = fixes.filter(fixes.times >= to_seconds(download_time))
+    order = np.lexsort((fixes.times, fixes.line_codes))
+    counts = np.bincount(fixes.line_codes, minlength=len(fixes.lines))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    times = fixes.datetimes(order)
+    coords = list(zip(fixes.lats[order].tolist(), fixes.lons[order].tolist()))
+
+    return {bus_line: list(zip(times[offsets[i]:offsets[i + 1]],
+                               coords[offsets[i]:offsets[i + 1]]))
+            for i, bus_line in enumerate(fixes.lines.tolist())}
+
+def measurement_window(download_time):
+    """
+    Returns the start and end in seconds of the measurement window starting at download_time,
+    used to drop stale fixes, see utils.find_outliers.
+    """
+    return to_seconds(download_time), to_seconds(download_time + BUS_DATA_MEASUREMENT_TIME)
+
+@instrumented("group")
+def get_bus_locations(buses_data, download_time, clean=True):
     """
     Gets bus lines locations based on live bus data.
+    With clean, GPS outliers, including fixes stale for the measurement window,
+    are dropped first, see utils.find_outliers.
     """
+    if isinstance(buses_data, BusFixes):
+        if clean:
+            buses_data, _ = clean_fixes(
+                buses_data.filter(buses_data.times >= to_seconds(download_time)),
+                measurement_window(download_time))
+        return get_fixes_locations(buses_data, download_time)
+
     buses = [bus["VehicleNumber"] for bus in buses_data
              if isinstance(bus, dict) and "VehicleNumber" in bus]
     bus_lines = [bus["Lines"] for bus in buses_data if isinstance(bus, dict) and "Lines" in bus]
@@ -60,13 +117,28 @@ def get_bus_locations(buses_data, download_time):
 
     bus_locations = {bus_line: [] for bus_line in bus_lines}
 
-    for data_point in buses_data:
-        if not isinstance(data_point, dict) or not validate_datetime_format(get_time(data_point)):
-            continue
-        time = datetime.strptime(data_point['Time'], '%Y-%m-%d %H:%M:%S')
-        if time < download_time:
-            continue
-        bus_locations[data_point["Lines"]].append((time, (get_coords(data_point))))
+    data_points = [data_point for data_point in buses_data if isinstance(data_point, dict)]
+    times, valid = parse_datetimes([get_time(data_point) for data_point in data_points])
+    valid &= times >= to_seconds(download_time)
+
+    if clean:
+        # Outliers are found along trajectories of vehicles sorted by time
+        vehicles = np.array([str(data_point.get("VehicleNumber", ""))
+                             for data_point in data_points], dtype=str)
+        order = np.flatnonzero(valid)[np.lexsort((times[valid], vehicles[valid]))]
+        starts = np.flatnonzero(np.concatenate(([True], vehicles[order][1:] !=
+                                                vehicles[order][:-1])))[:len(order)]
+        coords = np.array([get_coords(data_points[i]) for i in order.tolist()],
+                          dtype=np.float64).reshape(-1, 2)
+        outliers = find_outliers(coords[:, 0], coords[:, 1], times[order], starts,
+                                 time_window=measurement_window(download_time))
+        for rule, mask in outliers.items():
+            valid[order[mask]] = False
+        print("dropped outliers: " + ", ".join(f"{rule} {np.count_nonzero(mask)}"
+                                               for rule, mask in outliers.items()))
+
+    for data_point, time in zip(compress(data_points, valid.tolist()), times[valid].tolist()):
+        bus_locations[data_point["Lines"]].append((from_seconds(time), (get_coords(data_point))))
 
     for bus_line in bus_locations:
         bus_locations[bus_line] = sorted(bus_locations[bus_line], key=lambda x: x[0])
@@ -74,51 +146,244 @@ def get_bus_locations(buses_data, download_time):
 
     return bus_locations
 
-def calculate_delays(data_dir, filepath, download_time):
+@instrumented("match")
+def get_stop_arrivals(bus_locations, stop_grid):
     """
-    Calculates delays for buses and returns those that exceeded 2 minutes.
+    Indexes live bus data by bus line and bus stop.
+
+    Returns a dictionary mapping (bus_line, (bus_stop_id, bus_stop_nr)) to the sorted list
+    of times at which a bus of that line was seen at that bus stop.
     """
-    buses_data = get_buses_data(filepath)
-    schedules_data = get_schedules(data_dir)
-    bus_stops_to_locations = get_bus_stops_locations(data_dir)
-    bus_locations = get_bus_locations(buses_data, download_time)
+    stop_arrivals = {}
+    for bus_line, locations in bus_locations.items():
+        for time, bus_loc in locations:
+            for bus_stop in stop_grid.query(bus_loc):
+                stop_arrivals.setdefault((bus_line, bus_stop), []).append(time)
+
+    return stop_arrivals
+
+@instrumented("match")
+def get_stop_passages(fixes, stop_grid):
+    """
+    Indexes passages of buses by bus stops found along trajectories of vehicles in BusFixes.
+    A trajectory is a run of fixes of one vehicle serving one bus line, without gaps
+    longer than MAX_FIX_GAP seconds, across which passages would be invented.
+
+    Returns a dictionary mapping (bus_line, (bus_stop_id, bus_stop_nr)) to the sorted list
+    of interpolated times of the nearest approach of a bus of that line to that bus stop.
+    """
+    breaks = np.ones(len(fixes), dtype=bool)
+    breaks[1:] = (fixes.vehicle_codes[1:] != fixes.vehicle_codes[:-1]) | \
+        (fixes.line_codes[1:] != fixes.line_codes[:-1]) | \
+        (np.diff(fixes.times) > MAX_FIX_GAP)
+
+    lines = fixes.lines.tolist()
+    line_codes = fixes.line_codes.tolist()
+
+    stop_passages = {}
+    for start, bus_stop, _, nearest, _, _ in find_passages(fixes.lats, fixes.lons, fixes.times,
+                                                           np.flatnonzero(breaks), stop_grid):
+        stop_passages.setdefault((lines[line_codes[start]], bus_stop), []).append(
+            from_seconds(nearest))
+
+    for times in stop_passages.values():
+        times.sort()
+
+    return stop_passages
+
+def find_delays(schedules_data, bus_stops_to_locations, bus_locations, download_time,
+                progress=True, stats=None):
+    """
+    Matches scheduled times with live bus data and returns delays that exceeded 2 minutes.
+    A bus arrives at the first of its locations closer than EPS to the bus stop.
+    Schedules may be given as a dictionary, a ScheduleTable or a CompiledTimetable.
+    Delays of all matched departures are added to stats (a DelayStats) if given.
+    """
+    stop_arrivals = get_stop_arrivals(bus_locations, StopGrid(bus_stops_to_locations))
+
+    return join_schedule(schedules_data, stop_arrivals, bus_locations, download_time, progress,
+                         stats)
+
+def find_passage_delays(schedules_data, bus_stops_to_locations, fixes, download_time,
+                        progress=True, stats=None):
+    """
+    Matches scheduled times with passages of buses by bus stops in BusFixes
+    and returns delays that exceeded 2 minutes.
+    A bus arrives at the moment of its nearest approach to the bus stop.
+    GPS outliers, including fixes stale for the measurement window, are dropped first.
+    Delays of all matched departures are added to stats (a DelayStats) if given.
+    """
+    fixes = fixes.filter(fixes.times >= to_seconds(download_time))
+    fixes, _ = clean_fixes(fixes, measurement_window(download_time))
+    stop_passages = get_stop_passages(fixes, StopGrid(bus_stops_to_locations))
+
+    return join_schedule(schedules_data, stop_passages, set(fixes.lines.tolist()), download_time,
+                         progress, stats)
+
+@instrumented("join")
+def join_schedule(schedules_data, stop_arrivals, bus_lines, download_time, progress=True,
+                  stats=None):
+    """
+    Matches scheduled times within the measurement window with the first arrival
+    not earlier than 2 minutes before each of them.
+
+    Parameters:
+    - schedules_data: Schedules as a dictionary, a ScheduleTable or a CompiledTimetable.
+    - stop_arrivals (dict): Sorted arrival times by (bus_line, (bus_stop_id, bus_stop_nr)).
+    - bus_lines: Bus lines present in live data.
+    - download_time (datetime): Start of the measurement window.
+    - stats (DelayStats): If given, delays of all matched departures are added to it,
+      including early and on-time ones.
+
+    Returns:
+    - list: Tuples (bus_line, bus_stop_id, scheduled time, delay) of delays of 2 minutes or more.
+    """
+    timetable = schedules_data if isinstance(schedules_data, CompiledTimetable) \
+        else CompiledTimetable.build(schedules_data)
+    spans = timetable.window(download_time, download_time + BUS_DATA_MEASUREMENT_TIME)
 
     delayed_buses = []
     bus_lines_not_found = []
     not_arrived = 0
+    departures = ([], [], [], [])
 
-    for sid in tqdm(schedules_data):
+    for i, sid in enumerate(tqdm(timetable.keys.tolist(), disable=not progress)):
         bus_stop_id, bus_stop_nr, bus_line = sid.split(',')
 
-        times = schedules_data[sid]
-        times = [datetime.strptime(time, '%H:%M:%S').time()
-                for time in times if validate_time_format(time)]
-        times = [download_time.replace(
-            hour=t.hour, minute=t.minute, second=t.second) for t in times]
-        times = [time for time in times if download_time <=
-                time <= download_time + BUS_DATA_MEASUREMENT_TIME]
-
-        bus_stop_loc = bus_stops_to_locations[(bus_stop_id, bus_stop_nr)]
-
-        try:
-            locations = bus_locations[bus_line]
-        except KeyError:
+        if bus_line not in bus_lines:
             bus_lines_not_found.append(bus_line)
             continue
 
-        for time in times:
-            arrival = next(((t, bus_loc) for (t, bus_loc) in locations if t >= time -
-                        timedelta(minutes=2) and is_at_stop(bus_loc, bus_stop_loc)), None)
+        arrivals = stop_arrivals.get((bus_line, (bus_stop_id, bus_stop_nr)), [])
+
+        for time in timetable.window_times(spans, i):
+            k = bisect_left(arrivals, time - timedelta(minutes=2))
 
-            if arrival is None:
+            if k == len(arrivals):
                 not_arrived += 1
                 continue
 
-            delay = arrival[0] - time
+            delay = arrivals[k] - time
             if delay >= timedelta(minutes=2):
                 delayed_buses.append((bus_line, bus_stop_id, time, delay))
+            if stats is not None:
+                for values, value in zip(departures, (bus_line, f"{bus_stop_id},{bus_stop_nr}",
+                                                      time.hour, delay.total_seconds())):
+                    values.append(value)
 
     print(f"bus lines not found in live data: {len(set(bus_lines_not_found))},\
            buses that did not arrive: {not_arrived}")
 
+    if stats is not None:
+        stats.add(*departures)
+
     return delayed_buses
+
+@instrumented("calculate_delays")
+def calculate_delays(data_dir, filepath, download_time, stats=None):
+    """
+    Calculates delays for buses and returns those that exceeded 2 minutes.
+    Fixes stale for the measurement window starting at download_time are dropped.
+    Statistics of delays of all matched departures are added to stats (a DelayStats) if given.
+    """
+    fixes = load_bus_fixes(filepath, (download_time, None))
+    schedules_data = load_timetable(data_dir)
+    bus_stops_to_locations = get_bus_stops_locations(data_dir)
+
+    return find_passage_delays(schedules_data, bus_stops_to_locations, fixes, download_time,
+                               stats=stats)
+
+_worker_data = {}
+
+def _init_worker(schedules_data, bus_stops_to_locations):
+    """
+    Stores tables shared by all tasks of a worker process. With the fork start method
+    they are inherited from the parent without copying.
+    """
+    _worker_data["schedules"] = schedules_data
+    _worker_data["bus_stops"] = bus_stops_to_locations
+
+def _line_shard(bus_line, line_shards):
+    return zlib.crc32(bus_line.encode()) % line_shards
+
+def _snapshot_capture_task(task):
+    """
+    Reads a capture once and saves its fixes as a snapshot shared by the tasks of its shards.
+    """
+    filepath, download_time, dirpath = task
+    load_bus_fixes(filepath, (download_time, None)).save(dirpath)
+    return dirpath
+
+def _calculate_delays_task(task):
+    """
+    Calculates delays of bus lines of one shard in one capture.
+    """
+    filepath, download_time, shard, line_shards, with_stats = task
+    schedules_data = _worker_data["schedules"]
+
+    # With shards the capture is a snapshot, so reading it only maps its arrays
+    fixes = load_bus_fixes(filepath, (download_time, None))
+    if line_shards > 1:
+        in_shard = np.array([_line_shard(bus_line, line_shards) == shard
+                             for bus_line in fixes.lines.tolist()], dtype=bool)
+        fixes = fixes.filter(in_shard[fixes.line_codes])
+        schedules_data = schedules_data.select(
+            [_line_shard(sid.rsplit(',', 1)[1], line_shards) == shard
+             for sid in schedules_data.keys.tolist()])
+
+    stats = DelayStats() if with_stats else None
+    delays = find_passage_delays(schedules_data, _worker_data["bus_stops"], fixes, download_time,
+                                 progress=False, stats=stats)
+    return delays, stats
+
+def _map_delays_tasks(pool, captures, line_shards, with_stats):
+    """
+    Runs the tasks of all shards of captures in the pool.
+    """
+    tasks = [(filepath, download_time, shard, line_shards, with_stats)
+             for filepath, download_time in captures for shard in range(line_shards)]
+    return list(tqdm(pool.imap(_calculate_delays_task, tasks), total=len(tasks)))
+
+@instrumented("calculate_delays_batch")
+def calculate_delays_batch(data_dir, captures, processes=None, line_shards=1, stats=None):
+    """
+    Calculates delays for many captures in a pool of processes
+    and returns the merged list of those that exceeded 2 minutes.
+
+    Parameters:
+    - data_dir (str): Directory with bus schedules and bus stops, loaded once for all workers.
+    - captures (list): Pairs of capture filepath and download time.
+    - processes (int): Number of worker processes, all CPU cores by default.
+    - line_shards (int): Number of groups of bus lines each capture is split into,
+      useful when there are fewer captures than cores. Captures are then read once
+      into temporary snapshots memory-mapped by the tasks of their shards.
+    - stats (DelayStats): If given, statistics computed by the workers are merged into it.
+
+    Returns:
+    - list: Delays in the order of captures, as returned by calculate_delays.
+    """
+    schedules_data = load_timetable(data_dir)
+    bus_stops_to_locations = get_bus_stops_locations(data_dir)
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    with context.Pool(processes, initializer=_init_worker,
+                      initargs=(schedules_data, bus_stops_to_locations)) as pool:
+        if line_shards > 1:
+            # Snapshots go to the system temporary directory, so a crash leaves nothing in data_dir
+            with tempfile.TemporaryDirectory(prefix="bus-fixes-") as tmp_dir:
+                snapshots = pool.map(_snapshot_capture_task,
+                                     [(filepath, download_time, os.path.join(tmp_dir, str(i)))
+                                      for i, (filepath, download_time) in enumerate(captures)])
+                results = _map_delays_tasks(
+                    pool, [(dirpath, download_time)
+                           for dirpath, (_, download_time) in zip(snapshots, captures)],
+                    line_shards, stats is not None)
+        else:
+            results = _map_delays_tasks(pool, captures, line_shards, stats is not None)
+
+    if stats is not None:
+        for _, task_stats in results:
+            stats.merge(task_stats)
+
+    return [delay for delays, _ in results for delay in delays]
@@ -0,0 +1,151 @@
+"""
+This module provides binary snapshots of bus data for memory-mapped loading.
+
+Snapshots are directories of .npy files next to the JSON files they were converted from,
+e.g. data/bus-schedules.snapshot for data/bus-schedules.json. Run
+
+    python3 snapshot.py ../data [../data/bus-locations-<timestamp>.json ...]
+
+to convert bus stops and bus schedules in the data directory and the given captures.
+"""
+
+import os
+import sys
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+from bus_fixes import load_bus_fixes
+from utils import parse_times, save_arrays, load_arrays
+
+SNAPSHOT_SUFFIX = ".snapshot"
+
+
+def snapshot_path(filepath):
+    """
+    Returns the path of the snapshot directory of a JSON file.
+    """
+    return os.path.splitext(filepath)[0] + SNAPSHOT_SUFFIX
+
+
+def has_snapshot(filepath):
+    """
+    Checks if the JSON file has a snapshot directory that is not older than the file.
+    """
+    meta_filepath = os.path.join(snapshot_path(filepath), "meta.json")
+    if not os.path.isfile(meta_filepath):
+        return False
+    return not os.path.isfile(filepath) or \
+        os.path.getmtime(meta_filepath) >= os.path.getmtime(filepath)
+
+
+def source_signature(filepath):
+    """
+    Returns the path, size and modification time of a file, used to invalidate data
+    derived from it, or None if the file does not exist.
+    """
+    if not os.path.isfile(filepath):
+        return None
+    stat = os.stat(filepath)
+    return {"path": os.path.abspath(filepath), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class ScheduleTable(Mapping):
+    """
+    Read-only mapping of "busstopId,busstopNr,line" keys to lists of scheduled times,
+    backed by arrays: keys, offsets into times and times in seconds since midnight.
+    Times of the i-th key are times[offsets[i]:offsets[i + 1]]; unparseable entries
+    are stored as -1 and returned as empty strings, so counts match the source data.
+    """
+
+    def __init__(self, keys, offsets, times):
+        self.keys_array = keys
+        self.offsets = offsets
+        self.times = times
+        self.index = {key: i for i, key in enumerate(keys.tolist())}
+
+    @classmethod
+    def from_schedules(cls, schedules_data):
+        """
+        Builds the table from a dictionary as saved in bus-schedules.json.
+        """
+        keys = np.array(list(schedules_data), dtype=str)
+        counts = np.fromiter((len(times) for times in schedules_data.values()), dtype=np.int64,
+                             count=len(schedules_data))
+        times, valid = parse_times([time for times in schedules_data.values() for time in times],
+                                   max_hour=47)
+        times = np.where(valid, times, -1).astype(np.int32)
+        return cls(keys, np.concatenate(([0], np.cumsum(counts))), times)
+
+    def save(self, dirpath):
+        """
+        Saves the table as a snapshot directory.
+        """
+        save_arrays(dirpath, {"keys": self.keys_array, "offsets": self.offsets,
+                              "times": self.times}, {"format": "bus-schedules"})
+
+    @classmethod
+    def load(cls, dirpath):
+        """
+        Memory-maps a table saved by save.
+        """
+        arrays, _ = load_arrays(dirpath)
+        return cls(arrays["keys"], arrays["offsets"], arrays["times"])
+
+    def __getitem__(self, key):
+        i = self.index[key]
+        return ["" if time < 0 else f"{time // 3600:02d}:{time // 60 % 60:02d}:{time % 60:02d}"
+                for time in self.times[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def save_bus_stops(bus_stops_data, dirpath):
+    """
+    Saves bus stops ids, numbers and locations from bus-stops.json data as a snapshot directory.
+    """
+    stops = [[value["value"] for value in bus_stop["values"][:6]]
+             for bus_stop in bus_stops_data["result"]]
+    save_arrays(dirpath, {
+        "ids": np.array([stop[0] for stop in stops], dtype=str),
+        "nrs": np.array([stop[1] for stop in stops], dtype=str),
+        "lats": np.array([float(stop[4]) for stop in stops], dtype=np.float64),
+        "lons": np.array([float(stop[5]) for stop in stops], dtype=np.float64),
+    }, {"format": "bus-stops"})
+
+
+def load_bus_stops_locations(dirpath):
+    """
+    Reads bus stops locations from a snapshot directory saved by save_bus_stops.
+    """
+    arrays, _ = load_arrays(dirpath)
+    return dict(zip(zip(arrays["ids"].tolist(), arrays["nrs"].tolist()),
+                    zip(arrays["lats"].tolist(), arrays["lons"].tolist())))
+
+
+def convert(data_dir, capture_filepaths=()):
+    """
+    Converts bus-stops.json and bus-schedules.json in data_dir and given captures of bus
+    locations to snapshot directories.
+    """
+    filepath = os.path.join(data_dir, "bus-stops.json")
+    if os.path.isfile(filepath):
+        with open(filepath, "r", encoding="utf-8") as json_file:
+            save_bus_stops(json.load(json_file), snapshot_path(filepath))
+
+    filepath = os.path.join(data_dir, "bus-schedules.json")
+    if os.path.isfile(filepath):
+        with open(filepath, "r", encoding="utf-8") as json_file:
+            ScheduleTable.from_schedules(json.load(json_file)).save(snapshot_path(filepath))
+
+    for filepath in capture_filepaths:
+        load_bus_fixes(filepath).save(snapshot_path(filepath))
+
+
+if __name__ == "__main__":
+    convert(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,145 @@
+"""
+This module provides a compiled timetable of bus schedules for fast lookups of time windows.
+"""
+
+import os
+import json
+from datetime import timedelta
+
+import numpy as np
+
+from snapshot import ScheduleTable, has_snapshot, snapshot_path, source_signature
+from utils import parse_times, save_arrays, load_arrays
+from instrumentation import instrumented
+
+TIMETABLE_VERSION = 1
+
+# Schedules run up to 48 hours from the start of the service day (e.g. 24:10:00)
+SERVICE_DAY = 2 * 86400
+
+
+class CompiledTimetable:
+    """
+    Scheduled times per "busstopId,busstopNr,line" key as sorted seconds since the start
+    of the service day. Times past midnight, like 24:10:00, are kept as 87000 seconds.
+
+    Times of the i-th key are times[offsets[i]:offsets[i + 1]]. The ordinal array
+    (key index * SERVICE_DAY + time) is sorted over all entries, so a time window is
+    looked up for all keys at once with a single searchsorted.
+    """
+
+    def __init__(self, keys, offsets, times):
+        self.keys = keys
+        self.offsets = offsets
+        self.times = times
+        key_indices = np.repeat(np.arange(len(keys), dtype=np.int64), np.diff(offsets))
+        self.ordinal = key_indices * SERVICE_DAY + times
+
+    @classmethod
+    def build(cls, schedules_data):
+        """
+        Compiles schedules given as a dictionary as saved in bus-schedules.json or a ScheduleTable.
+        Unparseable times are dropped.
+        """
+        if isinstance(schedules_data, ScheduleTable):
+            keys, times = schedules_data.keys_array, np.asarray(schedules_data.times)
+            counts = np.diff(schedules_data.offsets)
+            valid = times >= 0
+        else:
+            keys = np.array(list(schedules_data), dtype=str)
+            counts = np.fromiter((len(times) for times in schedules_data.values()),
+                                 dtype=np.int64, count=len(schedules_data))
+            times, valid = parse_times([time for times in schedules_data.values()
+                                        for time in times], max_hour=47)
+
+        key_indices = np.repeat(np.arange(len(keys), dtype=np.int64), counts)[valid]
+        times = times[valid].astype(np.int64)
+        order = np.lexsort((times, key_indices))
+
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(key_indices,
+                                                             minlength=len(keys)))))
+        return cls(keys, offsets.astype(np.int64), times[order])
+
+    def select(self, mask):
+        """
+        Returns a timetable of the keys selected by a boolean mask.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        counts = np.diff(self.offsets)
+        entries = np.repeat(mask, counts)
+        offsets = np.concatenate(([0], np.cumsum(counts[mask])))
+        return CompiledTimetable(self.keys[mask], offsets.astype(np.int64), self.times[entries])
+
+    def save(self, dirpath, source=None):
+        """
+        Saves the timetable as a snapshot directory, recording the source signature.
+        """
+        save_arrays(dirpath, {"keys": self.keys, "offsets": self.offsets, "times": self.times},
+                    {"format": "compiled-timetable", "version": TIMETABLE_VERSION,
+                     "source": source})
+
+    def window(self, start, end):
+        """
+        Finds scheduled entries of all keys falling within [start, end].
+
+        Parameters:
+        - start, end (datetime): Bounds of the window.
+
+        Returns:
+        - list: Tuples (day_start, lo, hi) for every service day overlapping the window,
+          where times[lo[i]:hi[i]] are entries of the i-th key counted from day_start.
+        """
+        base = np.arange(len(self.keys), dtype=np.int64) * SERVICE_DAY
+        spans = []
+        # Service days run for up to 48 hours, so the one that started the day before
+        # the window can still run into it
+        day_start = start.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        while day_start <= end:
+            lo_s = max((start - day_start).total_seconds(), 0.0)
+            hi_s = (end - day_start).total_seconds()
+            if hi_s >= 0 and lo_s < SERVICE_DAY:
+                lo_s, hi_s = int(np.ceil(lo_s)), int(np.floor(min(hi_s, SERVICE_DAY - 1)))
+                spans.append((day_start,
+                              np.searchsorted(self.ordinal, base + lo_s, side="left"),
+                              np.searchsorted(self.ordinal, base + hi_s, side="right")))
+            day_start += timedelta(days=1)
+        return spans
+
+    def window_times(self, spans, i):
+        """
+        Returns sorted datetimes of entries of the i-th key in a window found by window.
+        """
+        return [day_start + timedelta(seconds=time)
+                for day_start, lo, hi in spans for time in self.times[lo[i]:hi[i]].tolist()]
+
+
+@instrumented("load")
+def load_timetable(data_dir):
+    """
+    Loads the compiled timetable of data_dir/bus-schedules.json from its cache in
+    data_dir/bus-schedules.compiled, compiling and caching it if the cache is missing
+    or the source file changed since it was built.
+    """
+    filepath = os.path.join(data_dir, "bus-schedules.json")
+    cache_dir = os.path.join(data_dir, "bus-schedules.compiled")
+    source = source_signature(filepath)
+
+    try:
+        arrays, meta = load_arrays(cache_dir)
+        if meta.get("version") == TIMETABLE_VERSION and meta.get("source") == source:
+            return CompiledTimetable(arrays["keys"], arrays["offsets"], arrays["times"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if has_snapshot(filepath):
+        timetable = CompiledTimetable.build(ScheduleTable.load(snapshot_path(filepath)))
+    else:
+        with open(filepath, "r", encoding="utf-8") as json_file:
+            timetable = CompiledTimetable.build(json.load(json_file))
+
+    try:
+        timetable.save(cache_dir, source)
+    except OSError as err:
+        print(f"could not cache compiled timetable: {err}")
+
+    return timetable
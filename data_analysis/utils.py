@@ -1,46 +1,244 @@
 """
 Module with analysis utils
 """
+import os
+import re
+import json
 from datetime import datetime, timedelta
-from math import radians, sin, cos, sqrt, atan2
+from math import radians, cos, floor, isnan, sqrt
+
+import numpy as np
 
 BUS_DATA_MEASUREMENT_TIME = timedelta(hours=1)
 
 EPS = 200.0
 
-def haversine_distance(coord1, coord2):
+# Radius of the Earth in meters
+EARTH_RADIUS = 6371000.0
+
+# Length of one degree of latitude in meters
+METERS_PER_DEGREE = EARTH_RADIUS * np.pi / 180.0
+
+EPOCH = datetime(1970, 1, 1)
+
+# Bounding box (min lat, max lat, min lon, max lon) of the area served by ZTM buses
+SERVICE_AREA = (51.9, 52.6, 20.6, 21.5)
+
+# Speed in km/h above which a jump between fixes is considered a GPS error
+MAX_SPEED = 120.0
+
+# Seconds a fix may lie outside the expected time window before it is considered stale
+MAX_FIX_AGE = 300
+
+# Seconds between consecutive fixes of a vehicle (a few poll intervals) above which
+# its route between them is unknown and the trajectory is split
+MAX_FIX_GAP = 300
+
+# Characters read at once when streaming JSON arrays
+READ_CHUNK_SIZE = 1 << 20
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+def iter_json_array(data_file, chunk_size=READ_CHUNK_SIZE):
     """
-    Calculate the haversine distance between two coordinates.
+    Lazily parses a JSON array from a text file, yielding its elements one by one,
+    so memory does not depend on the size of the file.
 
     Parameters:
-    - coord1 (tuple): A tuple containing latitude and longitude for the first point.
-    - coord2 (tuple): A tuple containing latitude and longitude for the second point.
+    - data_file (file): File opened in text mode.
+    - chunk_size (int): Number of characters read at once.
 
     Returns:
-    - float: The distance in meters.
+    - generator: Elements of the array. A file not holding an array is parsed whole
+      and iterated over, as json.load would be.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = _WHITESPACE.match
+    buffer, pos, eof = "", 0, False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = data_file.read(chunk_size)
+        eof = not chunk
+        buffer, pos = buffer[pos:] + chunk, 0
+
+    while True:
+        pos = whitespace(buffer, pos).end()
+        if pos < len(buffer) or eof:
+            break
+        fill()
+    if buffer[pos:pos + 1] != "[":
+        yield from json.loads(buffer[pos:] + data_file.read())
+        return
+    pos = whitespace(buffer, pos + 1).end()
+
+    empty, batch = True, True
+    while True:
+        if batch:
+            # Whole elements up to the last "}," of the buffer are decoded at once; the slice
+            # only parses as an array if the cut falls between elements of the outer array
+            batch = False
+            cut = buffer.rfind("},", pos)
+            if cut > pos:
+                try:
+                    values = json.loads("[" + buffer[pos:cut + 1] + "]")
+                except json.JSONDecodeError:
+                    values = None
+                if values is not None:
+                    yield from values
+                    empty = False
+                    pos = whitespace(buffer, cut + 2).end()
+
+        # A value is complete once the delimiter after it is read, e.g. 2 may continue as 2.5
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+            after = whitespace(buffer, end).end()
+            separator = buffer[after]
+        except (json.JSONDecodeError, IndexError):
+            if not eof:
+                fill()
+                pos, batch = whitespace(buffer, pos).end(), True
+                continue
+            if empty and buffer[pos:].strip() == "]":
+                return
+            decoder.raw_decode(buffer, pos)
+            raise json.JSONDecodeError("Expecting ',' delimiter", buffer, len(buffer)) from None
+
+        empty = False
+        if separator == ",":
+            yield value
+            pos = whitespace(buffer, after + 1).end()
+        elif separator == "]":
+            yield value
+            return
+        elif eof:
+            raise json.JSONDecodeError("Expecting ',' delimiter", buffer, after)
+        else:
+            fill()
+            batch = True
+
+def _in_time_window(records, time_window):
     """
+    Yields records with a time string within time_window (start and end datetimes,
+    None for an open end). Time strings have a fixed zero-padded format, so they are
+    compared as strings without parsing; bounds are truncated to whole seconds,
+    so exact filtering on parsed times still has to follow.
+    """
+    start, end = (None if time is None else time.strftime('%Y-%m-%d %H:%M:%S')
+                  for time in time_window)
+    for record in records:
+        time = record.get("Time") if isinstance(record, dict) else None
+        if isinstance(time, str) and (start is None or time >= start) \
+                and (end is None or time <= end):
+            yield record
+
+def iter_bus_records(filepaths, time_window=None):
+    """
+    Lazily reads bus data records from captured files in constant memory.
 
-    lat1, lon1 = coord1
-    lat2, lon2 = coord2
-    lat1, lon1, lat2, lon2 = map(float, [lat1, lon1, lat2, lon2])
-    # Radius of the Earth in kilometers
-    radius = 6371.0
+    Parameters:
+    - filepaths (str or list): Path or paths of bus-locations files, either JSON arrays
+      or newline-delimited JSON (.ndjson) written by streaming capture.
+    - time_window (tuple[datetime, datetime]): If given, only records with a time within
+      the window (None for an open end) are yielded; records without a valid time
+      are skipped too.
+
+    Returns:
+    - generator: Records in file order. A truncated last line of an NDJSON file
+      (e.g. after a crash during capture) is skipped.
+    """
+    records = _iter_bus_records([filepaths] if isinstance(filepaths, str) else filepaths)
+    if time_window is not None:
+        records = _in_time_window(records, time_window)
+    return records
+
+def _iter_bus_records(filepaths):
+    for filepath in filepaths:
+        with open(filepath, "r", encoding="utf-8") as data_file:
+            if not filepath.endswith(".ndjson"):
+                yield from iter_json_array(data_file)
+                continue
+            for line in data_file:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    if line.endswith("\n"):
+                        raise
+
+def save_arrays(dirpath, arrays, meta=None):
+    """
+    Save arrays as a snapshot directory of .npy files.
+
+    Parameters:
+    - dirpath (str): Path of the snapshot directory, created if needed.
+    - arrays (dict): A dictionary mapping names to numpy arrays.
+    - meta (dict): JSON-serializable metadata saved to meta.json.
+    """
+    os.makedirs(dirpath, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(dirpath, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(dirpath, "meta.json"), "w", encoding="utf-8") as json_file:
+        json.dump({"arrays": list(arrays), **(meta or {})}, json_file)
+
+def load_arrays(dirpath, mmap_mode="r"):
+    """
+    Load arrays of a snapshot directory written by save_arrays.
+
+    Parameters:
+    - dirpath (str): Path of the snapshot directory.
+    - mmap_mode (str or None): Memory-map mode passed to numpy.load, so data is read lazily
+      and pages are shared between processes; None reads arrays into memory.
+
+    Returns:
+    - tuple[dict, dict]: A dictionary mapping names to arrays and the metadata.
+    """
+    with open(os.path.join(dirpath, "meta.json"), "r", encoding="utf-8") as json_file:
+        meta = json.load(json_file)
+    arrays = {name: np.load(os.path.join(dirpath, f"{name}.npy"), mmap_mode=mmap_mode)
+              for name in meta["arrays"]}
+    return arrays, meta
+
+def haversine_distances(lat1, lon1, lat2, lon2):
+    """
+    Calculate haversine distances between arrays of coordinates.
+
+    Parameters:
+    - lat1, lon1 (array-like): Latitudes and longitudes of the first points.
+    - lat2, lon2 (array-like): Latitudes and longitudes of the second points.
 
+    Returns:
+    - numpy.ndarray: The distances in meters.
+    """
     # Convert latitude and longitude from degrees to radians
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64))
+                              for x in (lat1, lon1, lat2, lon2))
 
     # Calculate the differences between the coordinates
     dlat = lat2 - lat1
     dlon = lon2 - lon1
 
     # Haversine formula
-    a_var = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c_var = 2 * atan2(sqrt(a_var), sqrt(1 - a_var))
+    a_var = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c_var = 2 * np.arctan2(np.sqrt(a_var), np.sqrt(1 - a_var))
 
-    # Distance in kilometers
-    distance = radius * c_var
+    return EARTH_RADIUS * c_var
 
-    return distance * 1000.0
+def haversine_distance(coord1, coord2):
+    """
+    Calculate the haversine distance between two coordinates.
+
+    Parameters:
+    - coord1 (tuple): A tuple containing latitude and longitude for the first point.
+    - coord2 (tuple): A tuple containing latitude and longitude for the second point.
+
+    Returns:
+    - float: The distance in meters.
+    """
+    lat1, lon1 = coord1
+    lat2, lon2 = coord2
+    return float(haversine_distances(float(lat1), float(lon1), float(lat2), float(lon2)))
 
 def get_coords(bus):
     """
@@ -80,6 +278,28 @@ def calculate_distance(coord1, coord2):
     # return abs(geodesic(coord1, coord2).meters)
     return haversine_distance(coord1, coord2)
 
+def calculate_speeds(lats, lons, times):
+    """
+    Calculate speeds between consecutive points of a trajectory.
+
+    Parameters:
+    - lats, lons (array-like): Latitudes and longitudes of the points.
+    - times (array-like): Times of the points in seconds.
+
+    Returns:
+    - numpy.ndarray: Speeds in kilometers per hour between points i and i + 1,
+      NaN where the time difference is zero.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    times = np.asarray(times, dtype=np.float64)
+
+    distances_m = haversine_distances(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    times_s = np.diff(times)
+    speeds_mps = np.full(distances_m.shape, np.nan)
+    np.divide(distances_m, times_s, out=speeds_mps, where=times_s != 0.0)
+    return speeds_mps * 3.6
+
 def calculate_speed(bus_data1, bus_data2):
     """
     Calculate the speed between two sets of bus data.
@@ -91,13 +311,183 @@ def calculate_speed(bus_data1, bus_data2):
     Returns:
     - float or None: The speed in kilometers per hour, or None if time difference is zero.
     """
-    distance_m = calculate_distance(get_coords(bus_data1), get_coords(bus_data2))
+    (lat1, lon1), (lat2, lon2) = get_coords(bus_data1), get_coords(bus_data2)
     time_s = (get_time(bus_data2) - get_time(bus_data1)).total_seconds()
-    if time_s == 0.0:
-        return None
-    speed_mps = distance_m / time_s
-    speed_kmph = speed_mps * 3.6
-    return speed_kmph
+    speed_kmph = float(calculate_speeds([float(lat1), float(lat2)], [float(lon1), float(lon2)],
+                                        [0.0, time_s])[0])
+    return None if isnan(speed_kmph) else speed_kmph
+
+def to_seconds(time):
+    """
+    Convert a naive datetime to seconds since 1970-01-01 without applying a timezone.
+
+    Parameters:
+    - time (datetime): A datetime object.
+
+    Returns:
+    - float: The number of seconds.
+    """
+    return (time - EPOCH).total_seconds()
+
+def _char_codes(strings, width):
+    """
+    Returns Unicode code points of strings as an (n, width + 1) array.
+    Values that are not strings are treated as empty strings; longer strings are
+    recognized by a non-zero last column.
+    """
+    strings = [string if isinstance(string, str) else "" for string in strings]
+    array = np.array(strings, dtype=f"U{width + 1}") if strings else \
+        np.zeros(0, dtype=f"U{width + 1}")
+    return array.view(np.uint32).reshape(len(strings), width + 1)
+
+def _parse_fields(codes, digits, separators):
+    """
+    Reads decimal fields given as lists of digit positions from code points,
+    checking that separators are at their positions.
+    Returns the list of fields and a mask of rows with the expected layout.
+    """
+    width = codes.shape[1] - 1
+    valid = (codes[:, width] == 0) & (codes[:, width - 1] != 0)
+    for position, separator in separators.items():
+        valid &= codes[:, position] == ord(separator)
+
+    fields = []
+    for positions in digits:
+        field = np.zeros(len(codes), dtype=np.int64)
+        for position in positions:
+            digit = codes[:, position].astype(np.int64) - ord("0")
+            valid &= (digit >= 0) & (digit <= 9)
+            field = field * 10 + digit
+        fields.append(field)
+    return fields, valid
+
+def parse_datetimes(datetime_strs):
+    """
+    Parse strings in the format '%Y-%m-%d %H:%M:%S' at once.
+
+    Unlike strptime the parser accepts only zero-padded fields, as sent by the ZTM API.
+
+    Parameters:
+    - datetime_strs (list): Strings representing datetimes.
+
+    Returns:
+    - tuple[numpy.ndarray, numpy.ndarray]: Seconds since 1970-01-01 (without timezone)
+      and a mask of valid strings; seconds of invalid strings are undefined.
+    """
+    codes = _char_codes(datetime_strs, 19)
+    (year, month, day, hour, minute, second), valid = _parse_fields(
+        codes, [range(0, 4), range(5, 7), range(8, 10), range(11, 13), range(14, 16),
+                range(17, 19)],
+        {4: "-", 7: "-", 10: " ", 13: ":", 16: ":"})
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days_in_month = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & \
+        (day <= days_in_month[np.clip(month, 0, 12)] + (leap & (month == 2))) & \
+        (hour <= 23) & (minute <= 59) & (second <= 59)
+
+    # Days since 1970-01-01 of a proleptic Gregorian date
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+
+    return days * 86400 + hour * 3600 + minute * 60 + second, valid
+
+def parse_times(time_strs, max_hour=23):
+    """
+    Parse strings in the format '%H:%M:%S' at once.
+
+    Parameters:
+    - time_strs (list): Strings representing times.
+    - max_hour (int): Largest accepted hour, e.g. 47 for schedules running past midnight.
+
+    Returns:
+    - tuple[numpy.ndarray, numpy.ndarray]: Seconds since midnight and a mask of valid strings.
+    """
+    codes = _char_codes(time_strs, 8)
+    (hour, minute, second), valid = _parse_fields(
+        codes, [range(0, 2), range(3, 5), range(6, 8)], {2: ":", 5: ":"})
+    valid &= (hour <= max_hour) & (minute <= 59) & (second <= 59)
+    return hour * 3600 + minute * 60 + second, valid
+
+def find_outliers(lats, lons, times, starts, bounds=SERVICE_AREA, max_speed=MAX_SPEED,
+                  time_window=None, max_age=MAX_FIX_AGE):
+    """
+    Find fixes of trajectories that should be dropped before evaluating speeds.
+
+    Rules are applied in order and every fix is counted under the first rule that drops it:
+    - "bounds": the fix lies outside the bounding box,
+    - "stale": the fix is more than max_age seconds outside the time window,
+    - "jump": the fix is reached and left with a speed over max_speed, i.e. a GPS spike;
+      after spikes are dropped, also a first or last fix of a trajectory whose only
+      segment is over max_speed.
+    A jump after which the vehicle stays at the new location keeps its fixes, as it is not
+    known which side of it is wrong; segments over max_speed have to be discarded
+    when evaluating speeds.
+
+    Parameters:
+    - lats, lons (numpy.ndarray): Flattened trajectories sorted by time.
+    - times (numpy.ndarray): Times of the fixes in seconds.
+    - starts (numpy.ndarray): Indices of the first fixes of trajectories.
+    - bounds (tuple): Minimal and maximal latitude and longitude.
+    - max_speed (float): Maximal plausible speed in kilometers per hour.
+    - time_window (tuple): Start and end of the expected time window in seconds,
+      either of them may be None; None skips the "stale" rule.
+    - max_age (float): Tolerance of the time window in seconds.
+
+    Returns:
+    - dict: Boolean masks of the fixes dropped by each rule.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    times = np.asarray(times, dtype=np.int64)
+    min_lat, max_lat, min_lon, max_lon = bounds
+
+    outside = ~((lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon))
+
+    stale = np.zeros(len(times), dtype=bool)
+    if time_window is not None:
+        start, end = time_window
+        if start is not None:
+            stale |= times < start - max_age
+        if end is not None:
+            stale |= times > end + max_age
+    stale &= ~outside
+
+    trajectories = np.cumsum(np.isin(np.arange(len(times)), starts))
+    jump = np.zeros(len(times), dtype=bool)
+    # Spikes inside trajectories are dropped first, so their neighbours at the ends
+    # of trajectories are judged by their remaining segments
+    for at_ends in (False, True):
+        kept = np.flatnonzero(~(outside | stale | jump))
+        same = trajectories[kept][1:] == trajectories[kept][:-1]
+        with np.errstate(invalid="ignore"):
+            fast = calculate_speeds(lats[kept], lons[kept], times[kept]) > max_speed
+        fast_in = np.concatenate(([False], fast & same))
+        fast_out = np.concatenate((fast & same, [False]))
+        if at_ends:
+            has_previous = np.concatenate(([False], same))
+            has_next = np.concatenate((same, [False]))
+            jump[kept] = (fast_in & ~has_next) | (fast_out & ~has_previous)
+        else:
+            jump[kept] = fast_in & fast_out
+
+    return {"bounds": outside, "stale": stale, "jump": jump}
+
+def from_seconds(seconds):
+    """
+    Convert seconds since 1970-01-01 to a naive datetime, the inverse of to_seconds.
+
+    Parameters:
+    - seconds (int): The number of seconds.
+
+    Returns:
+    - datetime: A datetime object.
+    """
+    return EPOCH + timedelta(seconds=seconds)
 
 def validate_datetime_format(datetime_str):
     """
@@ -109,11 +499,7 @@ def validate_datetime_format(datetime_str):
     Returns:
     - bool: True if the format is valid, False otherwise.
     """
-    try:
-        datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
-        return True
-    except ValueError:
-        return False
+    return bool(parse_datetimes([datetime_str])[1][0])
 
 def validate_time_format(time_str):
     """
@@ -125,11 +511,7 @@ def validate_time_format(time_str):
     Returns:
     - bool: True if the format is valid, False otherwise.
     """
-    try:
-        datetime.strptime(time_str, '%H:%M:%S')
-        return True
-    except ValueError:
-        return False
+    return bool(parse_times([time_str])[1][0])
 
 def is_at_stop(bus_loc, bus_stop_loc):
     """
@@ -143,3 +525,336 @@ def is_at_stop(bus_loc, bus_stop_loc):
     - bool: True if the bus is close to the bus stop, False otherwise.
     """
     return calculate_distance(bus_loc, bus_stop_loc) < EPS
+
+
+class StopGrid:
+    """
+    Spatial index over bus stops locations.
+
+    Bus stops are bucketed into a regular latitude/longitude grid whose cells are at least
+    `radius` wide, so all stops closer than `radius` to a point lie in the 3x3 block of cells
+    around it. Candidates are then checked with the same distance function as is_at_stop,
+    so query results are exactly the stops for which is_at_stop would return True.
+    """
+
+    def __init__(self, bus_stops_to_locations, radius=EPS):
+        """
+        Parameters:
+        - bus_stops_to_locations (dict): A dictionary mapping bus stops to their coordinates.
+        - radius (float): Query radius in meters.
+        """
+        self.radius = radius
+        self.cells = {}
+
+        max_lat = max((abs(float(lat)) for lat, _ in bus_stops_to_locations.values()),
+                      default=0.0)
+        # Slightly oversized cells keep the 3x3 neighbourhood conservative
+        self.cell_lat = 1.01 * radius / METERS_PER_DEGREE
+        self.cell_lon = self.cell_lat / max(cos(radians(min(max_lat + self.cell_lat, 89.0))),
+                                            1e-6)
+
+        for bus_stop, bus_stop_loc in bus_stops_to_locations.items():
+            cell = self._cell(bus_stop_loc)
+            self.cells.setdefault(cell, []).append((bus_stop, bus_stop_loc))
+
+    def _cell(self, loc):
+        lat, lon = loc
+        return floor(float(lat) / self.cell_lat), floor(float(lon) / self.cell_lon)
+
+    def query(self, loc):
+        """
+        Find bus stops closer than radius to the given location.
+
+        Parameters:
+        - loc (tuple[float, float]): Geographical coordinates of the location.
+
+        Returns:
+        - list: Bus stops within radius of the location.
+        """
+        row, col = self._cell(loc)
+        found = []
+        for i in (row - 1, row, row + 1):
+            for j in (col - 1, col, col + 1):
+                for bus_stop, bus_stop_loc in self.cells.get((i, j), ()):
+                    if calculate_distance(loc, bus_stop_loc) < self.radius:
+                        found.append(bus_stop)
+        return found
+
+    def query_segment(self, loc1, loc2):
+        """
+        Find candidate bus stops that may be closer than radius to a segment.
+
+        Parameters:
+        - loc1, loc2 (tuple[float, float]): Geographical coordinates of the segment ends.
+
+        Returns:
+        - list: Pairs of bus stops and their coordinates from the cells around the segment.
+        """
+        row1, col1 = self._cell(loc1)
+        row2, col2 = self._cell(loc2)
+        found = []
+        for i in range(min(row1, row2) - 1, max(row1, row2) + 2):
+            for j in range(min(col1, col2) - 1, max(col1, col2) + 2):
+                found.extend(self.cells.get((i, j), ()))
+        return found
+
+
+def _segment_circle(loc1, loc2, stop_loc, radius):
+    """
+    Intersects a segment with a circle around a bus stop in a local flat projection.
+    Returns the distance and segment parameter of the nearest approach and parameters
+    of entering and leaving the circle, or None if the segment stays outside.
+    """
+    stop_lat, stop_lon = float(stop_loc[0]), float(stop_loc[1])
+    scale = METERS_PER_DEGREE * cos(radians(stop_lat))
+    x1, y1 = (loc1[1] - stop_lon) * scale, (loc1[0] - stop_lat) * METERS_PER_DEGREE
+    dx = (loc2[1] - loc1[1]) * scale
+    dy = (loc2[0] - loc1[0]) * METERS_PER_DEGREE
+
+    a = dx * dx + dy * dy
+    b = x1 * dx + y1 * dy
+    c = x1 * x1 + y1 * y1 - radius * radius
+    nearest = min(max(-b / a, 0.0), 1.0) if a > 0 else 0.0
+    distance = sqrt((x1 + nearest * dx) ** 2 + (y1 + nearest * dy) ** 2)
+    if distance >= radius:
+        return None
+    if a == 0:
+        return distance, nearest, float("-inf"), float("inf")
+
+    root = sqrt(b * b - a * c)
+    return distance, nearest, (-b - root) / a, (-b + root) / a
+
+
+def find_passages(lats, lons, times, starts, stop_grid):
+    """
+    Find passages of vehicles by bus stops in a single sweep over their trajectories.
+
+    Consecutive fixes are joined by straight segments, so a bus is also found passing a stop
+    between two fixes which are both farther than radius from it. Times of entering and
+    leaving the radius and of the nearest approach are interpolated along the segments.
+    Passages still in progress at the start or end of a trajectory get the time of its
+    first or last fix.
+
+    Parameters:
+    - lats, lons, times (numpy.ndarray): Flattened trajectories sorted by time,
+      times in seconds.
+    - starts (numpy.ndarray): Indices of the first fixes of trajectories.
+    - stop_grid (StopGrid): Spatial index over bus stops.
+
+    Returns:
+    - list: Tuples (index of the first fix of the trajectory, bus stop, time of entering,
+      time of the nearest approach, time of leaving, nearest distance in meters).
+    """
+    lats, lons, times = lats.tolist(), lons.tolist(), np.asarray(times, dtype=np.float64).tolist()
+    bounds = sorted(set(starts.tolist()) | {len(lats)}) if len(lats) else []
+    radius = stop_grid.radius
+    passages = []
+
+    for start, end in zip(bounds, bounds[1:]):
+        # bus stop -> [time of entering, time of nearest approach, nearest distance]
+        active = {}
+        for bus_stop, stop_loc in stop_grid.query_segment((lats[start], lons[start]),
+                                                          (lats[start], lons[start])):
+            hit = _segment_circle((lats[start], lons[start]), (lats[start], lons[start]),
+                                  stop_loc, radius)
+            if hit is not None:
+                active[bus_stop] = [times[start], times[start], hit[0]]
+
+        for i in range(start + 1, end):
+            loc1, loc2 = (lats[i - 1], lons[i - 1]), (lats[i], lons[i])
+            time1, duration = times[i - 1], times[i] - times[i - 1]
+            touched = set()
+
+            for bus_stop, stop_loc in stop_grid.query_segment(loc1, loc2):
+                hit = _segment_circle(loc1, loc2, stop_loc, radius)
+                if hit is None:
+                    continue
+                distance, nearest, entering, leaving = hit
+                passage = active.get(bus_stop)
+                if passage is None:
+                    passage = active[bus_stop] = [time1 + max(entering, 0.0) * duration,
+                                                  None, float("inf")]
+                if distance < passage[2]:
+                    passage[1], passage[2] = time1 + nearest * duration, distance
+                if leaving < 1.0:
+                    passages.append((start, bus_stop, passage[0], passage[1],
+                                     time1 + leaving * duration, passage[2]))
+                    del active[bus_stop]
+                else:
+                    touched.add(bus_stop)
+
+            # Passages not continued by the segment ended at its first fix
+            for bus_stop in [bus_stop for bus_stop in active if bus_stop not in touched]:
+                entered, nearest, distance = active.pop(bus_stop)
+                passages.append((start, bus_stop, entered, nearest, time1, distance))
+
+        for bus_stop, (entered, nearest, distance) in active.items():
+            passages.append((start, bus_stop, entered, nearest, times[end - 1], distance))
+
+    return passages
+
+
+class DelayStats:
+    """
+    Mergeable statistics of delays of scheduled departures per bus line, per bus stop
+    and per hour of the scheduled time.
+
+    Delays are counted in a fixed-bin histogram of BIN_WIDTH seconds between MIN_DELAY
+    and MAX_DELAY, with an underflow and an overflow bin, and summed for exact means.
+    Quantiles are interpolated within bins, so they are accurate to BIN_WIDTH.
+    Statistics of captures, shards or processes are combined by adding histograms,
+    which gives the same result as computing them in one pass.
+    """
+
+    DIMENSIONS = ("line", "stop", "hour")
+    BIN_WIDTH = 15
+    MIN_DELAY = -900
+    MAX_DELAY = 3600
+    # Departures more than a minute early are not on time, nor are those at least two minutes
+    # late, the delay from which calculate_delays reports them
+    EARLY_DELAY = -60
+    LATE_DELAY = 120
+
+    N_BINS = (MAX_DELAY - MIN_DELAY) // BIN_WIDTH + 2
+
+    def __init__(self):
+        # Per dimension: group keys, their indices, counts per bin and sums of delays
+        self.keys = {dimension: [] for dimension in self.DIMENSIONS}
+        self.indices = {dimension: {} for dimension in self.DIMENSIONS}
+        self.counts = {dimension: np.zeros((0, self.N_BINS), dtype=np.int64)
+                       for dimension in self.DIMENSIONS}
+        self.sums = {dimension: np.zeros(0, dtype=np.float64) for dimension in self.DIMENSIONS}
+
+    @classmethod
+    def bins(cls, delays):
+        """
+        Returns histogram bins of delays in seconds; bin 0 and the last bin count delays
+        below MIN_DELAY and from MAX_DELAY on.
+        """
+        delays = np.asarray(delays, dtype=np.float64)
+        return np.clip(np.floor((delays - cls.MIN_DELAY) / cls.BIN_WIDTH) + 1,
+                       0, cls.N_BINS - 1).astype(np.int64)
+
+    def _group(self, dimension, keys):
+        indices = self.indices[dimension]
+        new_keys = [key for key in dict.fromkeys(keys) if key not in indices]
+        for key in new_keys:
+            indices[key] = len(self.keys[dimension])
+            self.keys[dimension].append(key)
+        if new_keys:
+            self.counts[dimension] = np.vstack(
+                (self.counts[dimension], np.zeros((len(new_keys), self.N_BINS), dtype=np.int64)))
+            self.sums[dimension] = np.concatenate((self.sums[dimension],
+                                                   np.zeros(len(new_keys))))
+        return np.fromiter((indices[key] for key in keys), dtype=np.int64, count=len(keys))
+
+    def add(self, bus_lines, bus_stops, hours, delays):
+        """
+        Adds delays of departures.
+
+        Parameters:
+        - bus_lines (list): Bus line of every departure.
+        - bus_stops (list): Bus stop of every departure, e.g. "busstopId,busstopNr".
+        - hours (list): Hour of the day (0-23) of every scheduled time.
+        - delays (list): Delays in seconds, negative for early departures.
+        """
+        delays = np.asarray(delays, dtype=np.float64)
+        bins = self.bins(delays)
+        for dimension, keys in zip(self.DIMENSIONS, (bus_lines, bus_stops, hours)):
+            groups = self._group(dimension, list(keys))
+            n_groups = len(self.keys[dimension])
+            self.counts[dimension] += np.bincount(
+                groups * self.N_BINS + bins, minlength=n_groups * self.N_BINS).reshape(
+                    n_groups, self.N_BINS)
+            self.sums[dimension] += np.bincount(groups, weights=delays, minlength=n_groups)
+
+    def merge(self, other):
+        """
+        Adds statistics of other to these statistics and returns them.
+        """
+        for dimension in self.DIMENSIONS:
+            groups = self._group(dimension, other.keys[dimension])
+            self.counts[dimension][groups] += other.counts[dimension]
+            self.sums[dimension][groups] += other.sums[dimension]
+        return self
+
+    def quantiles(self, dimension, quantiles=(0.5, 0.9, 0.95)):
+        """
+        Returns an array of delay quantiles in seconds with a row per group of dimension.
+        Quantiles falling in the underflow or overflow bins are clipped to
+        MIN_DELAY or MAX_DELAY, and are NaN for groups without departures.
+        """
+        counts = self.counts[dimension]
+        cumulative = np.cumsum(counts, axis=1)
+        totals = cumulative[:, -1:]
+        targets = totals * np.asarray(quantiles, dtype=np.float64)[None, :]
+        # Lower edges of bins, the underflow bin is treated as empty below MIN_DELAY
+        edges = self.MIN_DELAY + (np.arange(self.N_BINS) - 1) * self.BIN_WIDTH
+
+        result = np.full(targets.shape, np.nan)
+        for row in np.flatnonzero(totals[:, 0]):
+            bins = np.minimum(np.searchsorted(cumulative[row], targets[row], side="left"),
+                              self.N_BINS - 1)
+            before = np.where(bins > 0, cumulative[row][bins - 1], 0)
+            inside = np.maximum(counts[row][bins], 1)
+            result[row] = edges[bins] + (targets[row] - before) / inside * self.BIN_WIDTH
+        return np.clip(result, self.MIN_DELAY, self.MAX_DELAY)
+
+    def summary(self, dimension, quantiles=(0.5, 0.9, 0.95)):
+        """
+        Summarizes delays per group of dimension ("line", "stop" or "hour").
+
+        Returns:
+        - dict: Groups mapped to dictionaries with the number of departures ("count"),
+          shares of "early", "on_time" and "late" departures, the "mean" delay
+          and delay quantiles ("p50", "p90", ...) in seconds.
+        """
+        counts = self.counts[dimension]
+        totals = counts.sum(axis=1)
+        early_bin, late_bin = self.bins([self.EARLY_DELAY, self.LATE_DELAY])
+        early = counts[:, :early_bin].sum(axis=1)
+        late = counts[:, late_bin:].sum(axis=1)
+        values = self.quantiles(dimension, quantiles)
+
+        summary = {}
+        for row, key in enumerate(self.keys[dimension]):
+            total = int(totals[row])
+            share = 1.0 / total if total else float("nan")
+            summary[key] = {"count": total, "early": float(early[row] * share),
+                            "on_time": float((total - early[row] - late[row]) * share),
+                            "late": float(late[row] * share),
+                            "mean": float(self.sums[dimension][row] * share),
+                            **{f"p{round(q * 100):d}": float(value)
+                               for q, value in zip(quantiles, values[row])}}
+        return summary
+
+    def save(self, dirpath):
+        """
+        Saves statistics as a snapshot directory, see save_arrays.
+        """
+        arrays = {}
+        for dimension in self.DIMENSIONS:
+            arrays[f"{dimension}_keys"] = np.array([str(key) for key in self.keys[dimension]],
+                                                   dtype=str)
+            arrays[f"{dimension}_counts"] = self.counts[dimension]
+            arrays[f"{dimension}_sums"] = self.sums[dimension]
+        save_arrays(dirpath, arrays, {"format": "delay-stats", "bin_width": self.BIN_WIDTH,
+                                      "min_delay": self.MIN_DELAY, "max_delay": self.MAX_DELAY})
+
+    @classmethod
+    def load(cls, dirpath):
+        """
+        Loads statistics saved by save.
+        """
+        arrays, meta = load_arrays(dirpath, mmap_mode=None)
+        if (meta.get("bin_width"), meta.get("min_delay"), meta.get("max_delay")) != \
+                (cls.BIN_WIDTH, cls.MIN_DELAY, cls.MAX_DELAY):
+            raise ValueError("delay statistics saved with different bins")
+        stats = cls()
+        for dimension in cls.DIMENSIONS:
+            keys = arrays[f"{dimension}_keys"].tolist()
+            stats.keys[dimension] = [int(key) for key in keys] if dimension == "hour" else keys
+            stats.indices[dimension] = {key: i for i, key in enumerate(stats.keys[dimension])}
+            stats.counts[dimension] = arrays[f"{dimension}_counts"].reshape(-1, cls.N_BINS)
+            stats.sums[dimension] = arrays[f"{dimension}_sums"]
+        return stats
@@ -4,13 +4,19 @@ This module provides functions downloading bus schedules data.
 
 from secrets import API_KEY
 
-from datetime import datetime
+import os
+import json
+from datetime import datetime, timedelta
 from tqdm import tqdm
 
-from utils import save_data, send_request
+from utils import save_data, send_request, fetch_concurrently, ApiClient,\
+                  find_latest_snapshot, load_snapshot, diff_schedule_keys
+from crawl_state import CrawlState
+from cache import ResponseCache
+from instrumentation import stage
 
 
-def get_bus_lines_stopping(bus_stop_id, bus_stop_nr):
+def get_bus_lines_stopping(bus_stop_id, bus_stop_nr, client=None):
     """
     Downloads bus lines that are stopping on a bus stop specified 
     by parameters bus_stop_id, bus_stop_nr.
@@ -19,18 +25,18 @@ def get_bus_lines_stopping(bus_stop_id, bus_stop_nr):
            "id=88cd555f-6f31-43ca-9de4-66c479ad5942&"
            f"busstopId={bus_stop_id}&busstopNr={bus_stop_nr}&apikey={API_KEY}")
 
-    return send_request(url)
+    return send_request(url, client)
 
-def get_bus_stops():
+def get_bus_stops(client=None):
     """
     Downloads list of bus stops.
     """
     url = ("https://api.um.warszawa.pl/api/action/dbstore_get?"
            f"id=ab75c33d-3a26-4342-b36a-6e5fef0a3ac3&apikey={API_KEY}")
 
-    return send_request(url)
+    return send_request(url, client)
 
-def get_bus_schedule(bus_stop_id, bus_stop_nr, bus_line):
+def get_bus_schedule(bus_stop_id, bus_stop_nr, bus_line, client=None):
     """
     Downloads schedule for given bus stop and given bus line.
     """
@@ -38,51 +44,203 @@ def get_bus_schedule(bus_stop_id, bus_stop_nr, bus_line):
            "id=e923fa0e-d96c-43f9-ae6e-60518c9f3238"
            f"&busstopId={bus_stop_id}&busstopNr={bus_stop_nr}&line={bus_line}&apikey={API_KEY}")
 
-    return send_request(url)
+    return send_request(url, client)
 
 
-def download_data(data_dir):
+def _crawl(state, kind, keys, fetch, parse, client, desc):
     """
-    Downloads bus schedules data and saves it to data_dir.
+    Fetches keys not yet recorded in crawl state and records their parsed results.
+    Returns True if results for all keys are recorded.
+    """
+    done = state.items(kind)
+    missing = [key for key in keys if ",".join(key) not in done]
+
+    failed = 0
+    with stage("crawl", kind=kind) as current:
+        current.add(items=len(keys), cached=len(keys) - len(missing))
+        for key, response in tqdm(fetch_concurrently(lambda key: fetch(*key, client),
+                                                     missing, client.max_workers),
+                                  desc=desc, total=len(missing)):
+            try:
+                result = parse(response.json()["result"])
+            except (AttributeError, ValueError, KeyError, TypeError, IndexError):
+                failed += 1
+                continue
+            state.put(kind, ",".join(key), result)
+        current.add(failed=failed)
+
+    if failed:
+        print(f"{failed} requests failed")
+    return failed == 0
+
+
+def _load_fetch_times(data_dir, version):
     """
-    download_time = datetime.now()
+    Loads times at which schedules of a snapshot were downloaded, as saved next to it.
+    Snapshots saved without them count as downloaded at their own timestamp.
+    """
+    try:
+        with open(os.path.join(data_dir, f"schedule-fetch-times-{version}.json"), "r",
+                  encoding="utf-8") as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _is_expired(fetch_time, cutoff):
+    try:
+        return datetime.fromisoformat(fetch_time) < cutoff
+    except (TypeError, ValueError):
+        return True
 
-    data = get_bus_stops().json()
+
+def _reuse_previous_schedules(state, data_dir, download_time, bus_stops, bus_lines, max_age):
+    """
+    Records schedules of the latest previous snapshot in crawl state for schedule keys
+    whose bus stop and bus lines did not change, so that they are not downloaded again.
+    Schedules downloaded more than max_age (a timedelta) before download_time are not
+    reused, so that every schedule is eventually refreshed.
+    """
+    version = find_latest_snapshot(data_dir, exclude=download_time)
+    if version is None:
+        return
+
+    old_bus_stops, old_bus_lines, old_schedules = load_snapshot(data_dir, version)
+    changed = diff_schedule_keys(old_bus_stops, bus_stops, old_bus_lines, bus_lines)
+
+    old_fetch_times = _load_fetch_times(data_dir, version)
+    cutoff = datetime.fromisoformat(download_time) - max_age if max_age is not None else None
+    expired = 0
+
+    done = state.items("schedule")
+    reused, fetch_times = {}, {}
+    for key in bus_lines:
+        for bus_line in bus_lines[key]:
+            sid = f"{key},{bus_line}"
+            if sid in changed or sid in done or sid not in old_schedules:
+                continue
+            fetch_time = old_fetch_times.get(sid, version)
+            if cutoff is not None and _is_expired(fetch_time, cutoff):
+                expired += 1
+                continue
+            reused[sid] = old_schedules[sid]
+            fetch_times[sid] = fetch_time
+    state.put_many("fetch-time", fetch_times)
+    state.put_many("schedule", reused)
+
+    print(f"reusing {len(reused)} schedules from snapshot {version}, "
+          f"{len(changed)} changed, {expired} expired")
+
+
+def _is_valid_result(response):
+    """
+    Checks if a response carries a list of results; on errors the API sends
+    a message as the result with status 200.
+    """
+    try:
+        return isinstance(response.json()["result"], list)
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def download_data(data_dir, max_workers=8, max_rate=10.0, state_path=None, incremental=True,
+                  max_age=timedelta(days=7), cache_path=None, cache_ttl=6 * 3600,
+                  offline=False):
+    """
+    Downloads bus schedules data and saves it to data_dir.
+    At most max_workers requests are in flight and at most max_rate are sent per second.
+
+    Completed requests are recorded in a crawl state database (data_dir/crawl-state.sqlite
+    by default), so rerunning an interrupted or failed download fetches only what is missing.
+    The state is cleared once everything has been downloaded.
+
+    If incremental, schedules are downloaded only for bus stops and lines that changed
+    since the latest snapshot in data_dir; the others are copied from it unless they were
+    downloaded more than max_age ago (None copies them regardless of age). Download times
+    of schedules are saved in schedule-fetch-times-<download time>.json.
+
+    API responses are cached in data_dir/http-cache.sqlite by default and reused for
+    cache_ttl seconds, so reruns do not hit the API again; offline serves only from the cache.
+    """
+    state = CrawlState(state_path or os.path.join(data_dir, "crawl-state.sqlite"))
+    cache = ResponseCache(cache_path or os.path.join(data_dir, "http-cache.sqlite"), cache_ttl,
+                          offline=offline, validate=_is_valid_result)
+    client = ApiClient(max_workers, max_rate, cache=cache)
+
+    download_time = state.get("meta", "download_time")
+    if download_time is None:
+        download_time = str(datetime.now())
+        state.put("meta", "download_time", download_time)
+
+    data = state.get("bus-stops", "")
+    if data is None:
+        response = get_bus_stops(client)
+        if response is None:
+            print("downloading bus stops failed")
+            state.close()
+            cache.close()
+            return
+        data = response.json()
+        state.put("bus-stops", "", data)
 
     save_data(data, data_dir, f"bus-stops-{download_time}.json")
 
-    bus_stop_ids = [value["values"][0]["value"] for value in data["result"]]
-    bus_stop_nrs = [value["values"][1]["value"] for value in data["result"]]
+    bus_stops = [(value["values"][0]["value"], value["values"][1]["value"])
+                 for value in data["result"]]
 
-    bus_stop_to_bus_lines_stopping = {}
+    # Set only once both crawls return, so an interrupted crawl keeps its checkpoint
+    complete = False
     try:
-        for bus_stop_id, bus_stop_nr in tqdm(zip(bus_stop_ids, bus_stop_nrs),
-                                             desc="Downloading bus lines stopping",
-                                             unit=" iterations",
-                                             total=len(bus_stop_ids)):
-            result = get_bus_lines_stopping(bus_stop_id, bus_stop_nr).json()
-            bus_lines_stopping = [kv["values"][0]["value"] for kv in result["result"]]
-            bus_stop_to_bus_lines_stopping[(bus_stop_id, bus_stop_nr)] = bus_lines_stopping
+        lines_complete = _crawl(state, "bus-lines", bus_stops, get_bus_lines_stopping,
+                                lambda result: [kv["values"][0]["value"] for kv in result],
+                                client, "Downloading bus lines stopping")
+
+        bus_lines = state.items("bus-lines")
+        if incremental:
+            _reuse_previous_schedules(state, data_dir, download_time, data, bus_lines, max_age)
+
+        schedule_keys = [(bus_stop_id, bus_stop_nr, bus_line)
+                         for bus_stop_id, bus_stop_nr in bus_stops
+                         for bus_line in bus_lines.get(f"{bus_stop_id},{bus_stop_nr}", [])]
+
+        schedules_complete = _crawl(state, "schedule", schedule_keys, get_bus_schedule,
+                                    lambda result: [stop["values"][-1]["value"]
+                                                    for stop in result],
+                                    client, "Downloading bus schedules")
+        complete = lines_complete and schedules_complete
     except KeyboardInterrupt:
         print("downloading interrupted")
 
-    data = {f"{id},{nr}": bus_stop_to_bus_lines_stopping[(id, nr)]
-            for id, nr in bus_stop_to_bus_lines_stopping}
+    bus_lines = state.items("bus-lines")
+    data = {f"{id},{nr}": bus_lines[f"{id},{nr}"]
+            for id, nr in bus_stops if f"{id},{nr}" in bus_lines}
 
     save_data(data, data_dir, f"bus-stops-to-bus-lines-{download_time}.json")
 
+    schedules = state.items("schedule")
     bus_schedules = {}
-    try:
-        for key in tqdm(data,
-                        desc="Downloading bus schedules"):
-            bus_stop_id, bus_stop_nr = key.split(',')
-            for bus_line in data[key]:
-                response = get_bus_schedule(bus_stop_id, bus_stop_nr, bus_line)
-                stops = response.json()["result"]
-                times = [stop["values"][-1]["value"] for stop in stops]
-                bus_schedules[f"{bus_stop_id},{bus_stop_nr},{bus_line}"] = times
-    except KeyboardInterrupt:
-        print("downloading interrupted")
+    for key in data:
+        for bus_line in data[key]:
+            if f"{key},{bus_line}" in schedules:
+                bus_schedules[f"{key},{bus_line}"] = schedules[f"{key},{bus_line}"]
 
     save_data(bus_schedules, data_dir, f"bus-schedules-{download_time}.json")
-    print("downloading finished")
+
+    fetch_times = state.items("fetch-time")
+    save_data({sid: fetch_times.get(sid, download_time) for sid in bus_schedules}, data_dir,
+              f"schedule-fetch-times-{download_time}.json")
+
+    for endpoint, counters in client.stats.summary().items():
+        print(f"{endpoint}: {counters['requests']} requests, {counters['cached']} cached, "
+              f"{counters['errors']} errors, "
+              f"{counters['failed']} failed, mean latency {counters['mean_latency']:.2f}s")
+    if client.breaker.opened:
+        print(f"requests were paused {client.breaker.opened} times after API failures")
+
+    if complete:
+        state.clear()
+        print("downloading finished")
+    else:
+        print("downloading incomplete, run again to resume")
+    state.close()
+    cache.close()
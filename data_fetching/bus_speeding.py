@@ -4,10 +4,14 @@ This module provides functions downloading bus locations data.
 
 from secrets import API_KEY
 
-from time import sleep
+import os
+import json
 from datetime import datetime
 
-from utils import save_data, send_request
+from utils import send_request, NdjsonWriter, FixDeduplicator, find_latest_snapshot
+from live import PollScheduler, SpeedingDetector, LivePositions, LiveDaemon, bus_stop_locations,\
+                 poll_results
+from instrumentation import stage
 
 
 def get_available_buses():
@@ -22,26 +26,75 @@ def get_available_buses():
 
     return send_request(url)
 
-def download_data(data_dir):
+def download_data(data_dir, iterations=60, interval=60, max_bytes=None, max_seconds=None,
+                  speed_limit=50.0, on_speeding=None):
     """
-    Downloads bus locations data to data_dir measured from a 1h time window.
+    Downloads bus locations data to data_dir, polling on wall-clock ticks every interval
+    seconds for iterations ticks (until interrupted if iterations is None).
+
+    Every poll is appended to bus-locations-<timestamp>.ndjson as it arrives, so memory
+    does not grow with the capture length and a crash loses at most the current poll.
+    Files are rotated after max_bytes bytes or max_seconds seconds.
+    Fixes repeated from the previous poll are dropped before saving.
+
+    Speeding over speed_limit km/h is detected while downloading: events of every poll
+    are passed to on_speeding, or appended to speeding-<timestamp>.ndjson by default.
     """
-    acc_results = []
+    writer = NdjsonWriter(data_dir, "bus-locations", max_bytes, max_seconds)
+    speeding_writer = NdjsonWriter(data_dir, "speeding") if on_speeding is None else None
+    scheduler = PollScheduler(interval, iterations)
+    deduplicator = FixDeduplicator()
+    detector = SpeedingDetector(speed_limit, on_speeding or speeding_writer.write)
 
-    download_time = datetime.now()
+    def handle(response):
+        results = poll_results(response)
+        if results is None:
+            return
+        with stage("poll") as current:
+            current.add(items=len(results))
+            results = list(deduplicator.filter(result for result in results
+                                               if isinstance(result, dict)))
+            writer.write(results)
+            current.add(saved=len(results), speeding=len(detector.process(results)))
+        print(f"downloaded data ({datetime.now()}), "
+              f"duplicates dropped so far: {deduplicator.ratio:.1%}, "
+              f"speeding events: {detector.detected}")
 
     try:
-        for _ in range(60):
-            results = get_available_buses()
-            if results is None:
-                continue
-            results = results.json()['result']
-            print(f"downloaded data ({datetime.now()})")
-            acc_results.extend(results)
-            sleep(60)
+        scheduler.run(get_available_buses, handle)
     except KeyboardInterrupt:
         print("downloading interrupted")
+    finally:
+        writer.close()
+        if speeding_writer is not None:
+            speeding_writer.close()
+
+    print(f"downloading finished, {scheduler.fired} polls, {scheduler.missed} missed ticks, "
+          f"saved to {', '.join(writer.filepaths)}")
+
+def run_daemon(data_dir=None, interval=10, window=600, host="127.0.0.1", port=8080,
+               iterations=None, fetch=get_available_buses):
+    """
+    Polls bus locations every interval seconds, keeping the last window seconds of fixes
+    of every vehicle in memory, and serves queries about them at http://host:port
+    (see LiveQueryServer): /positions, /near?stop=busstopId,busstopNr and /speed?vehicle=.
 
-    save_data(acc_results, data_dir, f"bus-locations-{download_time}.json")
+    Bus stops for /near queries are loaded from the latest bus-stops file in data_dir.
+    Runs for iterations polls, or until interrupted if iterations is None.
+    """
+    bus_stops = None
+    version = find_latest_snapshot(data_dir) if data_dir else None
+    if version is not None:
+        with open(os.path.join(data_dir, f"bus-stops-{version}.json"), "r",
+                  encoding="utf-8") as json_file:
+            bus_stops = bus_stop_locations(json.load(json_file))
 
-    print("downloading finished")
+    daemon = LiveDaemon(fetch, LivePositions(window), (host, port), bus_stops)
+    daemon.start()
+    print(f"serving live positions at {daemon.url}")
+    try:
+        daemon.run(interval, iterations)
+    except KeyboardInterrupt:
+        print("daemon interrupted")
+    finally:
+        daemon.stop()
@@ -0,0 +1,186 @@
+"""
+This module provides a persistent cache of API responses.
+"""
+
+import json
+import hashlib
+import sqlite3
+import threading
+from time import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+def cache_key(url):
+    """
+    Returns url without its apikey parameter, identifying the requested resource.
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if key != "apikey"]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class CachedResponse:
+    """
+    Response served from a ResponseCache, with the parts of requests.Response used
+    by the callers of send_request.
+    """
+
+    status_code = 200
+
+    def __init__(self, url, content, headers, stored, ttl):
+        self.url = url
+        self.content = content
+        self.headers = headers
+        self.stored = stored
+        self.ttl = ttl
+
+    @property
+    def fresh(self):
+        """
+        Checks if the response is younger than the time to live of the cache.
+        """
+        return time() - self.stored < self.ttl
+
+    def validators(self):
+        """
+        Returns headers of a conditional request revalidating the response,
+        or None if the server sent no ETag or Last-Modified.
+        """
+        headers = {}
+        if self.headers.get("ETag"):
+            headers["If-None-Match"] = self.headers["ETag"]
+        if self.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers or None
+
+    @property
+    def text(self):
+        """
+        Body decoded as UTF-8.
+        """
+        return self.content.decode("utf-8")
+
+    def json(self):
+        """
+        Body parsed as JSON.
+        """
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        """
+        Cached responses are always successful.
+        """
+
+
+class ResponseCache:
+    """
+    Persistent cache of successful API responses, backed by SQLite.
+
+    Responses are keyed by url without the apikey (see cache_key) and their bodies are
+    stored once per content hash, so identical responses of many requests share storage.
+    Responses older than ttl seconds are revalidated with a conditional request when the
+    server sent an ETag or Last-Modified header, and fetched again otherwise. Once bodies
+    exceed max_bytes, the least recently used responses are evicted.
+    In offline mode stale responses are served too and missing ones are not requested.
+    """
+
+    def __init__(self, filepath, ttl=6 * 3600, max_bytes=512 * 2**20, offline=False,
+                 validate=None):
+        """
+        Parameters:
+        - filepath (str): Path of the SQLite database.
+        - ttl (float): Seconds for which responses are served without a request.
+        - max_bytes (int): Maximum total size of cached bodies.
+        - offline (bool): Serve only from the cache.
+        - validate (callable): Called with a response before caching it; responses for which
+          it returns False (e.g. error messages sent with status 200) are not cached.
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.validate = validate
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                                "digest TEXT, headers TEXT, stored REAL, used REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS bodies "
+                                "(digest TEXT PRIMARY KEY, body BLOB, size INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_digest "
+                                "ON responses (digest)")
+        self.connection.commit()
+        self.size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def get(self, url):
+        """
+        Returns the cached response of url or None, marking it as recently used.
+        """
+        key = cache_key(url)
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT body, headers, stored FROM responses JOIN bodies USING (digest) "
+                "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET used = ? WHERE key = ?", (time(), key))
+        return CachedResponse(url, row[0], json.loads(row[1]), row[2], self.ttl)
+
+    def touch(self, url):
+        """
+        Marks the cached response of url as fresh after a successful revalidation.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE responses SET stored = ?, used = ? WHERE key = ?",
+                                    (time(), time(), cache_key(url)))
+
+    def put(self, url, response):
+        """
+        Caches a successful response of url and evicts least recently used responses
+        if the cache grew over max_bytes.
+        """
+        if response.status_code != 200 or \
+                (self.validate is not None and not self.validate(response)):
+            return
+        body = response.content
+        digest = hashlib.sha256(body).hexdigest()
+        headers = {key: response.headers[key] for key in ("ETag", "Last-Modified")
+                   if response.headers.get(key)}
+        key = cache_key(url)
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT digest FROM responses WHERE key = ?",
+                                          (key,)).fetchone()
+            if self.connection.execute("INSERT OR IGNORE INTO bodies VALUES (?, ?, ?)",
+                                       (digest, body, len(body))).rowcount:
+                self.size += len(body)
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                    (key, digest, json.dumps(headers), time(), time()))
+            if row is not None and row[0] != digest:
+                self._drop_unused(row[0])
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _drop_unused(self, digest):
+        if self.connection.execute("SELECT 1 FROM responses WHERE digest = ?",
+                                   (digest,)).fetchone() is None:
+            row = self.connection.execute("SELECT size FROM bodies WHERE digest = ?",
+                                          (digest,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+                self.connection.execute("DELETE FROM bodies WHERE digest = ?", (digest,))
+
+    def _evict(self):
+        for key, digest in self.connection.execute(
+                "SELECT key, digest FROM responses ORDER BY used").fetchall():
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._drop_unused(digest)
+            if self.size <= self.max_bytes:
+                break
+
+    def close(self):
+        """
+        Closes the underlying database.
+        """
+        self.connection.close()
@@ -0,0 +1,66 @@
+"""
+This module provides a persistent checkpoint of completed requests of a crawl.
+"""
+
+import json
+import sqlite3
+
+
+class CrawlState:
+    """
+    Persistent store of completed requests of a crawl, backed by SQLite.
+    Results are grouped by kind (e.g. "schedule") and keyed by strings
+    such as "busstopId,busstopNr,line".
+    """
+
+    def __init__(self, filepath):
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                "(kind TEXT, key TEXT, value TEXT, PRIMARY KEY (kind, key))")
+        self.connection.commit()
+
+    def put(self, kind, key, value):
+        """
+        Records the result of a completed request.
+        """
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                                    (kind, key, json.dumps(value)))
+
+    def put_many(self, kind, results):
+        """
+        Records results of many completed requests given as a dictionary.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                                        ((kind, key, json.dumps(value))
+                                         for key, value in results.items()))
+
+    def get(self, kind, key):
+        """
+        Returns the recorded result or None if the request was not completed.
+        """
+        row = self.connection.execute("SELECT value FROM results WHERE kind = ? AND key = ?",
+                                      (kind, key)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def items(self, kind):
+        """
+        Returns a dictionary with all recorded results of the given kind.
+        """
+        return {key: json.loads(value) for key, value in self.connection.execute(
+            "SELECT key, value FROM results WHERE kind = ?", (kind,))}
+
+    def clear(self):
+        """
+        Removes all recorded results.
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM results")
+
+    def close(self):
+        """
+        Closes the underlying database.
+        """
+        self.connection.close()
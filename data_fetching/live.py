@@ -0,0 +1,489 @@
+"""
+This module provides polling of live bus locations on wall-clock ticks, online detection
+of speeding and a daemon keeping recent positions in memory for local HTTP queries.
+"""
+
+import json
+import threading
+from math import ceil, radians, cos, isfinite
+from time import sleep, time
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from instrumentation import stage
+from data_analysis.utils import haversine_distance, EARTH_RADIUS, SERVICE_AREA, MAX_SPEED
+
+
+def parse_fix(record):
+    """
+    Parses a bus location record as returned by the ZTM API.
+    Returns (VehicleNumber, Lat, Lon, seconds since the epoch) or None if the record
+    has no valid vehicle, location or time.
+    """
+    try:
+        return (record["VehicleNumber"], float(record["Lat"]), float(record["Lon"]),
+                (datetime.strptime(record["Time"], '%Y-%m-%d %H:%M:%S')
+                 - datetime(1970, 1, 1)).total_seconds())
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class SpeedingDetector:
+    """
+    Detects speeding online from consecutive polls of bus locations.
+
+    Keeps only the last fix of every vehicle, so memory is bounded by the number of active
+    vehicles; vehicles not seen for max_idle seconds are forgotten. The speed between
+    the last and the new fix of a vehicle is computed with the haversine formula, as
+    calculate_speed in data_analysis.utils does, and segments faster than speed_limit km/h
+    are reported as events: the earlier fix of the segment with its 'Speed'.
+
+    Implausible data is handled as find_outliers in data_analysis.utils does: fixes outside
+    SERVICE_AREA are ignored and segments over MAX_SPEED are GPS jumps, not speeding.
+    """
+
+    def __init__(self, speed_limit=50.0, sink=None, max_idle=900.0):
+        """
+        Parameters:
+        - speed_limit (float): Speed limit in kilometers per hour.
+        - sink (callable): Called with the list of events found in every processed poll,
+          e.g. NdjsonWriter.write to save them to a file.
+        - max_idle (float): Seconds after which a vehicle without new fixes is forgotten.
+        """
+        self.speed_limit = speed_limit
+        self.sink = sink
+        self.max_idle = max_idle
+        # VehicleNumber -> (Lat, Lon, seconds, Time, Lines, Brigade) of the last fix
+        self.last_fixes = {}
+        self.latest = float("-inf")
+        self.detected = 0
+
+    def process(self, records):
+        """
+        Updates the state with records of one poll and returns the speeding events found.
+        Records with an invalid time or location, outside the service area, or older than
+        the last fix of their vehicle, are ignored.
+        """
+        min_lat, max_lat, min_lon, max_lon = SERVICE_AREA
+        events = []
+        for record in records:
+            fix = parse_fix(record)
+            if fix is None:
+                continue
+            vehicle_number, lat, lon, seconds = fix
+            if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+                continue
+
+            last_fix = self.last_fixes.get(vehicle_number)
+            if last_fix is not None:
+                if seconds <= last_fix[2]:
+                    continue
+                speed = haversine_distance(last_fix[:2], (lat, lon)) \
+                    / (seconds - last_fix[2]) * 3.6
+                if self.speed_limit < speed <= MAX_SPEED:
+                    events.append({"Lines": last_fix[4], "Lon": last_fix[1],
+                                   "VehicleNumber": vehicle_number, "Time": last_fix[3],
+                                   "Lat": last_fix[0], "Brigade": last_fix[5], "Speed": speed})
+
+            self.last_fixes[vehicle_number] = (lat, lon, seconds, record["Time"],
+                                               record.get("Lines"), record.get("Brigade"))
+            self.latest = max(self.latest, seconds)
+
+        self.last_fixes = {vehicle_number: last_fix
+                           for vehicle_number, last_fix in self.last_fixes.items()
+                           if self.latest - last_fix[2] <= self.max_idle}
+        self.detected += len(events)
+        if self.sink is not None and events:
+            self.sink(events)
+        return events
+
+
+class PollScheduler:
+    """
+    Runs a task on wall-clock ticks, i.e. at multiples of interval seconds since the epoch,
+    so samples stay evenly spaced regardless of how long each task takes.
+
+    The task runs in a background thread while the scheduler waits for the next tick,
+    and its result is passed to handle as soon as it is available. A tick at which
+    the previous task is still in flight, or which passed while the process was stalled,
+    is counted as missed instead of being run late.
+    """
+
+    def __init__(self, interval, iterations=None):
+        """
+        Parameters:
+        - interval (float): Seconds between ticks.
+        - iterations (int or None): Number of ticks to run for, or None to run until interrupted.
+        """
+        self.interval = interval
+        self.iterations = iterations
+        self.fired = 0
+        self.missed = 0
+
+    def _ticks_done(self):
+        return self.iterations is not None and self.fired + self.missed >= self.iterations
+
+    def run(self, task, handle):
+        """
+        Calls handle(task()) on every tick. Returns once all iterations are done.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = None
+        next_tick = ceil(time() / self.interval) * self.interval
+
+        try:
+            while not self._ticks_done():
+                if future is not None:
+                    wait([future], timeout=max(0.0, next_tick - time()))
+                    if future.done():
+                        handle(future.result())
+                        future = None
+                sleep(max(0.0, next_tick - time()))
+
+                behind = int((time() - next_tick) // self.interval)
+                if behind > 0:
+                    print(f"missed {behind} ticks, process was stalled")
+                    self.missed += behind
+                    next_tick += behind * self.interval
+                    continue
+
+                if future is not None:
+                    print(f"missed tick at {datetime.fromtimestamp(next_tick)}, "
+                          "previous poll still in flight")
+                    self.missed += 1
+                else:
+                    future = executor.submit(task)
+                    self.fired += 1
+                next_tick += self.interval
+
+            if future is not None:
+                handle(future.result())
+        finally:
+            executor.shutdown(wait=False)
+
+
+def poll_results(response):
+    """
+    Returns the list of results of a response of the ZTM API, or None if downloading failed
+    or the response is not JSON with a list of results, e.g. an error message.
+    """
+    if response is None:
+        print(f"downloading failed ({datetime.now()})")
+        return None
+    try:
+        results = response.json()["result"]
+    except (ValueError, KeyError, TypeError) as err:
+        print(f"invalid response ({datetime.now()}): {err!r}")
+        return None
+    if not isinstance(results, list):
+        print(f"unexpected response: {results}")
+        return None
+    return results
+
+
+def bus_stop_locations(bus_stops):
+    """
+    Returns a dictionary mapping "busstopId,busstopNr" to (Lat, Lon) of bus stops
+    as returned by the ZTM API. Bus stops without a valid location are skipped.
+    """
+    locations = {}
+    for bus_stop in bus_stops["result"]:
+        values = {value["key"]: value["value"] for value in bus_stop["values"]}
+        try:
+            locations[f"{values['zespol']},{values['slupek']}"] = (float(values["szer_geo"]),
+                                                                  float(values["dlug_geo"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return locations
+
+
+class LivePositions:
+    """
+    Recent fixes of every vehicle kept in memory for live queries.
+
+    Fixes of a vehicle are kept in a ring buffer of at most capacity entries and only
+    for the last window seconds (counted from the newest fix seen), so memory is bounded
+    by the fleet size. Latest fixes are indexed in a grid of cells of cell_size degrees
+    for queries of vehicles near a point. Safe to query from many threads while updated.
+    """
+
+    METERS_PER_DEGREE = EARTH_RADIUS * radians(1.0)
+    # Largest radius of near queries in meters, a block of cells well beyond the city
+    MAX_RADIUS = 50000.0
+
+    def __init__(self, window=600.0, capacity=64, cell_size=0.01):
+        self.window = window
+        self.capacity = capacity
+        self.cell_size = cell_size
+        # VehicleNumber -> deque of (seconds, Lat, Lon, Time, Lines, Brigade)
+        self.buffers = {}
+        # (row, col) -> VehicleNumbers with the latest fix in the cell
+        self.cells = {}
+        self.latest = float("-inf")
+        self.lock = threading.Lock()
+
+    def _cell(self, lat, lon):
+        return int(lat // self.cell_size), int(lon // self.cell_size)
+
+    def update(self, records):
+        """
+        Adds fixes of one poll and returns the number of new fixes.
+        Records with an invalid time or location, or not newer than the last fix
+        of their vehicle, are ignored.
+        """
+        added = 0
+        with self.lock:
+            for record in records:
+                fix = parse_fix(record)
+                if fix is None:
+                    continue
+                vehicle_number, lat, lon, seconds = fix
+                buffer = self.buffers.get(vehicle_number)
+                if buffer is None:
+                    buffer = self.buffers[vehicle_number] = deque(maxlen=self.capacity)
+                elif seconds <= buffer[-1][0]:
+                    continue
+                buffer.append((seconds, lat, lon, record["Time"], record.get("Lines"),
+                               record.get("Brigade")))
+                self.latest = max(self.latest, seconds)
+                added += 1
+
+            oldest = self.latest - self.window
+            for vehicle_number in list(self.buffers):
+                buffer = self.buffers[vehicle_number]
+                while buffer and buffer[0][0] < oldest:
+                    buffer.popleft()
+                if not buffer:
+                    del self.buffers[vehicle_number]
+
+            cells = {}
+            for vehicle_number, buffer in self.buffers.items():
+                cells.setdefault(self._cell(buffer[-1][1], buffer[-1][2]), []).append(
+                    vehicle_number)
+            self.cells = cells
+        return added
+
+    @staticmethod
+    def _record(vehicle_number, fix):
+        return {"Lines": fix[4], "Lon": fix[2], "VehicleNumber": vehicle_number,
+                "Time": fix[3], "Lat": fix[1], "Brigade": fix[5]}
+
+    def positions(self, line=None):
+        """
+        Returns the latest fix of every vehicle, or of vehicles of the given line.
+        """
+        with self.lock:
+            return [self._record(vehicle_number, buffer[-1])
+                    for vehicle_number, buffer in self.buffers.items()
+                    if line is None or buffer[-1][4] == line]
+
+    def near(self, lat, lon, radius=500.0):
+        """
+        Returns the latest fixes of vehicles within radius meters of a point,
+        nearest first, with their 'Distance' in meters.
+        Raises ValueError for a point off the globe or a radius that is not finite,
+        negative or larger than MAX_RADIUS.
+        """
+        if not (isfinite(lat) and isfinite(lon) and abs(lat) <= 90.0 and abs(lon) <= 180.0):
+            raise ValueError(f"invalid point {lat},{lon}")
+        if not (isfinite(radius) and 0.0 <= radius <= self.MAX_RADIUS):
+            raise ValueError(f"radius must be between 0 and {self.MAX_RADIUS:g} meters")
+
+        rows = ceil(radius / self.METERS_PER_DEGREE / self.cell_size)
+        cols = ceil(rows / max(cos(radians(lat)), 1e-6))
+        row, col = self._cell(lat, lon)
+        found = []
+        with self.lock:
+            # A wide block is scanned through the occupied cells, bounded by the fleet size
+            if (2 * rows + 1) * (2 * cols + 1) > len(self.cells):
+                cells = [vehicle_numbers for (cell_row, cell_col), vehicle_numbers
+                         in self.cells.items()
+                         if abs(cell_row - row) <= rows and abs(cell_col - col) <= cols]
+            else:
+                cells = [self.cells.get((cell_row, cell_col), ())
+                         for cell_row in range(row - rows, row + rows + 1)
+                         for cell_col in range(col - cols, col + cols + 1)]
+            for vehicle_numbers in cells:
+                for vehicle_number in vehicle_numbers:
+                    fix = self.buffers[vehicle_number][-1]
+                    distance = haversine_distance((lat, lon), fix[1:3])
+                    if distance <= radius:
+                        found.append({**self._record(vehicle_number, fix),
+                                      "Distance": distance})
+        return sorted(found, key=lambda record: record["Distance"])
+
+    def speed(self, vehicle_number):
+        """
+        Returns the recent speed of a vehicle in km/h as a dictionary with its latest fix,
+        the 'Speed' between its two latest fixes and the 'AverageSpeed' over all buffered
+        fixes (None with a single fix), or None if the vehicle has no recent fixes.
+        """
+        with self.lock:
+            buffer = self.buffers.get(vehicle_number)
+            if buffer is None:
+                return None
+            fixes = list(buffer)
+
+        speed = average_speed = None
+        if len(fixes) > 1:
+            distances = [haversine_distance(fix1[1:3], fix2[1:3])
+                         for fix1, fix2 in zip(fixes, fixes[1:])]
+            speed = distances[-1] / (fixes[-1][0] - fixes[-2][0]) * 3.6
+            average_speed = sum(distances) / (fixes[-1][0] - fixes[0][0]) * 3.6
+        return {**self._record(vehicle_number, fixes[-1]), "Speed": speed,
+                "AverageSpeed": average_speed, "Fixes": len(fixes),
+                "Seconds": fixes[-1][0] - fixes[0][0]}
+
+
+class _LiveQueryHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET queries of a LiveQueryServer.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Answers a query with a JSON body.
+        """
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            status, result = 200, {"result": self.server.query(url.path, params)}
+        except LookupError as err:
+            status, result = 404, {"error": str(err)}
+        except ValueError as err:
+            status, result = 400, {"error": str(err)}
+
+        body = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class LiveQueryServer(ThreadingHTTPServer):
+    """
+    Local HTTP server answering queries about LivePositions with JSON {"result": ...}
+    (or {"error": ...} with status 400 or 404):
+
+        GET /positions[?line=180]                   latest fixes of all vehicles (of a line)
+        GET /near?stop=7009,01[&radius=500]         vehicles within radius meters of a bus stop
+        GET /near?lat=52.23&lon=21.01[&radius=500]  vehicles within radius meters of a point
+        GET /speed?vehicle=1000                     recent speed of a vehicle
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, positions, bus_stops=None):
+        """
+        Parameters:
+        - address (tuple): Host and port to listen on, port 0 picks a free port.
+        - positions (LivePositions): Positions to query.
+        - bus_stops (dict): Mapping of "busstopId,busstopNr" to (Lat, Lon),
+          see bus_stop_locations.
+        """
+        super().__init__(address, _LiveQueryHandler)
+        self.positions = positions
+        self.bus_stops = bus_stops or {}
+
+    def query(self, path, params):
+        """
+        Returns the result of a query given by the path and parameters of a request.
+        Raises LookupError for unknown queries, bus stops and vehicles
+        and ValueError for invalid parameters.
+        """
+        if path == "/positions":
+            return self.positions.positions(params.get("line"))
+
+        if path == "/near":
+            radius = float(params.get("radius", 500.0))
+            if "stop" in params:
+                if params["stop"] not in self.bus_stops:
+                    raise LookupError(f"unknown bus stop {params['stop']}")
+                lat, lon = self.bus_stops[params["stop"]]
+            elif "lat" in params and "lon" in params:
+                lat, lon = float(params["lat"]), float(params["lon"])
+            else:
+                raise ValueError("stop or lat and lon parameters required")
+            return self.positions.near(lat, lon, radius)
+
+        if path == "/speed":
+            if "vehicle" not in params:
+                raise ValueError("vehicle parameter required")
+            result = self.positions.speed(params["vehicle"])
+            if result is None:
+                raise LookupError(f"no recent fixes of vehicle {params['vehicle']}")
+            return result
+
+        raise LookupError(f"unknown query {path}")
+
+
+class LiveDaemon:
+    """
+    Polls live bus locations with fetch into LivePositions and serves queries about them
+    with a LiveQueryServer running in a background thread.
+    """
+
+    def __init__(self, fetch, positions, address=("127.0.0.1", 8080), bus_stops=None):
+        """
+        Parameters:
+        - fetch (callable): Returns a response of the ZTM API with bus locations, or None
+          on failure, e.g. get_available_buses.
+        - positions (LivePositions): Store updated with every poll.
+        - address (tuple): Host and port of the query server.
+        - bus_stops (dict): Bus stop locations, see bus_stop_locations.
+        """
+        self.fetch = fetch
+        self.positions = positions
+        self.server = LiveQueryServer(address, positions, bus_stops)
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        Base URL of the query server.
+        """
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Starts serving queries in a background thread.
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def handle(self, response):
+        """
+        Adds bus locations of one response to the positions. Failed and invalid
+        responses are skipped.
+        """
+        results = poll_results(response)
+        if results is None:
+            return
+        with stage("poll") as current:
+            current.add(items=len(results),
+                        saved=self.positions.update(result for result in results
+                                                    if isinstance(result, dict)))
+
+    def run(self, interval, iterations=None):
+        """
+        Polls on wall-clock ticks every interval seconds for iterations ticks
+        (until interrupted if iterations is None).
+        """
+        PollScheduler(interval, iterations).run(self.fetch, self.handle)
+
+    def stop(self):
+        """
+        Stops serving queries.
+        """
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        self.server.server_close()
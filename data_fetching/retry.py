@@ -0,0 +1,151 @@
+"""
+This module provides the retry policy, circuit breaker and per-endpoint statistics
+of API requests.
+"""
+
+import random
+import threading
+from time import sleep, monotonic
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from collections import deque
+from requests.exceptions import HTTPError, InvalidURL, MissingSchema, InvalidSchema
+
+from instrumentation import event
+
+
+class RetryPolicy:
+    """
+    Decides which failed requests are retried and how long to wait before the next attempt:
+    exponential backoff with full jitter, or the delay requested by the server
+    in a Retry-After header.
+    """
+
+    # Statuses of overloaded or temporarily unavailable servers, other errors are permanent
+    RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+    def __init__(self, retries=5, base_delay=0.5, max_delay=30.0):
+        """
+        Parameters:
+        - retries (int): Maximum number of attempts of a request.
+        - base_delay (float): Upper bound of the delay after the first failed attempt,
+          doubled after every next one.
+        - max_delay (float): Cap of delays, including those requested by the server.
+        """
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, err):
+        """
+        Checks if a request failing with err can succeed when retried.
+        """
+        if isinstance(err, (InvalidURL, MissingSchema, InvalidSchema)):
+            return False
+        if isinstance(err, HTTPError) and err.response is not None:
+            return err.response.status_code in self.RETRYABLE_STATUSES
+        return True
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns seconds to wait after the given failed attempt (counted from 0).
+        """
+        if retry_after is not None:
+            return min(max(retry_after, 0.0), self.max_delay)
+        return random.uniform(0.0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def parse_retry_after(response):
+    """
+    Returns seconds to wait given by the Retry-After header of a response
+    (as seconds or as an HTTP date), or None if there is none.
+    """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not isinstance(value, str):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Pauses all requests sharing the breaker when the API fails too often.
+
+    Outcomes of the last window attempts are recorded. Once at least min_attempts are
+    recorded and the share of failures reaches threshold, the breaker opens and every
+    request waits for cooldown seconds; afterwards outcomes are counted anew.
+    """
+
+    def __init__(self, threshold=0.5, window=20, min_attempts=10, cooldown=30.0):
+        self.threshold = threshold
+        self.min_attempts = min_attempts
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.open_until = 0.0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks while the breaker is open.
+        """
+        with self.lock:
+            remaining = self.open_until - monotonic()
+        if remaining > 0:
+            sleep(remaining)
+
+    def record(self, success):
+        """
+        Records the outcome of an attempt, opening the breaker if the failure rate spikes.
+        """
+        with self.lock:
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_attempts \
+                    and failures >= self.threshold * len(self.outcomes):
+                self.open_until = monotonic() + self.cooldown
+                self.outcomes.clear()
+                self.opened += 1
+                event("circuit_open", failures=failures, cooldown=self.cooldown)
+                print(f"API failing, pausing requests for {self.cooldown}s")
+
+
+class EndpointStats:
+    """
+    Thread-safe counters of requests, attempts, errors and latency per API endpoint
+    (the path of the url).
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, **counts):
+        """
+        Adds to counters of an endpoint, e.g. add(endpoint, attempts=1, errors=1).
+        Latency is summed and its maximum is kept as max_latency.
+        """
+        with self.lock:
+            counters = self.counters.setdefault(endpoint, {
+                "requests": 0, "attempts": 0, "errors": 0, "failed": 0, "cached": 0,
+                "revalidated": 0, "latency": 0.0, "max_latency": 0.0})
+            for key, value in counts.items():
+                counters[key] += value
+            if "latency" in counts:
+                counters["max_latency"] = max(counters["max_latency"], counts["latency"])
+
+    def summary(self):
+        """
+        Returns a dictionary of counters per endpoint with the mean latency of attempts.
+        """
+        with self.lock:
+            return {endpoint: {**counters, "mean_latency":
+                               counters["latency"] / counters["attempts"]
+                               if counters["attempts"] else 0.0}
+                    for endpoint, counters in self.counters.items()}
@@ -3,34 +3,159 @@ This module provides utilities for data fetching.
 """
 
 import os
-from time import sleep
+from time import sleep, monotonic
+from datetime import datetime
+import re
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from socket import gaierror
+from urllib.parse import urlsplit
 import requests
-from requests.exceptions import RequestException, ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 
-def send_request(url):
+from instrumentation import stage, event
+from retry import RetryPolicy, CircuitBreaker, EndpointStats, parse_retry_after
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing calls evenly to at most max_rate per second.
+    """
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / max_rate
+        self.next_slot = monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed.
+        """
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+class ApiClient:
+    """
+    Shared HTTP session with a connection pool sized for max_workers concurrent requests
+    and an optional cap of max_rate requests per second.
+    Requests of all workers share the retry policy, circuit breaker, endpoint stats
+    and the optional ResponseCache.
+    """
+
+    def __init__(self, max_workers=8, max_rate=None, retry_policy=None, breaker=None,
+                 cache=None):
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.rate_limiter = RateLimiter(max_rate) if max_rate else None
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = EndpointStats()
+        self.cache = cache
+
+    def post(self, url, timeout, headers=None):
+        """
+        Sends a POST request through the shared session respecting the rate cap.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+        return self.session.post(url, timeout=timeout, headers=headers)
+
+
+# Used by requests sent without a client
+RETRY_POLICY = RetryPolicy()
+CIRCUIT_BREAKER = CircuitBreaker()
+ENDPOINT_STATS = EndpointStats()
+
+
+def redact_url(url):
+    """
+    Returns url without the value of its apikey parameter, safe to log.
+    """
+    return re.sub(r"(apikey=)[^&]*", r"\1***", url)
+
+
+def send_request(url, client=None):
     """
     Sends an API request at given url and returns the response.
-    Retries 5 times on failure. 
+    Uses the pooled session, retry policy, circuit breaker and response cache of client
+    if given. Fresh cached responses are returned without a request, stale ones are
+    revalidated if the server sent validators; in offline mode only the cache is used.
+
+    Failures that can be transient (connection errors, timeouts, 429 and 5xx statuses)
+    are retried with exponential backoff and jitter, or after the delay given by the
+    Retry-After header; permanent errors are not retried.
     If all tries didn't succeed, returns None
     """
-    retries = 5
-    for _ in range(retries):
-        try:
-            response = requests.post(url, timeout=60)
-            response.raise_for_status()
+    if client is None:
+        policy, breaker, stats = RETRY_POLICY, CIRCUIT_BREAKER, ENDPOINT_STATS
+    else:
+        policy, breaker, stats = client.retry_policy, client.breaker, client.stats
+    endpoint = urlsplit(url).path
+    stats.add(endpoint, requests=1)
+
+    cache = client.cache if client is not None else None
+    cached, headers = None, None
+    if cache is not None:
+        cached = cache.get(url)
+        if cached is not None and (cache.offline or cached.fresh):
+            stats.add(endpoint, cached=1)
+            return cached
+        if cache.offline:
+            print(f"offline, no cached response for {redact_url(url)}")
+            stats.add(endpoint, failed=1)
+            return None
+        headers = cached.validators() if cached is not None else None
+
+    with stage("request", url=redact_url(url)) as current:
+        for attempt in range(policy.retries):
+            breaker.wait()
+            current.add(attempts=1)
+            start = monotonic()
+            try:
+                if client is None:
+                    response = requests.post(url, timeout=60)
+                else:
+                    response = client.post(url, timeout=60, headers=headers)
+                response.raise_for_status()
+            except (RequestException, gaierror) as err:
+                stats.add(endpoint, attempts=1, errors=1, latency=monotonic() - start)
+                retryable = policy.is_retryable(err)
+                event("retry" if retryable else "permanent_error", url=redact_url(url),
+                      attempt=attempt, error=type(err).__name__)
+                if not retryable:
+                    print(f"request failed permanently, not retrying... {err}")
+                    break
+                breaker.record(False)
+                if attempt + 1 < policy.retries:
+                    delay = policy.delay(attempt, parse_retry_after(getattr(err, "response",
+                                                                            None)))
+                    print(f"{type(err).__name__}, retrying in {delay:.1f}s... {err}")
+                    sleep(delay)
+                continue
+
+            stats.add(endpoint, attempts=1, latency=monotonic() - start)
+            breaker.record(True)
+            if cached is not None and response.status_code == 304:
+                cache.touch(url)
+                stats.add(endpoint, revalidated=1)
+                return cached
+            current.add(bytes=len(response.content))
+            if cache is not None:
+                cache.put(url, response)
             return response
-        except ConnectionError as err:
-            print(f"connection error, retrying in 3s... {err}")
-            sleep(3)
-        except gaierror as err:
-            print(f"gaierror, retrying in 3s... {err}")
-            sleep(3)
-        except RequestException as err:
-            print(f"request exception, retrying in 3s... {err}")
-            sleep(3)
 
+        current.add(failed=1)
+    stats.add(endpoint, failed=1)
     return None
 
 def save_data(data, data_dir, filename):
@@ -41,3 +166,165 @@ def save_data(data, data_dir, filename):
 
     with open(filepath, "w", encoding="utf-8") as json_file:
         json.dump(data, json_file, indent=2)
+
+
+class FixDeduplicator:
+    """
+    Drops bus location fixes repeating the last seen time of their vehicle,
+    which the API returns again on consecutive polls.
+    Keeps a single entry per vehicle, so memory is bounded by the fleet size.
+    """
+
+    def __init__(self):
+        self.last_times = {}
+        self.seen = 0
+        self.dropped = 0
+
+    def filter(self, records):
+        """
+        Yields records that are not duplicates of the previous fix of their vehicle.
+        """
+        for record in records:
+            self.seen += 1
+            vehicle_number = record.get("VehicleNumber")
+            if self.last_times.get(vehicle_number) == record.get("Time"):
+                self.dropped += 1
+                continue
+            self.last_times[vehicle_number] = record.get("Time")
+            yield record
+
+    @property
+    def ratio(self):
+        """
+        Fraction of seen fixes that were dropped as duplicates.
+        """
+        return self.dropped / self.seen if self.seen else 0.0
+
+
+class NdjsonWriter:
+    """
+    Append-only writer saving records as newline-delimited JSON to
+    data_dir/prefix-<timestamp>.ndjson files.
+
+    Data is flushed after every write and synced to disk at most every fsync_interval
+    seconds. A new file is started once the current one exceeds max_bytes or is older
+    than max_seconds.
+    """
+
+    def __init__(self, data_dir, prefix, max_bytes=None, max_seconds=None, fsync_interval=0.0):
+        self.data_dir = data_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.fsync_interval = fsync_interval
+        self.filepaths = []
+        self.file = None
+        self.opened = None
+        self.synced = None
+
+    def _open(self):
+        filepath = os.path.join(self.data_dir, f"{self.prefix}-{datetime.now()}.ndjson")
+        self.file = open(filepath, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+        self.filepaths.append(filepath)
+        self.opened = self.synced = monotonic()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.synced = monotonic()
+
+    def write(self, records):
+        """
+        Appends records, one JSON object per line.
+        """
+        if self.file is not None and self.max_seconds is not None \
+                and monotonic() - self.opened >= self.max_seconds:
+            self.close()
+        if self.file is None:
+            self._open()
+
+        self.file.write("".join(json.dumps(record, ensure_ascii=False) + "\n"
+                                for record in records))
+        self.file.flush()
+        if monotonic() - self.synced >= self.fsync_interval:
+            self._sync()
+
+        if self.max_bytes is not None and self.file.tell() >= self.max_bytes:
+            self.close()
+
+    def close(self):
+        """
+        Syncs and closes the current file.
+        """
+        if self.file is not None:
+            self._sync()
+            self.file.close()
+            self.file = None
+
+def fetch_concurrently(fetch, items, max_workers):
+    """
+    Calls fetch(item) for every item with at most max_workers calls in flight.
+    Yields (item, result) pairs in completion order.
+    Pending calls are cancelled when the consumer stops early (e.g. on KeyboardInterrupt).
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, item): item for item in items}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def find_latest_snapshot(data_dir, exclude=None):
+    """
+    Finds the timestamp of the latest complete set of bus-stops, bus-stops-to-bus-lines
+    and bus-schedules files in data_dir, skipping the exclude timestamp.
+    Returns None if there is no such set.
+    """
+    prefix, suffix = "bus-schedules-", ".json"
+    versions = sorted((filename[len(prefix):-len(suffix)] for filename in os.listdir(data_dir)
+                       if filename.startswith(prefix) and filename.endswith(suffix)),
+                      reverse=True)
+    for version in versions:
+        if version != exclude and all(
+                os.path.isfile(os.path.join(data_dir, f"{name}-{version}.json"))
+                for name in ("bus-stops", "bus-stops-to-bus-lines")):
+            return version
+    return None
+
+def load_snapshot(data_dir, version):
+    """
+    Loads bus stops, bus stops to bus lines and bus schedules saved with given timestamp.
+    """
+    snapshot = []
+    for name in ("bus-stops", "bus-stops-to-bus-lines", "bus-schedules"):
+        with open(os.path.join(data_dir, f"{name}-{version}.json"), "r",
+                  encoding="utf-8") as json_file:
+            snapshot.append(json.load(json_file))
+    return tuple(snapshot)
+
+def diff_schedule_keys(old_bus_stops, new_bus_stops, old_bus_lines, new_bus_lines):
+    """
+    Compares two timetable snapshots and returns the set of "busstopId,busstopNr,line"
+    schedule keys of new_bus_lines that have to be downloaded again: those of new bus stops,
+    of bus stops whose record changed and of lines that newly stop at a bus stop.
+
+    Parameters:
+    - old_bus_stops, new_bus_stops (dict): Bus stops as returned by the ZTM API.
+    - old_bus_lines, new_bus_lines (dict): Mappings of "busstopId,busstopNr" to bus lines.
+    """
+    def records(bus_stops):
+        return {f"{stop['values'][0]['value']},{stop['values'][1]['value']}": stop["values"]
+                for stop in bus_stops["result"]}
+
+    old_records, new_records = records(old_bus_stops), records(new_bus_stops)
+
+    changed = set()
+    for key, bus_lines in new_bus_lines.items():
+        stop_changed = old_records.get(key) != new_records.get(key)
+        old_lines = set(old_bus_lines.get(key, []))
+        changed.update(f"{key},{bus_line}" for bus_line in bus_lines
+                       if stop_changed or bus_line not in old_lines)
+    return changed
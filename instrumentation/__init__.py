@@ -0,0 +1,237 @@
+"""
+Structured instrumentation of stages of fetching and analysis.
+
+Stages record wall time, counts of items and bytes, peak memory and errors as JSON lines.
+Instrumentation is disabled by default and costs a single check per stage; it is enabled by
+setting environment variables before running a script or notebook, or by calling enable:
+
+    WARSAW_BUSES_METRICS=metrics.jsonl      file the records are appended to
+    WARSAW_BUSES_TRACE_MEMORY=1             peak Python heap per stage (tracemalloc, slow)
+    WARSAW_BUSES_PROFILE=profiles/          cProfile stats of every outermost stage
+
+Usage:
+
+    with stage("load", filepath=filepath) as current:
+        records = load(filepath)
+        current.add(items=len(records), bytes=os.path.getsize(filepath))
+"""
+
+import os
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from functools import wraps
+from itertools import count
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ENV_METRICS = "WARSAW_BUSES_METRICS"
+ENV_TRACE_MEMORY = "WARSAW_BUSES_TRACE_MEMORY"
+ENV_PROFILE = "WARSAW_BUSES_PROFILE"
+
+
+class Stage:
+    """
+    Counters of a running stage, written to the metrics file when the stage ends.
+    """
+
+    def __init__(self, name, parent, fields):
+        self.name = name
+        self.parent = parent
+        self.fields = fields
+        self.counts = {}
+        self.peak = 0
+
+    def add(self, **counts):
+        """
+        Adds to counters of the stage, e.g. add(items=100, bytes=4096).
+        """
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+
+class _NullStage:
+    """
+    Stage returned while instrumentation is disabled.
+    """
+
+    def add(self, **counts):
+        """
+        Ignores counters.
+        """
+
+
+NULL_STAGE = _NullStage()
+
+
+class Recorder:
+    """
+    Appends records of stages and events to a JSON lines file. Safe to use from many threads;
+    processes forked from an instrumented process append to the same file.
+    """
+
+    def __init__(self, filepath, trace_memory=False, profile_dir=None):
+        self.filepath = filepath
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = count()
+        self.started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def stack(self):
+        """
+        Returns stages running in the current thread, outermost first.
+        """
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def write(self, record):
+        """
+        Appends one record as a JSON line.
+        """
+        line = json.dumps(record, default=str) + "\n"
+        with self.lock, open(self.filepath, "a", encoding="utf-8") as metrics_file:
+            metrics_file.write(line)
+
+    @contextmanager
+    def stage(self, name, fields):
+        """
+        Measures a stage, see instrumentation.stage.
+        """
+        stack = self.stack()
+        current = Stage(name, stack[-1].name if stack else None, fields)
+        profiler = None
+        # cProfile can only profile one thread at a time, so only stages of the main thread
+        if self.profile_dir and not stack and \
+                threading.current_thread() is threading.main_thread():
+            profiler = cProfile.Profile()
+
+        if self.trace_memory:
+            # The peak is reset for every stage, so the peak seen so far is kept by the parent
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        stack.append(current)
+        error = None
+        started, start = time.time(), time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield current
+        except BaseException as err:
+            error = type(err).__name__
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            stack.pop()
+
+            record = {"stage": name, "parent": current.parent, "start": started,
+                      "seconds": seconds, **current.counts, **current.fields, "pid": os.getpid()}
+            if self.trace_memory:
+                current.peak = max(current.peak, tracemalloc.get_traced_memory()[1])
+                record["peak_bytes"] = current.peak
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, current.peak)
+            if resource is not None:
+                record["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if error is not None:
+                record["error"] = error
+            if profiler is not None:
+                profile_path = os.path.join(
+                    self.profile_dir, f"{name}-{os.getpid()}-{next(self.profiles)}.prof")
+                profiler.dump_stats(profile_path)
+                record["profile"] = profile_path
+            self.write(record)
+
+
+_recorder = None
+
+
+def enable(filepath, trace_memory=False, profile_dir=None):
+    """
+    Enables instrumentation, appending records to filepath.
+
+    Parameters:
+    - filepath (str): Path of the JSON lines file.
+    - trace_memory (bool): Record peak Python heap of every stage with tracemalloc.
+    - profile_dir (str): Directory to save cProfile stats of outermost stages to.
+    """
+    disable()
+    global _recorder  # pylint: disable=global-statement
+    _recorder = Recorder(filepath, trace_memory, profile_dir)
+
+
+def disable():
+    """
+    Disables instrumentation.
+    """
+    global _recorder  # pylint: disable=global-statement
+    if _recorder is not None and _recorder.started_tracing:
+        tracemalloc.stop()
+    _recorder = None
+
+
+def is_enabled():
+    """
+    Checks if instrumentation is enabled.
+    """
+    return _recorder is not None
+
+
+def stage(name, **fields):
+    """
+    Context manager measuring a stage, e.g. "load", "validate", "group", "sort", "match",
+    "render" or "request". Fields are written with the record; the yielded Stage
+    collects counters with add.
+    """
+    if _recorder is None:
+        return _null_stage()
+    return _recorder.stage(name, fields)
+
+
+@contextmanager
+def _null_stage():
+    yield NULL_STAGE
+
+
+def event(name, **fields):
+    """
+    Records a single event, e.g. a failed attempt of a request.
+    """
+    if _recorder is not None:
+        _recorder.write({"event": name, "time": time.time(), **fields, "pid": os.getpid()})
+
+
+def instrumented(name):
+    """
+    Decorator measuring every call of a function as a stage.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _recorder.stage(name, {"function": function.__qualname__}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get(ENV_METRICS):
+    enable(os.environ[ENV_METRICS], bool(os.environ.get(ENV_TRACE_MEMORY)),
+           os.environ.get(ENV_PROFILE) or None)
@@ -15,5 +15,5 @@ setup(
     "License :: OSI Approved :: MIT License",
     "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.9',
 )
\ No newline at end of file
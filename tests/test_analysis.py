@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import datetime
+import tempfile
+import pytest
+import pandas as pd
+
+# Analysis scripts import their sibling modules directly, as when run from data_analysis
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "data_analysis"))
+
+# pylint: disable=wrong-import-position
+from bus_fixes import BusFixes, load_bus_fixes
+from bus_speeding import get_speeding_buses, calculate_speeding, SpeedingGrid, SPEED_LIMIT
+from punctuality import get_stop_passages, get_bus_locations, join_schedule, calculate_delays, calculate_delays_batch
+from timetable import CompiledTimetable, load_timetable
+from bus_stop_criticality import aggregate_scheduled_stops, calculate_bus_stop_criticality,\
+    generate_criticality_map
+from snapshot import ScheduleTable
+from utils import StopGrid, DelayStats
+from benchmarks.synthetic import generate_city
+
+START = datetime.datetime(2024, 2, 19, 8, 0, 0)
+
+def fix(vehicle_number, seconds, lat, lon, line='119'):
+    return {'VehicleNumber': vehicle_number, 'Lines': line, 'Brigade': '1',
+            'Time': (START + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S'),
+            'Lat': lat, 'Lon': lon}
+
+def test_step_jump_is_not_speeding():
+    # The vehicle jumps 10 km within 30 s and stays there, then drives at about 60 km/h
+    records = [fix('1000', 30 * i, 52.2 + (0.09 if i >= 3 else 0.0), 21.0) for i in range(6)]
+    records.append(fix('1000', 180, 52.2 + 0.09 + 0.0045, 21.0))
+
+    bus_to_data = {'1000': [dict(record, Time=datetime.datetime.strptime(
+        record['Time'], '%Y-%m-%d %H:%M:%S')) for record in records]}
+    [point] = get_speeding_buses(bus_to_data)
+    assert point['Time'] == START + datetime.timedelta(seconds=150)
+
+    [point] = get_speeding_buses(BusFixes.from_records(records))
+    assert point['Speed'] == pytest.approx(60.0, rel=0.01)
+
+def test_bus_fixes_skip_invalid_locations():
+    records = [fix('1000', 0, 52.2, 21.0), {'VehicleNumber': '1000', 'Time': 'bad', 'Lat': None},
+               dict(fix('1000', 30, 52.2, 21.0), Lat=None),
+               dict(fix('1000', 60, 52.2, 21.0), Lon='x'),
+               {key: value for key, value in fix('1001', 0, 52.2, 21.0).items() if key != 'Lat'}]
+
+    fixes = BusFixes.from_records(records)
+    assert len(fixes) == 1 and fixes.vehicle_count == 1
+    assert fixes.records([0])[0]['Time'] == START
+
+def test_speeding_points_carry_speed_of_their_segment():
+    # The first segment of the vehicle is over the limit, at about 100 km/h
+    records = [fix('1000', 0, 52.2, 21.0), fix('1000', 30, 52.2075, 21.0),
+               fix('1000', 60, 52.2076, 21.0)]
+    bus_to_data = {'1000': [dict(record, Time=datetime.datetime.strptime(
+        record['Time'], '%Y-%m-%d %H:%M:%S')) for record in records]}
+
+    [point] = get_speeding_buses(bus_to_data)
+    [expected] = get_speeding_buses(BusFixes.from_records(records))
+    assert point['Time'] == START
+    assert point['Speed'] == pytest.approx(expected['Speed']) and point['Speed'] > 90.0
+
+    grid = SpeedingGrid.from_points([point])
+    assert grid.severities.tolist() == pytest.approx([point['Speed'] - SPEED_LIMIT])
+
+def test_stop_passages_not_invented_across_gaps():
+    # The bus stop lies halfway between fixes 1 km apart
+    stop_grid = StopGrid({('7009', '01'): (52.2045, 21.0)})
+    for gap, passages in ((120, 1), (1800, 0)):
+        fixes = BusFixes.from_records([fix('1000', 0, 52.2, 21.0), fix('1000', gap, 52.209, 21.0)])
+        stop_passages = get_stop_passages(fixes, stop_grid)
+        assert len(stop_passages.get(('119', ('7009', '01')), [])) == passages
+
+def parsed(records):
+    return [dict(record, Time=datetime.datetime.strptime(record['Time'], '%Y-%m-%d %H:%M:%S'))
+            for record in records]
+
+def test_bus_fixes_round_trip_records():
+    records = [fix('1000', 0, 52.2, 21.0), fix('1000', 30, 52.21, 21.01, line='520'),
+               fix('999', 60, 52.3, 20.9, line='N01')]
+
+    fixes = BusFixes.from_records(records)
+    assert len(fixes) == 3
+    assert sorted(fixes.records(range(len(fixes))), key=lambda record: record['Time']) == \
+        parsed(records)
+
+def test_bus_fixes_grouped_by_vehicle_and_time():
+    records = [fix('1001', 60, 52.2, 21.0), fix('1000', 30, 52.2, 21.0),
+               fix('1001', 0, 52.2, 21.0), fix('1000', 0, 52.2, 21.0), fix('1001', 30, 52.2, 21.0)]
+
+    fixes = BusFixes.from_records(records)
+    assert fixes.vehicles.tolist() == ['1000', '1001']
+    assert fixes.offsets.tolist() == [0, 2, 5]
+    for vehicle_code, vehicle in enumerate(fixes.vehicles.tolist()):
+        vehicle_records = fixes.records(range(len(fixes))[fixes.vehicle_slice(vehicle_code)])
+        assert [record['VehicleNumber'] for record in vehicle_records] == [vehicle] * \
+            len(vehicle_records)
+        assert fixes.times[fixes.vehicle_slice(vehicle_code)].tolist() == \
+            sorted(fixes.times[fixes.vehicle_slice(vehicle_code)].tolist())
+
+def test_bus_fixes_skip_invalid_entries():
+    records = [fix('1000', 0, 52.2, 21.0), fix('1000', 0, 52.2, 21.0), 'not a dict', None,
+               dict(fix('1000', 30, 52.2, 21.0), Time='2024-02-19 08:00'),
+               {'VehicleNumber': '1000', 'Lat': 52.2, 'Lon': 21.0}, fix('1000', 60, 52.2, 21.0)]
+
+    fixes = BusFixes.from_records(records)
+    assert [record['Time'] for record in fixes.records(range(len(fixes)))] == \
+        [START, START + datetime.timedelta(seconds=60)]
+
+def test_bus_fixes_snapshot(tmpdir):
+    records = [fix('1000', 0, 52.2, 21.0), fix('1001', 30, 52.21, 21.01, line='520'),
+               fix('1000', 60, 52.22, 21.02)]
+    fixes = BusFixes.from_records(records)
+    dirpath = os.path.join(tmpdir.strpath, 'bus-locations.snapshot')
+    fixes.save(dirpath)
+
+    loaded = load_bus_fixes(dirpath)
+    assert len(loaded) == len(fixes) and loaded.vehicle_count == fixes.vehicle_count
+    assert loaded.records(range(len(loaded))) == fixes.records(range(len(fixes)))
+
+    window = (START + datetime.timedelta(seconds=30), None)
+    assert [(record['VehicleNumber'], record['Time'])
+            for record in load_bus_fixes(dirpath, window).records([0, 1])] == \
+        [('1000', START + datetime.timedelta(seconds=60)),
+         ('1001', START + datetime.timedelta(seconds=30))]
+
+def test_timetable_window_across_midnight():
+    timetable = CompiledTimetable.build({'7009,01,119': ['23:55:00', '24:05:00', '05:00:00'],
+                                         '7009,02,N01': ['00:03:00', '23:50:00']})
+    start = datetime.datetime(2024, 2, 19, 23, 58, 0, 500000)
+    spans = timetable.window(start, start + datetime.timedelta(minutes=10))
+
+    # 24:05:00 of the previous service day falls past midnight of the next calendar day
+    assert timetable.window_times(spans, 0) == [datetime.datetime(2024, 2, 20, 0, 5)]
+    assert timetable.window_times(spans, 1) == [datetime.datetime(2024, 2, 20, 0, 3)]
+
+def test_timetable_cache_rebuilt_when_source_changes(tmpdir):
+    filepath = os.path.join(tmpdir.strpath, 'bus-schedules.json')
+    with open(filepath, 'w', encoding='utf-8') as json_file:
+        json.dump({'7009,01,119': ['08:00:00']}, json_file)
+    assert load_timetable(tmpdir.strpath).keys.tolist() == ['7009,01,119']
+    assert os.path.isdir(os.path.join(tmpdir.strpath, 'bus-schedules.compiled'))
+
+    with open(filepath, 'w', encoding='utf-8') as json_file:
+        json.dump({'7009,01,119': ['08:00:00'], '7009,02,520': ['09:00:00']}, json_file)
+    timetable = load_timetable(tmpdir.strpath)
+    assert timetable.keys.tolist() == ['7009,01,119', '7009,02,520']
+    assert timetable.times.tolist() == [8 * 3600, 9 * 3600]
+
+def test_calculate_delays_batch_matches_sequential(tmpdir, monkeypatch):
+    data_dir = tmpdir.strpath
+    # Record temporary directories for snapshots created by the batch
+    temporary_dirs = []
+    make_temporary_dir = tempfile.TemporaryDirectory
+
+    def record_temporary_dir(**kwargs):
+        temporary_dirs.append(kwargs)
+        return make_temporary_dir(**kwargs)
+    monkeypatch.setattr(tempfile, 'TemporaryDirectory', record_temporary_dir)
+    city = generate_city(data_dir, vehicles=48, hours=0.25)
+    captures = [(city['capture'], city['download_time']),
+                (city['capture'], city['download_time'] + datetime.timedelta(minutes=5))]
+
+    expected_stats = DelayStats()
+    expected = [delay for filepath, download_time in captures
+                for delay in calculate_delays(data_dir, filepath, download_time, expected_stats)]
+    assert expected
+    for line_shards in (1, 3):
+        stats = DelayStats()
+        delays = calculate_delays_batch(data_dir, captures, processes=2, line_shards=line_shards,
+                                        stats=stats)
+        assert sorted(delays) == sorted(expected)
+        # Statistics of shards and captures merge into those of the sequential runs
+        for dimension in DelayStats.DIMENSIONS:
+            summary, expected_summary = stats.summary(dimension), expected_stats.summary(dimension)
+            assert sorted(summary) == sorted(expected_summary)
+            for key, values in expected_summary.items():
+                assert summary[key] == pytest.approx(values)
+    # Only sharded captures are snapshotted, outside of data_dir
+    assert len(temporary_dirs) == 1 and 'dir' not in temporary_dirs[0]
+
+SCHEDULES = {'7009,01,119': ['05:00:00', '05:30:00', '24:10:00'], '7009,01,520': ['05:10:00'],
+             '7009,02,119': ['bad', '23:00:00'], '1001,01,N01': []}
+
+def write_schedules(data_dir, schedules):
+    with open(os.path.join(data_dir, 'bus-schedules.json'), 'w', encoding='utf-8') as json_file:
+        json.dump(schedules, json_file)
+
+def test_aggregate_scheduled_stops_matches_dict_loop(tmpdir):
+    expected = {}
+    for sid, times in SCHEDULES.items():
+        bus_stop_id, bus_stop_nr, _ = sid.split(',')
+        expected[(bus_stop_id, bus_stop_nr)] = expected.get((bus_stop_id, bus_stop_nr), 0) + \
+            len(times)
+
+    stops, totals, hourly = aggregate_scheduled_stops(ScheduleTable.from_schedules(SCHEDULES))
+    assert dict(zip((tuple(stop.split(',')) for stop in stops.tolist()), totals.tolist())) == \
+        expected
+    assert hourly.sum(axis=1).tolist() == [0, 4, 1]
+
+    write_schedules(tmpdir.strpath, SCHEDULES)
+    assert calculate_bus_stop_criticality(tmpdir.strpath) == expected
+    by_hour = calculate_bus_stop_criticality(tmpdir.strpath, by_hour=True)
+    assert by_hour[('7009', '01')][:6] == [1, 0, 0, 0, 0, 3]
+
+def test_criticality_cache_rebuilt_when_source_changes(tmpdir):
+    write_schedules(tmpdir.strpath, {'7009,01,119': ['05:00:00']})
+    assert calculate_bus_stop_criticality(tmpdir.strpath) == {('7009', '01'): 1}
+    assert os.path.isdir(os.path.join(tmpdir.strpath, 'bus-stop-criticality.snapshot'))
+
+    write_schedules(tmpdir.strpath, SCHEDULES)
+    assert calculate_bus_stop_criticality(tmpdir.strpath) == \
+        {('1001', '01'): 0, ('7009', '01'): 4, ('7009', '02'): 2}
+
+def test_join_schedule_fills_stats():
+    schedules = {'7009,01,119': ['08:05:00', '08:10:00', '08:15:00', '08:20:00'],
+                 '7009,02,119': ['08:06:00']}
+    arrivals = [START + datetime.timedelta(minutes=minutes, seconds=seconds)
+                for minutes, seconds in ((3, 0), (10, 30), (17, 0))]
+    stop_arrivals = {('119', ('7009', '01')): arrivals}
+
+    stats = DelayStats()
+    delays = join_schedule(schedules, stop_arrivals, {'119'}, START, progress=False, stats=stats)
+
+    # 08:05 departs 2 minutes early, 08:10 on time, 08:15 exactly 2 minutes late, 08:20 never
+    assert delays == [('119', '7009', START + datetime.timedelta(minutes=15),
+                       datetime.timedelta(minutes=2))]
+    summary = stats.summary('line')['119']
+    assert summary['count'] == 3
+    assert summary['early'] == pytest.approx(1 / 3) and summary['late'] == pytest.approx(1 / 3)
+    assert summary['mean'] == pytest.approx((-120 + 30 + 120) / 3)
+    assert list(stats.summary('stop')) == ['7009,01'] and list(stats.summary('hour')) == [8]
+
+def test_stale_fixes_dropped_for_the_measurement_window(tmpdir):
+    # Vehicle 1001 reports fixes from two hours after the one-hour measurement window
+    records = [fix('1000', 0, 52.2, 21.0), fix('1000', 30, 52.2045, 21.0),
+               fix('1001', 3 * 3600, 52.2, 21.0), fix('1001', 3 * 3600 + 30, 52.2045, 21.0)]
+
+    for buses_data in (records, BusFixes.from_records(records)):
+        bus_locations = get_bus_locations(buses_data, START)
+        assert [time for time, _ in bus_locations['119']] == \
+            [START, START + datetime.timedelta(seconds=30)]
+
+    filepath = os.path.join(tmpdir.strpath, 'bus-locations.json')
+    with open(filepath, 'w', encoding='utf-8') as json_file:
+        json.dump(records, json_file)
+    assert [point['VehicleNumber'] for point in calculate_speeding(filepath, START)] == ['1000']
+
+def test_criticality_of_empty_schedules(tmpdir):
+    stops, totals, hourly = aggregate_scheduled_stops(ScheduleTable.from_schedules({}))
+    assert len(stops) == len(totals) == 0 and hourly.shape == (0, 24)
+
+    write_schedules(tmpdir.strpath, {})
+    assert calculate_bus_stop_criticality(tmpdir.strpath) == {}
+    # Served from the cache the second time
+    assert calculate_bus_stop_criticality(tmpdir.strpath, by_hour=True) == {}
+
+    data_frame = pd.DataFrame({"Bus stop": [], "Number of scheduled stops": [],
+                               "Latitude": [], "Longitude": []})
+    assert generate_criticality_map(data_frame).get_root().render()
@@ -1,15 +1,30 @@
+import json
 import datetime
 from unittest.mock import MagicMock
+import numpy as np
 import pytest
 from data_analysis.utils import (
     haversine_distance,
+    haversine_distances,
     get_coords,
     get_time,
     calculate_distance,
     calculate_speed,
+    calculate_speeds,
     validate_datetime_format,
     validate_time_format,
     is_at_stop,
+    StopGrid,
+    find_passages,
+    find_outliers,
+    DelayStats,
+    iter_bus_records,
+    iter_json_array,
+    parse_datetimes,
+    parse_times,
+    to_seconds,
+    save_arrays,
+    load_arrays,
 )
 
 EPS = 1e-6  # A small epsilon for floating-point comparisons
@@ -29,6 +44,15 @@ def test_haversine_distance():
     distance = haversine_distance(coord1, coord2)
     assert distance == pytest.approx(0, EPS)  # Approximate square root of 2 times 1000
 
+def test_haversine_distances():
+    lats = np.array([52.2297, 52.2297, 52.4064])
+    lons = np.array([21.0122, 21.0122, 16.9252])
+    distances = haversine_distances(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    assert distances[0] == pytest.approx(0, EPS)
+    assert distances[1] == pytest.approx(279_000, rel=1e-2)  # Warsaw - Poznan
+    assert distances[1] == pytest.approx(haversine_distance((lats[1], lons[1]),
+                                                            (lats[2], lons[2])))
+
 def test_get_coords(bus_data):
     coords = get_coords(bus_data)
     assert coords == (52.5200, 13.4050)
@@ -52,6 +76,14 @@ def test_calculate_speed(bus_data):
     speed = calculate_speed(bus_data, bus_data2)
     assert speed == pytest.approx(0, EPS)  # Approximate speed in km/h
 
+def test_calculate_speeds():
+    speeds = calculate_speeds([52.2300, 52.2310, 52.2310, 52.2320],
+                              [21.0100, 21.0100, 21.0100, 21.0100],
+                              [0.0, 10.0, 10.0, 20.0])
+    assert speeds[0] == pytest.approx(11.119 * 3.6, rel=1e-3)
+    assert np.isnan(speeds[1])  # Zero time difference
+    assert speeds[2] == pytest.approx(speeds[0])
+
 def test_validate_datetime_format():
     assert validate_datetime_format('2024-02-18 12:00:00')
     assert not validate_datetime_format('2024-02-18 12:00')  # Missing seconds
@@ -62,8 +94,144 @@ def test_validate_time_format():
     assert not validate_time_format('12:00')  # Missing seconds
     assert not validate_time_format('12:00:00 AM')  # Incorrect format
 
+def test_parse_datetimes():
+    seconds, valid = parse_datetimes(['2024-02-18 12:00:00', '2024-02-29 23:59:59',
+                                      '2023-02-29 12:00:00', '2024-02-18 24:00:00',
+                                      '2024-02-18 12:00', None])
+    assert valid.tolist() == [True, True, False, False, False, False]
+    assert seconds[0] == to_seconds(datetime.datetime(2024, 2, 18, 12, 0, 0))
+    assert seconds[1] == to_seconds(datetime.datetime(2024, 2, 29, 23, 59, 59))
+
+def test_parse_times():
+    seconds, valid = parse_times(['00:00:00', '23:59:59', '24:10:00', '12:00:00 AM'])
+    assert valid.tolist() == [True, True, False, False]
+    assert seconds[:2].tolist() == [0, 86399]
+
+    seconds, valid = parse_times(['24:10:00'], max_hour=47)
+    assert valid.tolist() == [True]
+    assert seconds.tolist() == [87000]
+
 def test_is_at_stop():
     bus_loc = (52.5200, 13.4050)
     bus_stop_loc = (52.5200, 13.4050)
     assert is_at_stop(bus_loc, bus_stop_loc)
-    assert not is_at_stop(bus_loc, (52.5400, 13.4200))  # Bus is not close enough
\ No newline at end of file
+    assert not is_at_stop(bus_loc, (52.5400, 13.4200))  # Bus is not close enough
+
+def test_stop_grid_matches_is_at_stop():
+    bus_stops_to_locations = {
+        ('1001', '01'): ('52.2300', '21.0100'),
+        ('1001', '02'): ('52.2310', '21.0100'),
+        ('1002', '01'): ('52.2400', '21.0300'),
+    }
+    grid = StopGrid(bus_stops_to_locations)
+    for bus_loc in [(52.2300, 21.0100), (52.2305, 21.0125), (52.2390, 21.0290), (52.3, 21.2)]:
+        expected = sorted(stop for stop, loc in bus_stops_to_locations.items()
+                          if is_at_stop(bus_loc, loc))
+        assert sorted(grid.query(bus_loc)) == expected
+
+
+def test_find_passages_interpolates_between_fixes():
+    grid = StopGrid({('1', '01'): (52.2, 21.0)})
+    # Fixes 600 m apart on both sides of the stop, none of them within the radius
+    lats = np.full(3, 52.2)
+    lons = np.array([21.0 - 0.0132, 21.0 - 0.0044, 21.0 + 0.0044])
+    times = np.array([0.0, 60.0, 120.0])
+    [(start, bus_stop, entered, nearest, left, distance)] = find_passages(lats, lons, times,
+                                                                           np.array([0]), grid)
+    assert start == 0 and bus_stop == ('1', '01')
+    assert entered < nearest < left
+    assert abs(nearest - 90.0) < 1e-6
+    assert distance < 1e-6
+
+
+def test_find_outliers_reports_each_rule():
+    # Two trajectories: a GPS spike at index 2, a fix outside Warsaw at index 4,
+    # and a stale fix at index 5
+    lats = np.array([52.20, 52.201, 52.60, 52.203, 54.0, 52.2, 52.2, 52.201])
+    lons = np.array([21.00, 21.001, 21.00, 21.003, 21.0, 21.0, 21.0, 21.001])
+    times = np.array([0, 60, 120, 180, 240, -3600, 3000, 3060])
+    outliers = find_outliers(lats, lons, times, np.array([0, 5]), time_window=(0, 3600))
+    assert np.flatnonzero(outliers['jump']).tolist() == [2]
+    assert np.flatnonzero(outliers['bounds']).tolist() == [4]
+    assert np.flatnonzero(outliers['stale']).tolist() == [5]
+
+
+def test_iter_bus_records_reads_json_and_ndjson(tmpdir):
+    records = [{'VehicleNumber': '1000', 'Lines': '119'}, {'VehicleNumber': '1001', 'Lines': '119'}]
+    json_path = tmpdir.join('bus-locations.json')
+    json_path.write(json.dumps(records))
+    ndjson_path = tmpdir.join('bus-locations.ndjson')
+    # Last line truncated as after a crash during capture
+    ndjson_path.write(''.join(json.dumps(record) + '\n' for record in records) + '{"Vehicle')
+
+    assert list(iter_bus_records(json_path.strpath)) == records
+    assert list(iter_bus_records([json_path.strpath, ndjson_path.strpath])) == records + records
+
+
+def test_iter_json_array_across_chunks(tmpdir):
+    data = [{'VehicleNumber': '1000', 'Time': '2024-02-18 20:12:43', 'Lat': 52.25},
+            {'Nested': {'a': [1, {}]}, 'Text': '},{'}, 2.5, -1e-3, None, [], 'x']
+    for text in (json.dumps(data), json.dumps(data, indent=2), '[]', ' [ ] '):
+        for chunk_size in (1, 3, 7, 1000):
+            path = tmpdir.join('data.json')
+            path.write(text)
+            with open(path.strpath, encoding='utf-8') as data_file:
+                assert list(iter_json_array(data_file, chunk_size)) == json.loads(text)
+
+    for text in ('[1 2]', '[{}, {},]', '[{"a": 1}'):
+        path.write(text)
+        with open(path.strpath, encoding='utf-8') as data_file, \
+                pytest.raises(json.JSONDecodeError):
+            list(iter_json_array(data_file, 2))
+
+    # Records outside the time window are skipped while reading
+    path.write(json.dumps(data))
+    window = (datetime.datetime(2024, 2, 18, 20, 12, 43), None)
+    assert list(iter_bus_records(path.strpath, window)) == data[:1]
+    assert list(iter_bus_records(path.strpath, (None, window[0] - datetime.timedelta(1)))) == []
+
+
+def test_save_and_load_arrays(tmpdir):
+    dirpath = tmpdir.join('bus-locations.snapshot').strpath
+    arrays = {'lats': np.array([52.23, 52.24]), 'lines': np.array(['119', '213'])}
+    save_arrays(dirpath, arrays, {'format': 'test'})
+
+    loaded, meta = load_arrays(dirpath)
+    assert meta['format'] == 'test'
+    assert isinstance(loaded['lats'], np.memmap)
+    assert loaded['lats'].tolist() == [52.23, 52.24]
+    assert loaded['lines'].tolist() == ['119', '213']
+
+
+def test_delay_stats_summary_and_merge(tmpdir):
+    rng = np.random.default_rng(0)
+    delays = rng.normal(60.0, 120.0, 1000)
+    lines = ['119' if i % 2 else '180' for i in range(1000)]
+    stops = ['7009,01'] * 1000
+    hours = [8 + i % 3 for i in range(1000)]
+
+    whole = DelayStats()
+    whole.add(lines, stops, hours, delays)
+    first, second = DelayStats(), DelayStats()
+    first.add(lines[:300], stops[:300], hours[:300], delays[:300])
+    second.add(lines[300:], stops[300:], hours[300:], delays[300:])
+    merged = first.merge(second)
+
+    summary = whole.summary('stop')['7009,01']
+    # Histograms of merged parts equal those of one pass, sums differ only by rounding
+    for dimension in DelayStats.DIMENSIONS:
+        assert merged.keys[dimension] == whole.keys[dimension]
+        assert np.array_equal(merged.counts[dimension], whole.counts[dimension])
+        assert merged.sums[dimension] == pytest.approx(whole.sums[dimension])
+    assert summary['count'] == 1000
+    assert summary['mean'] == pytest.approx(delays.mean())
+    assert summary['early'] == pytest.approx(np.mean(delays < -60))
+    assert summary['late'] == pytest.approx(np.mean(delays >= 120))
+    assert summary['early'] + summary['on_time'] + summary['late'] == pytest.approx(1.0)
+    # Quantiles are accurate to the width of histogram bins
+    assert summary['p50'] == pytest.approx(np.quantile(delays, 0.5), abs=DelayStats.BIN_WIDTH)
+    assert summary['p90'] == pytest.approx(np.quantile(delays, 0.9), abs=DelayStats.BIN_WIDTH)
+    assert sorted(whole.summary('hour')) == [8, 9, 10]
+
+    whole.save(tmpdir.join('stats').strpath)
+    assert DelayStats.load(tmpdir.join('stats').strpath).summary('hour') == whole.summary('hour')
@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import secrets
+import importlib
+from datetime import datetime, timedelta
+import pytest
+
+DATA_FETCHING_DIR = os.path.join(os.path.dirname(__file__), "..", "data_fetching")
+
+# Fetching scripts import their sibling modules directly, as when run from data_fetching
+sys.path.insert(0, DATA_FETCHING_DIR)
+
+# pylint: disable=wrong-import-position
+import data_fetching.utils as fetch_utils
+from crawl_state import CrawlState
+
+@pytest.fixture
+def bus_schedule(monkeypatch):
+    # The script imports its sibling utils module and API_KEY from the local secrets.py
+    monkeypatch.syspath_prepend(DATA_FETCHING_DIR)
+    monkeypatch.setitem(sys.modules, 'utils', fetch_utils)
+    monkeypatch.setattr(secrets, 'API_KEY', 'test-key', raising=False)
+    monkeypatch.delitem(sys.modules, 'bus_schedule', raising=False)
+    yield importlib.import_module('bus_schedule')
+    sys.modules.pop('bus_schedule', None)
+
+class FakeResponse:
+    def __init__(self, result):
+        self.result = result
+
+    def json(self):
+        return {'result': self.result}
+
+def stop_values(*pairs):
+    return {'values': [{'key': key, 'value': value} for key, value in pairs]}
+
+def test_interrupted_download_resumes(bus_schedule, monkeypatch, tmpdir):
+    data_dir = tmpdir.strpath
+    calls = {'bus-lines': 0, 'schedule': 0}
+    interrupt = [True]
+
+    def get_bus_lines_stopping(bus_stop_id, bus_stop_nr, client=None):
+        calls['bus-lines'] += 1
+        return FakeResponse([stop_values(('linia', '119'))])
+
+    def get_bus_schedule(bus_stop_id, bus_stop_nr, bus_line, client=None):
+        calls['schedule'] += 1
+        if interrupt[0]:
+            raise KeyboardInterrupt
+        return FakeResponse([stop_values(('brygada', '1'), ('czas', '05:00:00'))])
+
+    monkeypatch.setattr(bus_schedule, 'get_bus_stops', lambda client=None: FakeResponse(
+        [stop_values(('zespol', '1000'), ('slupek', '01')),
+         stop_values(('zespol', '1001'), ('slupek', '02'))]))
+    monkeypatch.setattr(bus_schedule, 'get_bus_lines_stopping', get_bus_lines_stopping)
+    monkeypatch.setattr(bus_schedule, 'get_bus_schedule', get_bus_schedule)
+
+    bus_schedule.download_data(data_dir, max_workers=1, max_rate=None)
+
+    # Interrupted during schedules: the checkpoint keeps the downloaded bus lines
+    state = CrawlState(os.path.join(data_dir, 'crawl-state.sqlite'))
+    assert len(state.items('bus-lines')) == 2
+    download_time = state.get('meta', 'download_time')
+    state.close()
+
+    interrupt[0] = False
+    bus_schedule.download_data(data_dir, max_workers=1, max_rate=None)
+
+    assert calls['bus-lines'] == 2
+    with open(os.path.join(data_dir, f"bus-schedules-{download_time}.json"),
+              encoding='utf-8') as json_file:
+        assert json.load(json_file) == {'1000,01,119': ['05:00:00'], '1001,02,119': ['05:00:00']}
+    state = CrawlState(os.path.join(data_dir, 'crawl-state.sqlite'))
+    assert state.items('bus-lines') == {}
+    state.close()
+
+def test_incremental_download_refreshes_old_schedules(bus_schedule, monkeypatch, tmpdir):
+    data_dir = tmpdir.strpath
+    version = '2024-01-01 00:00:00'
+    recent = str(datetime.now() - timedelta(days=1))
+    bus_stops = {'result': [stop_values(('zespol', '1000'), ('slupek', '01')),
+                            stop_values(('zespol', '1001'), ('slupek', '02'))]}
+    previous = {'bus-stops': bus_stops,
+                'bus-stops-to-bus-lines': {'1000,01': ['119'], '1001,02': ['119']},
+                'bus-schedules': {'1000,01,119': ['04:00:00'], '1001,02,119': ['04:00:00']},
+                'schedule-fetch-times': {'1000,01,119': version, '1001,02,119': recent}}
+    for name, data in previous.items():
+        fetch_utils.save_data(data, data_dir, f"{name}-{version}.json")
+
+    fetched = []
+
+    def get_bus_schedule(bus_stop_id, bus_stop_nr, bus_line, client=None):
+        fetched.append(f"{bus_stop_id},{bus_stop_nr},{bus_line}")
+        return FakeResponse([stop_values(('brygada', '1'), ('czas', '05:00:00'))])
+
+    monkeypatch.setattr(bus_schedule, 'get_bus_stops', lambda client=None: FakeResponse(
+        bus_stops['result']))
+    monkeypatch.setattr(bus_schedule, 'get_bus_lines_stopping', lambda *args, client=None:
+                        FakeResponse([stop_values(('linia', '119'))]))
+    monkeypatch.setattr(bus_schedule, 'get_bus_schedule', get_bus_schedule)
+
+    bus_schedule.download_data(data_dir, max_workers=1, max_rate=None)
+
+    # Only the schedule downloaded more than a week ago is downloaded again
+    assert fetched == ['1000,01,119']
+    download_time = fetch_utils.find_latest_snapshot(data_dir)
+    _, _, schedules = fetch_utils.load_snapshot(data_dir, download_time)
+    assert schedules == {'1000,01,119': ['05:00:00'], '1001,02,119': ['04:00:00']}
+    with open(os.path.join(data_dir, f"schedule-fetch-times-{download_time}.json"),
+              encoding='utf-8') as json_file:
+        assert json.load(json_file) == {'1000,01,119': download_time, '1001,02,119': recent}
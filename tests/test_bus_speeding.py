@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+import secrets
+import importlib
+import pytest
+
+DATA_FETCHING_DIR = os.path.join(os.path.dirname(__file__), "..", "data_fetching")
+
+# Fetching scripts import their sibling modules directly, as when run from data_fetching
+sys.path.insert(0, DATA_FETCHING_DIR)
+
+# pylint: disable=wrong-import-position
+import data_fetching.utils as fetch_utils
+
+@pytest.fixture
+def bus_speeding(monkeypatch):
+    # The script imports its sibling utils module and API_KEY from the local secrets.py
+    monkeypatch.syspath_prepend(DATA_FETCHING_DIR)
+    monkeypatch.setitem(sys.modules, 'utils', fetch_utils)
+    monkeypatch.setattr(secrets, 'API_KEY', 'test-key', raising=False)
+    monkeypatch.delitem(sys.modules, 'bus_speeding', raising=False)
+    yield importlib.import_module('bus_speeding')
+    sys.modules.pop('bus_speeding', None)
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        if isinstance(self.body, str):
+            raise ValueError(f"invalid JSON: {self.body}")
+        return self.body
+
+def test_download_survives_invalid_responses(bus_speeding, monkeypatch, tmpdir):
+    fix = {'VehicleNumber': '1000', 'Lines': '119', 'Brigade': '1',
+           'Lat': 52.2, 'Lon': 21.0, 'Time': '2024-02-18 20:12:00'}
+    responses = iter([FakeResponse('<html>Service Unavailable</html>'), FakeResponse({}),
+                      FakeResponse([fix]), FakeResponse({'result': [fix]})])
+    monkeypatch.setattr(bus_speeding, 'get_available_buses', lambda: next(responses))
+
+    bus_speeding.download_data(tmpdir.strpath, iterations=4, interval=0.02,
+                               on_speeding=lambda events: None)
+
+    [filename] = [name for name in os.listdir(tmpdir.strpath)
+                  if name.startswith('bus-locations')]
+    with open(os.path.join(tmpdir.strpath, filename), encoding='utf-8') as ndjson_file:
+        assert [json.loads(line) for line in ndjson_file] == [fix]
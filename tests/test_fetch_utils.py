@@ -1,11 +1,100 @@
 import os
+import sys
 import json
+import datetime
+import threading
+from time import sleep, monotonic, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch, MagicMock
 import requests
 import pytest
 from requests.exceptions import ConnectionError, RequestException
 
-from data_fetching.utils import send_request, save_data
+# Fetching scripts import their sibling modules directly, as when run from data_fetching
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "data_fetching"))
+
+# pylint: disable=wrong-import-position
+from data_fetching.utils import (
+    send_request,
+    save_data,
+    fetch_concurrently,
+    ApiClient,
+    RateLimiter,
+    diff_schedule_keys,
+    find_latest_snapshot,
+    NdjsonWriter,
+    FixDeduplicator,
+)
+from retry import RetryPolicy, CircuitBreaker
+from cache import ResponseCache
+from crawl_state import CrawlState
+from live import PollScheduler, SpeedingDetector, LivePositions, LiveDaemon
+from data_analysis.utils import calculate_speed
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Base of handlers of stub_server, sharing the state dict yielded by the fixture
+    @property
+    def state(self):
+        return self.server.state
+
+    def send_body(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class EchoHandler(StubHandler):
+    # Answers every POST with the request path, counting requests in flight
+    def do_POST(self):
+        with self.server.lock:
+            self.state['in_flight'] += 1
+            self.state['max_in_flight'] = max(self.state['max_in_flight'],
+                                              self.state['in_flight'])
+        sleep(0.01)
+        self.send_body(200, json.dumps({'result': self.path}).encode(),
+                       {'Content-Type': 'application/json'})
+        with self.server.lock:
+            self.state['in_flight'] -= 1
+
+class PollsHandler(StubHandler):
+    # Answers every POST with the next poll of bus locations in state['polls']
+    def do_POST(self):
+        self.send_body(200, json.dumps({'result': next(self.state['polls'], [])}).encode())
+
+class FlakyHandler(StubHandler):
+    # Answers /flaky with 503 and Retry-After twice, then 200; /missing is a permanent 404
+    def do_POST(self):
+        calls = self.state['calls']
+        calls[self.path] += 1
+        status = 404 if self.path == '/missing' else 503 if calls['/flaky'] <= 2 else 200
+        self.send_body(status, b'{}', {'Retry-After': '0'} if status == 503 else None)
+
+class EtagHandler(StubHandler):
+    # Sends an ETag and answers 304 to requests revalidating it
+    def do_POST(self):
+        self.state['calls'].append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_body(304)
+            return
+        self.send_body(200, json.dumps({'result': [self.path.split('?')[0]]}).encode(),
+                       {'ETag': '"v1"'})
+
+@pytest.fixture
+def stub_server(request):
+    # Local stub of the ZTM API; the handler class is passed with indirect parametrization
+    server = ThreadingHTTPServer(('127.0.0.1', 0), getattr(request, 'param', EchoHandler))
+    server.state = {'in_flight': 0, 'max_in_flight': 0}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", server.state
+    server.shutdown()
+    server.server_close()
 
 @pytest.fixture
 def mock_post_request_success():
@@ -59,3 +148,292 @@ def test_save_data(tmpdir):
         loaded_data = json.load(json_file)
 
     assert loaded_data == data
+
+
+def test_fetch_concurrently_with_stub_server(stub_server):
+    base_url, state = stub_server
+    client = ApiClient(max_workers=4)
+    paths = [f"/stop/{i}" for i in range(40)]
+
+    results = dict(fetch_concurrently(lambda path: send_request(base_url + path, client),
+                                      paths, client.max_workers))
+
+    assert {path: response.json()['result'] for path, response in results.items()} == \
+        {path: path for path in paths}
+    assert 1 < state['max_in_flight'] <= 4
+
+def test_rate_limiter_spacing():
+    rate_limiter = RateLimiter(max_rate=50)
+    start = monotonic()
+    for _ in range(11):
+        rate_limiter.wait()
+    assert monotonic() - start >= 0.19
+
+def test_crawl_state_persists_results(tmpdir):
+    filepath = os.path.join(tmpdir.strpath, 'crawl-state.sqlite')
+    state = CrawlState(filepath)
+    state.put('schedule', '1001,01,123', ['10:00:00', '10:15:00'])
+    state.close()
+
+    state = CrawlState(filepath)
+    assert state.get('schedule', '1001,01,123') == ['10:00:00', '10:15:00']
+    assert state.get('schedule', '1001,01,124') is None
+    assert state.items('schedule') == {'1001,01,123': ['10:00:00', '10:15:00']}
+
+    state.clear()
+    assert state.items('schedule') == {}
+    state.close()
+
+def test_diff_schedule_keys():
+    def bus_stops(*records):
+        return {'result': [{'values': [{'value': stop_id}, {'value': stop_nr}, {'value': name}]}
+                           for stop_id, stop_nr, name in records]}
+
+    old_bus_stops = bus_stops(('1001', '01', 'Kijowska'), ('1001', '02', 'Kijowska'))
+    new_bus_stops = bus_stops(('1001', '01', 'Kijowska'), ('1001', '02', 'Dworzec Wschodni'),
+                              ('1002', '01', 'Targowa'))
+    old_bus_lines = {'1001,01': ['123', '138'], '1001,02': ['138']}
+    new_bus_lines = {'1001,01': ['123', '138', '509'], '1001,02': ['138'], '1002,01': ['166']}
+
+    assert diff_schedule_keys(old_bus_stops, new_bus_stops, old_bus_lines, new_bus_lines) == \
+        {'1001,01,509', '1001,02,138', '1002,01,166'}
+
+def test_find_latest_snapshot(tmpdir):
+    data_dir = tmpdir.strpath
+    for version in ('2024-02-18 20:00:00', '2024-02-19 09:00:00'):
+        for name in ('bus-stops', 'bus-stops-to-bus-lines', 'bus-schedules'):
+            save_data({}, data_dir, f"{name}-{version}.json")
+    save_data({}, data_dir, "bus-schedules-2024-02-20 09:00:00.json")  # Incomplete snapshot
+
+    assert find_latest_snapshot(data_dir) == '2024-02-19 09:00:00'
+    assert find_latest_snapshot(data_dir, exclude='2024-02-19 09:00:00') == '2024-02-18 20:00:00'
+
+def test_ndjson_writer_appends_and_rotates(tmpdir):
+    writer = NdjsonWriter(tmpdir.strpath, 'bus-locations', max_bytes=100)
+    records = [{'VehicleNumber': str(i), 'Lines': '123'} for i in range(6)]
+    for i in range(0, 6, 2):
+        writer.write(records[i:i + 2])
+    writer.close()
+
+    assert len(writer.filepaths) > 1
+    loaded = []
+    for filepath in writer.filepaths:
+        with open(filepath, 'r') as ndjson_file:
+            loaded.extend(json.loads(line) for line in ndjson_file)
+    assert loaded == records
+
+def test_poll_scheduler_keeps_ticks_and_reports_missed():
+    interval = 0.05
+    starts = []
+    results = []
+
+    def task():
+        starts.append(time())
+        if len(starts) == 2:
+            sleep(2.5 * interval)  # Slow request spanning two ticks
+        return len(starts)
+
+    scheduler = PollScheduler(interval, iterations=8)
+    scheduler.run(task, results.append)
+
+    assert scheduler.fired + scheduler.missed == 8
+    assert scheduler.missed >= 2
+    assert results == list(range(1, scheduler.fired + 1))
+    # Polls start on ticks, not after the previous poll plus a delay
+    for start in starts:
+        offset = (start / interval) % 1
+        assert min(offset, 1 - offset) < 0.4
+
+def test_fix_deduplicator_drops_repeated_fixes():
+    deduplicator = FixDeduplicator()
+    poll1 = [{'VehicleNumber': '1000', 'Time': '2024-02-18 20:12:43'},
+             {'VehicleNumber': '1001', 'Time': '2024-02-18 20:12:54'}]
+    poll2 = [{'VehicleNumber': '1000', 'Time': '2024-02-18 20:12:43'},
+             {'VehicleNumber': '1001', 'Time': '2024-02-18 20:13:50'}]
+
+    assert list(deduplicator.filter(poll1)) == poll1
+    assert list(deduplicator.filter(poll2)) == poll2[1:]
+    assert deduplicator.ratio == pytest.approx(0.25)
+
+
+def test_speeding_detector_matches_calculate_speed():
+    events = []
+    detector = SpeedingDetector(speed_limit=50.0, sink=events.extend, max_idle=600.0)
+    fix1 = {'VehicleNumber': '1000', 'Lines': '119', 'Brigade': '1',
+            'Lat': 52.2, 'Lon': 21.0, 'Time': '2024-02-18 20:12:00'}
+    fix2 = {**fix1, 'Lat': 52.205, 'Time': '2024-02-18 20:12:30'}
+    fix3 = {**fix2, 'Lat': 52.2051, 'Time': '2024-02-18 20:13:30'}
+    other = {**fix1, 'VehicleNumber': '1001', 'Time': '2024-02-18 20:30:00'}
+
+    assert detector.process([fix1]) == []
+    [event] = detector.process([fix2])
+    assert detector.process([fix3]) == []
+    expected = calculate_speed(
+        *({**fix, 'Time': datetime.datetime.strptime(fix['Time'], '%Y-%m-%d %H:%M:%S')}
+          for fix in (fix1, fix2)))
+    assert event['Speed'] == pytest.approx(expected)
+    assert event['Time'] == fix1['Time'] and events == [event]
+
+    # Vehicle 1000 is idle for longer than max_idle and is forgotten
+    detector.process([other])
+    assert list(detector.last_fixes) == ['1001']
+
+
+@pytest.mark.parametrize('stub_server', [PollsHandler], indirect=True)
+def test_live_daemon_serves_queries_from_stub_ztm(stub_server):
+    # The stub of the ZTM endpoint returns the next poll of two vehicles
+    base_url, state = stub_server
+    state['polls'] = iter([
+        [{'VehicleNumber': '1000', 'Lines': '119', 'Brigade': '1',
+          'Lat': 52.2, 'Lon': 21.0, 'Time': '2024-02-18 20:12:00'},
+         {'VehicleNumber': '1001', 'Lines': '180', 'Brigade': '2',
+          'Lat': 52.3, 'Lon': 21.1, 'Time': '2024-02-18 20:12:00'}],
+        [{'VehicleNumber': '1000', 'Lines': '119', 'Brigade': '1',
+          'Lat': 52.201, 'Lon': 21.0, 'Time': '2024-02-18 20:12:30'}],
+    ])
+    url = f"{base_url}/busestrams_get"
+
+    daemon = LiveDaemon(lambda: send_request(url), LivePositions(window=600.0),
+                        ('127.0.0.1', 0), {'7009,01': (52.2005, 21.0)})
+    daemon.start()
+    try:
+        daemon.run(0.05, iterations=2)
+
+        positions = requests.get(f"{daemon.url}/positions").json()['result']
+        assert sorted(fix['VehicleNumber'] for fix in positions) == ['1000', '1001']
+        [fix] = requests.get(f"{daemon.url}/positions?line=119").json()['result']
+        assert fix['Lat'] == 52.201
+
+        [near] = requests.get(f"{daemon.url}/near?stop=7009,01&radius=200").json()['result']
+        assert near['VehicleNumber'] == '1000' and near['Distance'] == pytest.approx(55.6, abs=1)
+
+        speed = requests.get(f"{daemon.url}/speed?vehicle=1000").json()['result']
+        assert speed['Fixes'] == 2 and speed['Speed'] == pytest.approx(111.2 / 30 * 3.6, rel=1e-2)
+        assert requests.get(f"{daemon.url}/speed?vehicle=9999").status_code == 404
+        assert requests.get(f"{daemon.url}/near?radius=100").status_code == 400
+        assert requests.get(f"{daemon.url}/near?stop=7009,01&radius=inf").status_code == 400
+    finally:
+        daemon.stop()
+
+
+@pytest.mark.parametrize('stub_server', [FlakyHandler], indirect=True)
+def test_send_request_retry_policy_with_stub_server(stub_server):
+    url, state = stub_server
+    calls = state['calls'] = {'/flaky': 0, '/missing': 0}
+    client = ApiClient(retry_policy=RetryPolicy(base_delay=10.0))
+
+    start = monotonic()
+    assert send_request(f"{url}/flaky", client).status_code == 200
+    assert send_request(f"{url}/missing", client) is None
+    # Retry-After: 0 overrides the backoff and the 404 is not retried
+    assert monotonic() - start < 5.0
+    assert calls == {'/flaky': 3, '/missing': 1}
+    stats = client.stats.summary()
+    assert stats['/flaky']['attempts'] == 3 and stats['/flaky']['errors'] == 2
+    assert stats['/missing']['failed'] == 1
+
+def test_circuit_breaker_opens_on_failure_spike():
+    breaker = CircuitBreaker(threshold=0.5, window=4, min_attempts=4, cooldown=0.2)
+    for success in (True, False, True):
+        breaker.record(success)
+    assert breaker.opened == 0
+    breaker.record(False)
+    assert breaker.opened == 1
+
+    start = monotonic()
+    breaker.wait()
+    assert monotonic() - start >= 0.15
+    assert 0.0 <= RetryPolicy(base_delay=1.0).delay(3) <= 8.0
+    assert RetryPolicy(max_delay=30.0).delay(0, retry_after=120.0) == 30.0
+
+
+@pytest.mark.parametrize('stub_server', [EtagHandler], indirect=True)
+def test_response_cache_revalidates_and_serves_offline(stub_server, tmpdir):
+    url, state = stub_server
+    calls = state['calls'] = []
+    filepath = os.path.join(tmpdir.strpath, 'http-cache.sqlite')
+    client = ApiClient(cache=ResponseCache(filepath, ttl=60.0))
+    assert send_request(f"{url}/stops?id=1&apikey=a", client).json() == {'result': ['/stops']}
+    # Keyed without the apikey, fresh responses do not hit the API
+    assert send_request(f"{url}/stops?id=1&apikey=b", client).json() == {'result': ['/stops']}
+    assert len(calls) == 1
+
+    client.cache.ttl = 0.0
+    assert send_request(f"{url}/stops?id=1&apikey=a", client).json() == {'result': ['/stops']}
+    assert calls[-1] == ('/stops?id=1&apikey=a', '"v1"')
+    client.cache.close()
+
+    offline = ApiClient(cache=ResponseCache(filepath, ttl=0.0, offline=True))
+    assert send_request(f"{url}/stops?id=1", offline).json() == {'result': ['/stops']}
+    assert send_request(f"{url}/lines?id=1", offline) is None
+    assert len(calls) == 2
+    offline.cache.close()
+
+def test_response_cache_evicts_least_recently_used(tmpdir):
+    cache = ResponseCache(os.path.join(tmpdir.strpath, 'http-cache.sqlite'), max_bytes=30)
+    for path in ('a', 'b', 'c'):
+        response = MagicMock(status_code=200, content=f'{{"result": "{path}"}}'.encode(),
+                             headers={})
+        cache.put(f"http://example.com/{path}", response)
+        if path == 'b':
+            cache.get("http://example.com/a")
+    # Each body has 15 bytes, so only a and c fit, b was used least recently
+    assert cache.get("http://example.com/b") is None
+    assert cache.get("http://example.com/a").json() == {'result': 'a'}
+    assert cache.size == 30
+    cache.close()
+
+def test_live_positions_near_bounds_radius():
+    positions = LivePositions()
+    positions.update([{'VehicleNumber': '1000', 'Lines': '119', 'Brigade': '1',
+                       'Lat': 52.2, 'Lon': 21.0, 'Time': '2024-02-18 20:12:00'},
+                      {'VehicleNumber': '1001', 'Lines': '180', 'Brigade': '2',
+                       'Lat': 52.3, 'Lon': 21.1, 'Time': '2024-02-18 20:12:00'}])
+
+    start = monotonic()
+    # The block of cells is larger than the occupied cells, which are scanned instead
+    assert [fix['VehicleNumber'] for fix in positions.near(52.2, 21.0, 20000.0)] == \
+        ['1000', '1001']
+    assert monotonic() - start < 0.5
+    assert [fix['VehicleNumber'] for fix in positions.near(52.2, 21.0, 100.0)] == ['1000']
+    for radius in (float('inf'), float('nan'), -1.0, LivePositions.MAX_RADIUS + 1.0):
+        with pytest.raises(ValueError):
+            positions.near(52.2, 21.0, radius)
+    with pytest.raises(ValueError):
+        positions.near(float('inf'), 21.0)
+
+class BadJsonResponse:
+    def json(self):
+        raise ValueError('Expecting value')
+
+def test_live_daemon_skips_invalid_responses():
+    valid = MagicMock()
+    valid.json.return_value = {'result': [{'VehicleNumber': '1000', 'Lines': '119',
+                                           'Brigade': '1', 'Lat': 52.2, 'Lon': 21.0,
+                                           'Time': '2024-02-18 20:12:00'}]}
+    wrong_shapes = [MagicMock(**{'json.return_value': value})
+                    for value in ({}, [], {'result': 'Błędna metoda lub parametry wywołania'})]
+    responses = iter([None, BadJsonResponse(), *wrong_shapes, valid])
+
+    daemon = LiveDaemon(lambda: next(responses), LivePositions(), ('127.0.0.1', 0))
+    try:
+        daemon.run(0.02, iterations=6)
+    finally:
+        daemon.stop()
+    assert [fix['VehicleNumber'] for fix in daemon.positions.positions()] == ['1000']
+
+def test_speeding_detector_skips_implausible_fixes():
+    detector = SpeedingDetector(speed_limit=50.0)
+    fix1 = {'VehicleNumber': '1000', 'Lines': '119', 'Brigade': '1',
+            'Lat': 52.2, 'Lon': 21.0, 'Time': '2024-02-18 20:12:00'}
+    # A GPS jump of 11 km within 30 s, after which the vehicle stays at the new location
+    jump = {**fix1, 'Lat': 52.3, 'Time': '2024-02-18 20:12:30'}
+    stay = {**jump, 'Lat': 52.3001, 'Time': '2024-02-18 20:13:00'}
+    outside = {**fix1, 'Lat': 0.0, 'Lon': 0.0, 'Time': '2024-02-18 20:13:15'}
+    fast = {**stay, 'Lat': 52.3061, 'Time': '2024-02-18 20:13:30'}
+
+    for fix in (fix1, jump, stay, outside):
+        assert detector.process([fix]) == []
+    # Speeding is measured from the last fix within the service area
+    [event] = detector.process([fast])
+    assert event['Time'] == stay['Time'] and event['Speed'] == pytest.approx(80.1, abs=0.5)
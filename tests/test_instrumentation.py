@@ -0,0 +1,50 @@
+import json
+import pytest
+import instrumentation
+from instrumentation import stage, event, instrumented
+
+
+@pytest.fixture
+def metrics_path(tmpdir):
+    path = str(tmpdir.join('metrics.jsonl'))
+    instrumentation.enable(path, trace_memory=True)
+    yield path
+    instrumentation.disable()
+
+
+def read_records(path):
+    with open(path, encoding='utf-8') as metrics_file:
+        return [json.loads(line) for line in metrics_file]
+
+
+def test_stage_records_nested_stages_and_counters(metrics_path):
+    @instrumented('match')
+    def match():
+        return [0] * 100000
+
+    with stage('load', filepath='capture.json') as current:
+        current.add(items=10)
+        current.add(items=5, bytes=1024)
+        match()
+    event('retry', attempt=1)
+
+    inner, outer, retry = read_records(metrics_path)
+    assert inner['stage'] == 'match' and inner['parent'] == 'load'
+    assert outer['stage'] == 'load' and outer['parent'] is None
+    assert outer['items'] == 15 and outer['bytes'] == 1024
+    assert outer['filepath'] == 'capture.json'
+    assert outer['peak_bytes'] >= inner['peak_bytes'] > 0
+    assert outer['seconds'] >= inner['seconds']
+    assert retry['event'] == 'retry' and retry['attempt'] == 1
+
+
+def test_stage_records_errors_and_is_silent_when_disabled(metrics_path):
+    with pytest.raises(ValueError):
+        with stage('validate'):
+            raise ValueError('bad data')
+    assert read_records(metrics_path)[0]['error'] == 'ValueError'
+
+    instrumentation.disable()
+    with stage('validate') as current:
+        current.add(items=1)
+    assert len(read_records(metrics_path)) == 1